@@ -4,9 +4,11 @@ from dataclasses import dataclass
 import os
 import configparser
 import json
-from time import sleep
+from time import monotonic, sleep
 from botocore.exceptions import ClientError
 
+from db import read_config
+
 # Load Environment Variables
 # load_dotenv()
 
@@ -34,8 +36,7 @@ def init():
     
     """
     # CONFIG
-    config = configparser.ConfigParser()
-    config.read("dwh.cfg")
+    config = read_config()
     envs = Environments(
         key=config.get("CLUSTER", "ACCESS_KEY"),
         secret=config.get("CLUSTER", "SECRET"),
@@ -55,6 +56,103 @@ def init():
     return envs
 
 
+def write_cluster_config(path="dwh.cfg", host=None, role_arn=None):
+    """ Writes the endpoint of the cluster and the role arn back into the configuration, keeping the case of the keys
+    and the rest of the file as it is.
+
+    Args:
+    path (str): The path of the configuration file.
+    host (str): The endpoint address of the cluster, written to HOST of the CLUSTER section.
+    role_arn (str): The arn of the role of the cluster, written to ARN of the IAM_ROLE section.
+    """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(path)
+    if host is not None:
+        config["CLUSTER"]["HOST"] = host
+    if role_arn is not None:
+        config["IAM_ROLE"]["ARN"] = role_arn
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        config.write(f, space_around_delimiters=False)
+    os.replace(tmp_path, path)
+    print(f"The configuration {path} is updated")
+
+
+def wait_for_cluster(
+    redshift, cluster_identifier, status, timeout=1800, initial_delay=5, max_delay=60, settled=False
+):
+    """ Polls the status of the cluster with an exponential backoff until it reaches the expected status, printing
+    the progress. Returns the properties of the cluster, or None once a deleted cluster is gone.
+
+    Args:
+    redshift (obj): [Boto3 redshift object]
+    cluster_identifier (str): [The identifier of the cluster]
+    status (str): [The expected status, for example available or deleted]
+    timeout (int): [The maximum number of seconds to wait]
+    initial_delay (float): [The seconds to wait before the second check, doubled after every check]
+    max_delay (float): [The maximum seconds between two checks]
+    settled (bool): [Also wait until the cluster has no pending modifications, required before a resize]
+    """
+    started = monotonic()
+    delay = initial_delay
+    while True:
+        try:
+            props = redshift.describe_clusters(ClusterIdentifier=cluster_identifier)["Clusters"][0]
+        except redshift.exceptions.ClusterNotFoundFault:
+            if status == "deleted":
+                print(f"The cluster is deleted after {monotonic() - started:.0f}s")
+                return None
+            raise
+        cluster_status = props["ClusterStatus"].lower()
+        if settled and cluster_status == status and props.get("PendingModifiedValues"):
+            cluster_status = "pending modifications"
+        elapsed = monotonic() - started
+        if cluster_status == status:
+            print(f"The cluster is {cluster_status} after {elapsed:.0f}s")
+            return props
+        if elapsed + delay > timeout:
+            raise TimeoutError(f"The cluster is still {cluster_status} after {elapsed:.0f}s, expected {status}")
+        print(f"[{elapsed:5.0f}s] The current status is {cluster_status}, checking again in {delay:.0f}s")
+        sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def poll_settings(config):
+    """ Returns the timeout, the initial and the maximum delay of the status polling from the IAC section.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    return dict(
+        timeout=config.getint("IAC", "POLL_TIMEOUT", fallback=1800),
+        initial_delay=config.getfloat("IAC", "POLL_INITIAL_DELAY", fallback=5),
+        max_delay=config.getfloat("IAC", "POLL_MAX_DELAY", fallback=60),
+    )
+
+
+def cluster_available(ec2, redshift, envs, poll):
+    """ Waits for the cluster to be available, then opens the db port and writes the endpoint and the role arn
+    into dwh.cfg.
+
+    Args:
+    ec2 (obj): [Boto3 ec2 object]
+    redshift (obj): [Boto3 redshift object]
+    envs (Environment): [Class containing the environment data]
+    poll (dict): [The polling settings as returned by poll_settings]
+    """
+    props = wait_for_cluster(redshift, envs["cluster_identifier"], "available", **poll)
+    end_point_port = f"{props['Endpoint']['Address']}:{props['Endpoint']['Port']}"
+    role_arn = props["IamRoles"][0]["IamRoleArn"] if props.get("IamRoles") else envs.get("roleARN")
+    print(f"The created endpoint with port is {end_point_port}")
+    print(f"The role arn created is {role_arn}")
+    envs["endpoint_address"] = props["Endpoint"]["Address"]
+    # Allow VPC to connect to the db_port. If exists then simply print the exception.
+    attach_sg(ec2, props, envs)
+    write_cluster_config(host=envs["endpoint_address"], role_arn=role_arn)
+    return props
+
+
 def attach_sg(ec2, props, envs):
     """ Attaches the security group based on the provided properties and environment.
     
@@ -63,6 +161,9 @@ def attach_sg(ec2, props, envs):
     props (dict): [Dictionary object of the defined properties]
     envs (Environment): [Class containing the environment data]
     """
+    if not props.get("VpcId"):
+        print("The cluster is not in a VPC, skipping the security group")
+        return
     try:
         vpc = ec2.Vpc(id=props["VpcId"])
         defaultSg = list(vpc.security_groups.all())[0]
@@ -77,17 +178,17 @@ def attach_sg(ec2, props, envs):
     except ClientError as exc:
         print(exc)
         print("Continuing...")
-    except Exception as e:
-        print(e)
 
 
-def create_cluster(ec2, redshift, envs):
+def create_cluster(ec2, redshift, envs, poll, wait=True):
     """ Creates the redshift cluster based upon the provided environmental data as configurations.
     
     Args:
     ec2 (obj): [Boto3 ec2 object]
     redshift (obj): [Boto3 redshift object]
     envs (Environment): [Class containing the environment data]
+    poll (dict): [The polling settings as returned by poll_settings]
+    wait (bool): [Wait for the cluster to be available, otherwise return once it is requested]
     """
     try:
         response = redshift.create_cluster(
@@ -102,41 +203,15 @@ def create_cluster(ec2, redshift, envs):
             MasterUserPassword=envs["db_password"],
             # Roles (for s3 access)
             IamRoles=[envs["roleARN"]],
+            # WLM queues
+            **({"ClusterParameterGroupName": envs["parameter_group"]} if envs.get("parameter_group") else {}),
         )
         if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-            props = redshift.describe_clusters(
-                ClusterIdentifier=envs["cluster_identifier"]
-            )["Clusters"][0]
-            cluster_status = props["ClusterStatus"].lower()
-            while cluster_status != "available":
-                print("Cluster is still being prepared ...")
-                print(f"The current status is {cluster_status}")
-                props = redshift.describe_clusters(
-                    ClusterIdentifier=envs["cluster_identifier"]
-                )["Clusters"][0]
-                cluster_status = props["ClusterStatus"].lower()
-                sleep(30)
-
-            props = redshift.describe_clusters(
-                ClusterIdentifier=envs["cluster_identifier"]
-            )["Clusters"][0]
-            print(
-                f"The cluster is available with the status is {props['ClusterStatus']}"
-            )
-            end_point_port = (
-                f"{props['Endpoint']['Address']}:{props['Endpoint']['Port']}"
-            )
-            role_arn = props["IamRoles"][0]["IamRoleArn"]
-            print(f"The created endpoint with port is {end_point_port}")
-            endpoint_address = props["Endpoint"]["Address"]
-            print(
-                f"Use the Host - {endpoint_address} in the ETL process by updating the dwh.cfg"
-            )
-            print(f"The role arn created is {role_arn}")
-            # Updating the envs
-            envs["endpoint_address"] = endpoint_address
-            # Allow VPC to connect to the db_port. If exists then simply print the exception.
-            attach_sg(ec2, props, envs)
+            write_cluster_config(role_arn=envs["roleARN"])
+            if wait:
+                cluster_available(ec2, redshift, envs, poll)
+            else:
+                print("The cluster is requested, run the wait option to write its endpoint once it is available")
         else:
             print(
                 f"The status of creation is not success and code returned is {response['ResponseMetadata']['HTTPStatusCode']}"
@@ -145,34 +220,25 @@ def create_cluster(ec2, redshift, envs):
             print(response)
     except ClientError as exc:
         print(exc)
-    except Exception as e:
-        raise e
+        raise
 
 
-def teardown_cluster(redshift, envs):
+def teardown_cluster(redshift, envs, poll, wait=True):
     """ Delete the redshift cluster based upon the provided environmental data as configurations.
     
     Args:
     redshift (obj): [Boto3 redshift object]
     envs (Environment): [Class containing the environment data]
+    poll (dict): [The polling settings as returned by poll_settings]
+    wait (bool): [Wait for the cluster to be deleted]
     """
     try:
         response = redshift.delete_cluster(
             ClusterIdentifier=envs["cluster_identifier"], SkipFinalClusterSnapshot=True
         )
         if response["ResponseMetadata"]["HTTPStatusCode"] == 200:
-            props = redshift.describe_clusters(
-                ClusterIdentifier=envs["cluster_identifier"]
-            )["Clusters"][0]
-            cluster_status = props["ClusterStatus"]
-            while cluster_status == "deleting":
-                print("Cluster is still being deleted ...")
-                print(f"The current status is {cluster_status}")
-                props = redshift.describe_clusters(
-                    ClusterIdentifier=envs["cluster_identifier"]
-                )["Clusters"][0]
-                cluster_status = props["ClusterStatus"]
-                sleep(10)
+            if wait:
+                wait_for_cluster(redshift, envs["cluster_identifier"], "deleted", **poll)
         else:
             print("Something has gone wrong")
             print("Response:")
@@ -184,6 +250,196 @@ def teardown_cluster(redshift, envs):
         raise e
 
 
+def describe_cluster(redshift, envs):
+    """ Returns the properties of the cluster.
+
+    Args:
+    redshift (obj): [Boto3 redshift object]
+    envs (Environment): [Class containing the environment data]
+    """
+    return redshift.describe_clusters(ClusterIdentifier=envs["cluster_identifier"])["Clusters"][0]
+
+
+def pause_cluster(redshift, envs, poll, wait=True):
+    """ Pauses the cluster, only its storage is billed while it is paused. A paused cluster is left as it is.
+
+    Args:
+    redshift (obj): [Boto3 redshift object]
+    envs (Environment): [Class containing the environment data]
+    poll (dict): [The polling settings as returned by poll_settings]
+    wait (bool): [Wait for the cluster to be paused]
+    """
+    if describe_cluster(redshift, envs)["ClusterStatus"].lower() == "paused":
+        print("The cluster is already paused")
+        return
+    # A cluster can only be paused once the running operations (for example a resize) are completed.
+    wait_for_cluster(redshift, envs["cluster_identifier"], "available", settled=True, **poll)
+    redshift.pause_cluster(ClusterIdentifier=envs["cluster_identifier"])
+    print("The cluster is pausing")
+    if wait:
+        wait_for_cluster(redshift, envs["cluster_identifier"], "paused", **poll)
+
+
+def resume_cluster(redshift, envs, poll, wait=True):
+    """ Resumes a paused cluster, the endpoint of the cluster stays the same. A running cluster is left as it is.
+
+    Args:
+    redshift (obj): [Boto3 redshift object]
+    envs (Environment): [Class containing the environment data]
+    poll (dict): [The polling settings as returned by poll_settings]
+    wait (bool): [Wait for the cluster to be available]
+    """
+    if describe_cluster(redshift, envs)["ClusterStatus"].lower() == "paused":
+        redshift.resume_cluster(ClusterIdentifier=envs["cluster_identifier"])
+        print("The cluster is resuming")
+    else:
+        print("The cluster is not paused")
+    if wait:
+        wait_for_cluster(redshift, envs["cluster_identifier"], "available", settled=True, **poll)
+
+
+def resize_cluster(redshift, envs, n_nodes, poll, wait=True):
+    """ Elastically resizes the cluster to a number of nodes of the same node type. The resize is requested once the
+    cluster is available without pending modifications, and skipped when the cluster already has that size.
+
+    Args:
+    redshift (obj): [Boto3 redshift object]
+    envs (Environment): [Class containing the environment data]
+    n_nodes (int): [The number of nodes after the resize]
+    poll (dict): [The polling settings as returned by poll_settings]
+    wait (bool): [Wait for the resize to be completed]
+    """
+    props = wait_for_cluster(redshift, envs["cluster_identifier"], "available", settled=True, **poll)
+    if int(props["NumberOfNodes"]) == int(n_nodes):
+        print(f"The cluster already has {n_nodes} nodes")
+        return
+    redshift.resize_cluster(
+        ClusterIdentifier=envs["cluster_identifier"],
+        ClusterType="multi-node" if int(n_nodes) > 1 else "single-node",
+        NodeType=props["NodeType"],
+        NumberOfNodes=int(n_nodes),
+        Classic=False,
+    )
+    print(f"The cluster is resizing from {props['NumberOfNodes']} to {n_nodes} nodes")
+    if wait:
+        wait_for_cluster(redshift, envs["cluster_identifier"], "available", settled=True, **poll)
+
+
+def wlm_configuration(config):
+    """ Returns the manual WLM queues of the WLM section of dwh.cfg as the wlm_json_configuration parameter:
+    one queue per query group (matched with a wildcard, so that the stage labels etl-insert_tables and the like are
+    routed too), the default queue with the remaining memory and the short query acceleration.
+
+    Args:
+    config (ConfigParser): [The parsed dwh.cfg configuration]
+    """
+    queues = []
+    for workload in ("ETL", "ANALYSIS"):
+        queues.append(
+            {
+                "query_group": [f"{config.get('WLM', f'{workload}_QUERY_GROUP')}*"],
+                "query_group_wild_card": 1,
+                "query_concurrency": config.getint("WLM", f"{workload}_CONCURRENCY"),
+                "memory_percent_to_use": config.getint("WLM", f"{workload}_MEMORY_PERCENT"),
+                "concurrency_scaling": config.get("WLM", f"{workload}_CONCURRENCY_SCALING", fallback="off"),
+            }
+        )
+    default_memory = 100 - sum(queue["memory_percent_to_use"] for queue in queues)
+    if default_memory <= 0:
+        raise ValueError("The memory of the WLM queues must leave a share to the default queue")
+    queues.append(
+        {
+            "query_concurrency": config.getint("WLM", "DEFAULT_CONCURRENCY", fallback=5),
+            "memory_percent_to_use": default_memory,
+        }
+    )
+    queues.append({"short_query_queue": config.getboolean("WLM", "SHORT_QUERY_ACCELERATION", fallback=True)})
+    return queues
+
+
+def apply_parameter_group(redshift, config):
+    """ Creates the parameter group of the WLM section of dwh.cfg unless it exists and sets its WLM queues and
+    concurrency scaling. Returns the name of the parameter group, or None when PARAMETER_GROUP is not set.
+
+    Args:
+    redshift (obj): [Boto3 redshift object]
+    config (ConfigParser): [The parsed dwh.cfg configuration]
+    """
+    name = config.get("WLM", "PARAMETER_GROUP", fallback="")
+    if not name:
+        return None
+    try:
+        redshift.create_cluster_parameter_group(
+            ParameterGroupName=name,
+            ParameterGroupFamily="redshift-1.0",
+            Description="Sparkify WLM queues isolating the ETL from the analysis queries",
+        )
+        print(f"The parameter group {name} is created")
+    except redshift.exceptions.ClusterParameterGroupAlreadyExistsFault:
+        print(f"The parameter group {name} already exists, updating it")
+    redshift.modify_cluster_parameter_group(
+        ParameterGroupName=name,
+        Parameters=[
+            {
+                "ParameterName": "wlm_json_configuration",
+                "ParameterValue": json.dumps(wlm_configuration(config)),
+                "ApplyType": "dynamic",
+            },
+            {
+                "ParameterName": "max_concurrency_scaling_clusters",
+                "ParameterValue": config.get("WLM", "MAX_CONCURRENCY_SCALING_CLUSTERS", fallback="1"),
+                "ApplyType": "dynamic",
+            },
+        ],
+    )
+    print(f"The WLM queues of {name} are set")
+    return name
+
+
+def apply_wlm(redshift, envs, config, poll):
+    """ Applies the WLM parameter group to the running cluster. The changes of the queue concurrency and memory are
+    applied dynamically, adding or removing a queue requires a reboot of the cluster.
+
+    Args:
+    redshift (obj): [Boto3 redshift object]
+    envs (Environment): [Class containing the environment data]
+    config (ConfigParser): [The parsed dwh.cfg configuration]
+    poll (dict): [The polling settings as returned by poll_settings]
+    """
+    name = apply_parameter_group(redshift, config)
+    if name is None:
+        print("PARAMETER_GROUP is not set in the WLM section, the cluster keeps its WLM configuration")
+        return
+    props = wait_for_cluster(redshift, envs["cluster_identifier"], "available", settled=True, **poll)
+    groups = [group["ParameterGroupName"] for group in props.get("ClusterParameterGroups", [])]
+    if name not in groups:
+        redshift.modify_cluster(ClusterIdentifier=envs["cluster_identifier"], ClusterParameterGroupName=name)
+        print(f"The cluster is using the parameter group {name}")
+        props = wait_for_cluster(redshift, envs["cluster_identifier"], "available", settled=True, **poll)
+    statuses = {group.get("ParameterApplyStatus") for group in props.get("ClusterParameterGroups", [])}
+    if "pending-reboot" in statuses:
+        print(
+            "The parameter group is applied after a reboot: aws redshift reboot-cluster --cluster-identifier "
+            f"{envs['cluster_identifier']}"
+        )
+
+
+def aws_clients(envs, endpoint_url=None):
+    """ Creates the iam and redshift clients and the ec2 resource.
+
+    Args:
+    envs (Environment): [Class containing the environment data]
+    endpoint_url (str): [The endpoint of the AWS services, for example a local moto server]
+    """
+    session = dict(
+        region_name=envs["region"],
+        aws_access_key_id=envs["key"],
+        aws_secret_access_key=envs["secret"],
+        endpoint_url=endpoint_url,
+    )
+    return boto3.client("iam", **session), boto3.client("redshift", **session), boto3.resource("ec2", **session)
+
+
 def create_iam_role(iam, envs):
     """ Creates the IAM role to allow redshift cluster to call AWS Services using the environmental data as configurations.
     
@@ -212,45 +468,49 @@ def create_iam_role(iam, envs):
     except iam.exceptions.EntityAlreadyExistsException as exc:
         print(exc)
         print("Continuing...")
-    except Exception as e:
-        print(e)
 
 
 @click.command()
 @click.option(
     "--name",
-    prompt="Your options either to create/delete/delete_role for creation of cluster, and deletion.",
-    help="This is used to create redshift cluster or delete the cluster",
+    prompt="Your options either to create/delete/delete_role for creation of cluster, and deletion "
+    "(or wait/pause/resume/resize/wlm).",
+    help="This is used to create redshift cluster or delete the cluster, wait waits for a requested cluster, "
+    "pause/resume pause and resume the cluster, resize resizes it elastically to --nodes nodes and wlm applies "
+    "the WLM queues of dwh.cfg",
+)
+@click.option(
+    "--endpoint-url",
+    default=None,
+    help="The endpoint of the AWS services, for example a local moto server (http://localhost:5000) in CI.",
+)
+@click.option(
+    "--wait/--no-wait",
+    default=True,
+    help="Wait for the cluster to be available (create, resume, resize), deleted (delete) or paused (pause), "
+    "polling with an exponential backoff.",
+)
+@click.option(
+    "--nodes",
+    type=int,
+    default=None,
+    help="The number of nodes of the resize option, by default DWH_NUM_NODES.",
 )
-def do_work(name):
+def do_work(name, endpoint_url, wait, nodes):
     # init the environment variables
-    """ This is a wrapper function which first based on the options (create/delete/delete_role) obtained from commandline
-    will utilize that and perform creation of cluster, deletion etc..
+    """ This is a wrapper function which first based on the options (create/delete/delete_role/wait/pause/resume/resize/wlm)
+    obtained from commandline will utilize that and perform creation of cluster, deletion etc..
+    Once the cluster is available its endpoint and role arn are written into dwh.cfg.
     
     Args (name): [The value user provides from the commandline]
     """
     try:
         envs = init()
+        config = read_config()
+        poll = poll_settings(config)
         if envs != -1:
             # Based on name either create or destroy
-            iam = boto3.client(
-                "iam",
-                region_name=envs["region"],
-                aws_access_key_id=envs["key"],
-                aws_secret_access_key=envs["secret"],
-            )
-            redshift = boto3.client(
-                "redshift",
-                region_name=envs["region"],
-                aws_access_key_id=envs["key"],
-                aws_secret_access_key=envs["secret"],
-            )
-            ec2 = boto3.resource(
-                "ec2",
-                region_name=envs["region"],
-                aws_access_key_id=envs["key"],
-                aws_secret_access_key=envs["secret"],
-            )
+            iam, redshift, ec2 = aws_clients(envs, endpoint_url)
 
             if name == "create":
                 # Create a iam role.
@@ -267,8 +527,10 @@ def do_work(name):
                 roleArn = iam.get_role(RoleName=envs["iam_role_name"])["Role"]["Arn"]
                 print(f"The role arn is {roleArn}, attaching that to envs")
                 envs["roleARN"] = roleArn
+                # The WLM queues of the ETL and analysis query groups.
+                envs["parameter_group"] = apply_parameter_group(redshift, config)
                 # Creation of redshift cluster
-                create_cluster(ec2, redshift, envs)
+                create_cluster(ec2, redshift, envs, poll, wait)
                 # Print the total environment information.
                 print(
                     "The cluster and environment details are listed down below to be used in the environment files"
@@ -278,7 +540,18 @@ def do_work(name):
 
             elif name == "delete":
                 # Destroy reshift cluster and associated entities.
-                teardown_cluster(redshift, envs)
+                teardown_cluster(redshift, envs, poll, wait)
+            elif name == "wait":
+                # Wait for a cluster requested with --no-wait and write its endpoint into dwh.cfg.
+                cluster_available(ec2, redshift, envs, poll)
+            elif name == "pause":
+                pause_cluster(redshift, envs, poll, wait)
+            elif name == "resume":
+                resume_cluster(redshift, envs, poll, wait)
+            elif name == "resize":
+                resize_cluster(redshift, envs, nodes or envs["n_nodes"], poll, wait)
+            elif name == "wlm":
+                apply_wlm(redshift, envs, config, poll)
             elif name == "delete_role":
                 # remove associated role information.
                 r1 = iam.detach_role_policy(
@@ -300,8 +573,11 @@ def do_work(name):
             print(
                 "The required envs cannot be empty in the env file for creation of resources in the AWS"
             )
+            raise SystemExit(1)
     except Exception as e:
         print(e)
+        # A failed step exits with a non-zero status, so that the scripts and the CI calling it stop there.
+        raise SystemExit(1) from e
 
 
 if __name__ == "__main__":
@@ -0,0 +1,482 @@
+"""
+This python file provides the physical design advisor of the warehouse tables, which:
+1. Captures a snapshot of the catalog (SVV_TABLE_INFO row counts, sizes and skew, the number of slices and the
+   value distribution of the join and filter columns), so the advice can also be computed offline.
+2. Extracts the join, filter and range filter columns of every table from the analysis and insert queries.
+3. Recommends DISTSTYLE ALL/KEY/EVEN, a compound or interleaved sort key and the column encodings.
+4. Writes the CREATE TABLE queries of the current and recommended designs.
+5. Benchmarks the design variants on the cluster by deep copying every table and timing the analysis queries.
+"""
+
+import json
+import os
+import re
+import statistics
+from collections import Counter, defaultdict
+from dataclasses import replace
+from datetime import datetime, timezone
+from time import perf_counter
+
+import click
+
+from db import Warehouse, read_config
+from ddl import TABLES, Design, Table, column_encoding, create_table_query
+from sql_queries import (
+    analyze_queries,
+    insert_table_queries,
+    staging_events_columns,
+    staging_events_match_key_update,
+    staging_songs_columns,
+)
+
+# A dimension up to this number of rows is copied to every node when it is only joined to larger tables.
+ALL_MAX_ROWS = 1000000
+# The estimated rows of the heaviest slice over the average slice above which a column is rejected as DISTKEY.
+SKEW_LIMIT = 2.0
+MAX_SORTKEY_COLUMNS = 3
+
+TABLE_INFO_QUERY = """
+SELECT "table", diststyle, sortkey1, skew_rows, tbl_rows, size, unsorted, stats_off, encoded
+FROM svv_table_info
+WHERE schema = 'public';
+"""
+
+SLICES_QUERY = "SELECT COUNT(*) FROM stv_slices;"
+
+COLUMN_STATS_QUERY = """
+SELECT COUNT(DISTINCT {column}), COALESCE(MAX(n), 0), COALESCE(SUM(CASE WHEN {column} IS NULL THEN n END), 0)
+FROM (SELECT {column}, COUNT(*) AS n FROM {table} GROUP BY {column}) v;
+"""
+
+RANGE_OPERATORS = ("between", ">", "<", ">=", "<=")
+
+# The columns loaded by COPY into the staging tables. The other columns are only filled after the load, so they are
+# NULL on every row while COPY distributes the rows.
+COPY_COLUMNS = {
+    "staging_events": set(staging_events_columns.strip("()").split(", ")),
+    "staging_songs": set(staging_songs_columns.strip("()").split(", ")),
+}
+# The columns set on every row by the enrichment update after the COPY. The update writes new versions of the rows,
+# which are distributed on their key, so they can be a DISTKEY but would be left unsorted as a sort key.
+ENRICHED_COLUMNS = {
+    "staging_events": set(re.findall(r"^(?:SET\s+)?(\w+)\s*=", staging_events_match_key_update, re.M)),
+}
+
+
+def table_aliases(query):
+    """ Returns the alias of every table of the warehouse used in a query mapped to the table name,
+    every table is also reachable through its own name.
+
+    Args:
+    query (str): The query text.
+    """
+    aliases = {}
+    keywords = {"on", "where", "join", "group", "order", "limit", "using", "set", "inner", "left", "right"}
+    for table, alias in re.findall(r"\b(?:from|join|into|using|update)\s+(\w+)(?:\s+(?:as\s+)?(\w+))?", query, re.I):
+        if table in TABLES:
+            aliases[table] = table
+            if alias and alias.lower() not in keywords:
+                aliases[alias] = table
+    return aliases
+
+
+def resolve(aliases, ref, tables):
+    """ Returns the (table, column) of a column reference, qualified (alias.column) or not.
+
+    Args:
+    aliases (dict): The aliases of the query as returned by table_aliases.
+    ref (str): The column reference.
+    tables (set): The tables used in the query.
+    """
+    if "." in ref:
+        alias, column = ref.split(".", 1)
+        table = aliases.get(alias)
+        if table and any(c.name == column for c in TABLES[table].columns):
+            return table, column
+        return None
+    owners = [table for table in tables if any(c.name == ref for c in TABLES[table].columns)]
+    return (owners[0], ref) if len(owners) == 1 else None
+
+
+def query_patterns(queries):
+    """ Counts the join, filter and range filter columns of every table in the queries.
+    Returns the patterns per table and the joined (table, column) pairs.
+
+    Args:
+    queries (list): The query texts.
+    """
+    patterns = defaultdict(lambda: {"joins": Counter(), "filters": Counter(), "ranges": Counter(), "queries": 0})
+    join_pairs = Counter()
+    single_filters = defaultdict(list)
+    for query in queries:
+        aliases = table_aliases(query)
+        tables = set(aliases.values())
+        for table in tables:
+            patterns[table]["queries"] += 1
+        for left, right in re.findall(r"(\w+\.\w+)\s*=\s*(\w+\.\w+)", query):
+            left, right = resolve(aliases, left, tables), resolve(aliases, right, tables)
+            if left and right and left[0] != right[0]:
+                patterns[left[0]]["joins"][left[1]] += 1
+                patterns[right[0]]["joins"][right[1]] += 1
+                join_pairs[tuple(sorted([left, right]))] += 1
+            elif bool(left) != bool(right):
+                # Joined to a temp table or subquery, for example the DELETE USING of the upserts.
+                table, column = left or right
+                patterns[table]["joins"][column] += 1
+        for where in re.findall(r"\bwhere\b(.*?)(?=\bgroup\b|\border\b|\blimit\b|;|\)\s*$|$)", query, re.I | re.S):
+            filtered = set()
+            for ref, operator, value in re.findall(
+                r"([\w.]+)\s*(between|>=|<=|=|>|<|like|in)\s*('?%?[\w.]*)", where, re.I
+            ):
+                resolved = resolve(aliases, ref, tables)
+                # A join condition or a LIKE with a leading wildcard cannot use the zone maps of a sort key.
+                if not resolved or re.fullmatch(r"\w+\.\w+", value) or value.startswith("'%"):
+                    continue
+                kind = "ranges" if operator.lower() in RANGE_OPERATORS else "filters"
+                patterns[resolved[0]][kind][resolved[1]] += 1
+                filtered.add(resolved)
+            if len(filtered) == 1:
+                table, column = filtered.pop()
+                single_filters[table].append(column)
+    for table, columns in single_filters.items():
+        patterns[table]["single_filters"] = Counter(columns)
+    return patterns, join_pairs
+
+
+def capture_snapshot(db, patterns):
+    """ Captures the catalog statistics needed by the advisor: SVV_TABLE_INFO, the number of slices and the
+    value distribution of the current distkeys and of the join and filter columns.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    patterns (dict): The query patterns as returned by query_patterns.
+    """
+    snapshot = {
+        "captured_at": datetime.now(timezone.utc).isoformat(),
+        "slices": db.fetchone(SLICES_QUERY)[0],
+        "tables": {},
+        "columns": {},
+    }
+    for row in db.run(TABLE_INFO_QUERY, fetch=True):
+        name, diststyle, sortkey1, skew_rows, rows, size, unsorted, stats_off, encoded = row
+        if name not in TABLES:
+            continue
+        snapshot["tables"][name] = {
+            "diststyle": diststyle,
+            "sortkey1": sortkey1,
+            "skew_rows": float(skew_rows) if skew_rows is not None else None,
+            "rows": int(rows or 0),
+            "size_mb": int(size or 0),
+            "unsorted": float(unsorted) if unsorted is not None else None,
+            "stats_off": float(stats_off) if stats_off is not None else None,
+            "encoded": encoded,
+        }
+    for name in snapshot["tables"]:
+        table = TABLES[name]
+        columns = set(patterns[name]["joins"]) | set(patterns[name]["filters"]) | set(patterns[name]["ranges"])
+        if table.design.distkey:
+            columns.add(table.design.distkey)
+        snapshot["columns"][name] = {}
+        for column in sorted(columns):
+            distinct, top_count, nulls = db.fetchone(COLUMN_STATS_QUERY.format(table=name, column=column))
+            snapshot["columns"][name][column] = {"distinct": distinct, "top_count": top_count, "nulls": nulls}
+        print(f"Captured the statistics of {name}")
+    return snapshot
+
+
+def estimated_skew(column_stats, rows, slices):
+    """ Estimates the rows of the heaviest slice over the average slice when distributing on a column:
+    the most frequent value (NULL included) lands on a single slice and a column with fewer distinct values
+    than slices leaves slices empty.
+
+    Args:
+    column_stats (dict): The distinct values, the count of the most frequent value and the NULLs of the column.
+    rows (int): The rows of the table.
+    slices (int): The slices of the cluster.
+    """
+    if not rows:
+        return 1.0
+    average = rows / slices
+    heaviest = max(column_stats["top_count"], rows / max(min(column_stats["distinct"], slices), 1))
+    return heaviest / average
+
+
+def recommend_distribution(name, snapshot, patterns, join_pairs):
+    """ Recommends the distribution of a table with the reasons.
+
+    Args:
+    name (str): The name of the table.
+    snapshot (dict): The catalog snapshot.
+    patterns (dict): The query patterns as returned by query_patterns.
+    join_pairs (Counter): The joined (table, column) pairs as returned by query_patterns.
+    """
+    info = snapshot["tables"].get(name, {})
+    rows = info.get("rows", 0)
+    joins = patterns[name]["joins"]
+    partners = [b[0] if a[0] == name else a[0] for a, b in join_pairs if name in (a[0], b[0])]
+    partner_rows = [snapshot["tables"].get(partner, {}).get("rows", 0) for partner in partners]
+    reasons = []
+    if info.get("skew_rows") and info["skew_rows"] > SKEW_LIMIT:
+        reasons.append(f"the current distribution is skewed ({info['skew_rows']:.2f} rows on the heaviest slice)")
+    if (
+        joins
+        and not name.startswith("staging_")
+        and rows <= ALL_MAX_ROWS
+        and partner_rows
+        and all(rows < other for other in partner_rows)
+    ):
+        reasons.append(f"{rows} rows, only joined to larger tables: copy it to every node")
+        return "ALL", None, reasons
+    column_stats = snapshot["columns"].get(name, {})
+    for column, count in joins.most_common():
+        if name in COPY_COLUMNS and column not in COPY_COLUMNS[name] | ENRICHED_COLUMNS.get(name, set()):
+            reasons.append(f"{column} is joined {count} times but only filled after the COPY")
+            continue
+        if column not in column_stats:
+            reasons.append(f"{column} is joined {count} times, its skew is unknown")
+            return "KEY", column, reasons
+        skew = estimated_skew(column_stats[column], rows, snapshot["slices"])
+        if skew <= SKEW_LIMIT:
+            reasons.append(f"{column} is joined {count} times with an estimated skew of {skew:.2f}")
+            return "KEY", column, reasons
+        reasons.append(f"{column} is joined {count} times but too skewed ({skew:.2f})")
+    if not joins:
+        reasons.append("no join pattern: spread the rows evenly")
+    return "EVEN", None, reasons
+
+
+def recommend_sortkey(name, patterns, distkey):
+    """ Recommends the sort key of a table with the reasons: the range filters first, then the equality filters
+    and the distkey when it is joined on (merge joins). Interleaved when several columns are filtered on alone.
+
+    Args:
+    name (str): The name of the table.
+    patterns (dict): The query patterns as returned by query_patterns.
+    distkey (str): The recommended distkey.
+    """
+    scores = Counter()
+    for column, count in patterns[name]["ranges"].items():
+        scores[column] += 3 * count
+    for column, count in patterns[name]["filters"].items():
+        scores[column] += 2 * count
+    if distkey and patterns[name]["joins"].get(distkey):
+        scores[distkey] += patterns[name]["joins"][distkey]
+    if name in COPY_COLUMNS:
+        # The update filling the other columns after the load would leave the rows unsorted on them.
+        scores = Counter({column: score for column, score in scores.items() if column in COPY_COLUMNS[name]})
+    if not scores:
+        current = TABLES[name].design
+        return current.sortkey, current.sortstyle, ["no filter pattern: keep the current sort key"]
+    sortkey = tuple(column for column, _ in scores.most_common(MAX_SORTKEY_COLUMNS))
+    # Interleaving only pays off when several columns are each the only filter of repeated queries.
+    single = Counter({c: n for c, n in patterns[name].get("single_filters", Counter()).items() if n >= 2})
+    if len(single) >= 2 and min(single.values()) * 2 >= max(single.values()):
+        reason = f"{', '.join(sorted(single))} are each filtered on alone as often"
+        return tuple(sorted(single, key=lambda c: -single[c]))[:MAX_SORTKEY_COLUMNS], "INTERLEAVED", [reason]
+    return sortkey, "COMPOUND", [f"filtered or joined on {', '.join(sortkey)}"]
+
+
+def recommend(snapshot, queries=None):
+    """ Recommends the physical design of every table of the snapshot.
+    Returns the table name mapped to the recommended Design and the reasons.
+
+    Args:
+    snapshot (dict): The catalog snapshot.
+    queries (list): The query patterns to design for, by default the analysis and insert queries.
+    """
+    patterns, join_pairs = query_patterns(queries or analyze_queries + insert_table_queries)
+    recommendations = {}
+    for name in TABLES:
+        if name not in snapshot["tables"]:
+            continue
+        diststyle, distkey, dist_reasons = recommend_distribution(name, snapshot, patterns, join_pairs)
+        sortkey, sortstyle, sort_reasons = recommend_sortkey(name, patterns, distkey)
+        recommendations[name] = (Design(diststyle, distkey, sortkey, sortstyle), dist_reasons + sort_reasons)
+    return recommendations
+
+
+def variants(name, recommended, snapshot):
+    """ Returns the design variants worth benchmarking for a table: the current and recommended designs and
+    the EVEN and (for small tables) ALL distributions with the recommended sort key.
+
+    Args:
+    name (str): The name of the table.
+    recommended (Design): The recommended design.
+    snapshot (dict): The catalog snapshot.
+    """
+    designs = {"current": TABLES[name].design, "recommended": recommended}
+    designs["even"] = replace(recommended, diststyle="EVEN", distkey=None)
+    if not name.startswith("staging_") and snapshot["tables"][name]["rows"] <= ALL_MAX_ROWS:
+        designs["all"] = replace(recommended, diststyle="ALL", distkey=None)
+    unique = {}
+    for label, design in designs.items():
+        if design.describe() not in {d.describe() for d in unique.values()}:
+            unique[label] = design
+    return unique
+
+
+def print_recommendations(snapshot, recommendations):
+    """ Prints the current and recommended design of every table with the reasons and encodings.
+
+    Args:
+    snapshot (dict): The catalog snapshot.
+    recommendations (dict): As returned by recommend.
+    """
+    print(f"--------------------- PHYSICAL DESIGN ({snapshot['slices']} slices) ------------------")
+    for name, (design, reasons) in recommendations.items():
+        info = snapshot["tables"][name]
+        print(f"{name:<16}{info['rows']:>12} rows {info['size_mb']:>8} MB  skew {info.get('skew_rows') or 0:.2f}")
+        print(f"    current      {TABLES[name].design.describe()}")
+        print(f"    recommended  {design.describe()}")
+        for reason in reasons:
+            print(f"      - {reason}")
+        encodings = ", ".join(f"{c.name} {c.encode or column_encoding(c, design)}" for c in TABLES[name].columns)
+        print(f"    encodings    {encodings}")
+
+
+def write_ddl(output_dir, recommendations):
+    """ Writes the create table queries of the current and of the recommended designs, in the order of
+    create_table_queries, into current.sql and recommended.sql.
+
+    Args:
+    output_dir (str): The output directory.
+    recommendations (dict): As returned by recommend.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for label in ("current", "recommended"):
+        path = os.path.join(output_dir, f"{label}.sql")
+        with open(path, "w") as f:
+            for name, table in TABLES.items():
+                design = recommendations[name][0] if label == "recommended" and name in recommendations else None
+                f.write(create_table_query(table, design))
+        print(f"The {label} design is written to {path}")
+
+
+def variant_table(table):
+    """ Returns the table without its IDENTITY column property, so that the rows can be deep copied into a variant.
+
+    Args:
+    table (Table): The table.
+    """
+    columns = [replace(c, constraints=re.sub(r"IDENTITY\(\d+,\s*\d+\)\s*", "", c.constraints)) for c in table.columns]
+    return Table(table.name, columns, table.design)
+
+
+def benchmark_variants(db, snapshot, recommendations, repeat=3, queries=None):
+    """ Benchmarks the design variants of every table on the cluster: the table is deep copied into one table per
+    variant, and the analysis queries reading it are timed against every copy with the result cache disabled.
+    Returns the table name mapped to the variant label mapped to its design, size and median query times.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    snapshot (dict): The catalog snapshot.
+    recommendations (dict): As returned by recommend.
+    repeat (int): The number of timed runs of every query.
+    queries (list): The queries to time, by default the analysis queries.
+    """
+    results = {}
+    for name, (design, _) in recommendations.items():
+        table_queries = [q for q in queries or analyze_queries if re.search(rf"\b{name}\b", q)]
+        if not table_queries:
+            continue
+        results[name] = {}
+        for label, variant in variants(name, design, snapshot).items():
+            copy_name = f"{name}__{label}"
+            db.run(f"DROP TABLE IF EXISTS {copy_name};")
+            db.run(create_table_query(variant_table(TABLES[name]), variant, copy_name))
+            db.run(f"INSERT INTO {copy_name} SELECT * FROM {name};")
+            db.run(f"ANALYZE {copy_name};")
+            size = db.fetchone(f"SELECT size FROM svv_table_info WHERE \"table\" = '{copy_name}';")
+            timings = []
+            for query in table_queries:
+                rewritten = re.sub(rf"\b{name}\b", copy_name, query)
+                durations = []
+                for _ in range(repeat):
+                    started = perf_counter()
+                    db.run("SET enable_result_cache_for_session TO off;" + rewritten, fetch=True)
+                    durations.append(perf_counter() - started)
+                timings.append(statistics.median(durations))
+            db.run(f"DROP TABLE {copy_name};")
+            results[name][label] = {
+                "design": variant.describe(),
+                "size_mb": size[0] if size else None,
+                "query_s": [round(t, 4) for t in timings],
+                "total_s": round(sum(timings), 4),
+            }
+            print(f"{name:<12} {label:<12} {variant.describe():<40} {sum(timings):8.3f}s")
+    return results
+
+
+def load_snapshot(path):
+    """ Loads a catalog snapshot captured by the snapshot command.
+
+    Args:
+    path (str): The path of the snapshot json file.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+@click.group()
+def cli():
+    """ Advises on the DISTSTYLE, DISTKEY, SORTKEY and encodings of the warehouse tables.
+    """
+
+
+@cli.command()
+@click.option("--output", default="catalog_snapshot.json", show_default=True, help="The snapshot json file.")
+def snapshot(output):
+    """ Captures the catalog statistics of the cluster into a json file for the offline advice.
+    """
+    db = Warehouse(read_config(), workload="analysis")
+    try:
+        patterns, _ = query_patterns(analyze_queries + insert_table_queries)
+        captured = capture_snapshot(db, patterns)
+    finally:
+        db.close()
+    with open(output, "w") as f:
+        json.dump(captured, f, indent=2, default=str)
+    print(f"The catalog snapshot is written to {output}")
+
+
+@cli.command("recommend")
+@click.option("--snapshot", "snapshot_path", default="catalog_snapshot.json", show_default=True,
+              help="The catalog snapshot captured by the snapshot command.")
+@click.option("--ddl-dir", default=None, help="Write the current and recommended create table queries here.")
+def recommend_design(snapshot_path, ddl_dir):
+    """ Recommends the physical design from a catalog snapshot, without a connection to the cluster.
+    """
+    captured = load_snapshot(snapshot_path)
+    recommendations = recommend(captured)
+    print_recommendations(captured, recommendations)
+    if ddl_dir:
+        write_ddl(ddl_dir, recommendations)
+
+
+@cli.command()
+@click.option("--snapshot", "snapshot_path", default=None, help="Use a captured snapshot instead of a new one.")
+@click.option("--repeat", default=3, show_default=True, help="The number of timed runs of every query.")
+@click.option("--results", default="design_benchmark.json", show_default=True, help="The results json file.")
+def benchmark(snapshot_path, repeat, results):
+    """ Benchmarks the current, recommended, EVEN and ALL design variants of every table on the cluster.
+    """
+    db = Warehouse(read_config(), workload="analysis")
+    try:
+        if snapshot_path:
+            captured = load_snapshot(snapshot_path)
+        else:
+            patterns, _ = query_patterns(analyze_queries + insert_table_queries)
+            captured = capture_snapshot(db, patterns)
+        recommendations = recommend(captured)
+        print_recommendations(captured, recommendations)
+        print("--------------------- VARIANTS -----------------------")
+        measured = benchmark_variants(db, captured, recommendations, repeat)
+    finally:
+        db.close()
+    with open(results, "w") as f:
+        json.dump({"captured_at": captured["captured_at"], "results": measured}, f, indent=2)
+    print(f"The benchmark results are written to {results}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,50 +1,140 @@
-import configparser
-import psycopg2
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import click
+
+from db import Warehouse, read_config
+from exporters import FORMATS, PrintWriter, open_writer
+from instrumentation import statement_name
+from result_cache import from_config
 from sql_queries import analyze_queries
 
 
-def analyze_tables_queries(cur):
-    """Analyze the fact and dimension queries
+def query_name(index, query):
+    """ Returns the name of an analysis query, used for its output file, for example 06_select_songplays.
+
+    Args:
+    index (int): The position of the query in analyze_queries.
+    query (str): The query.
+    """
+    return f"{index:02d}_" + re.sub(r"\W+", "_", statement_name(" ".join(query.split()))).strip("_")
+
+
+def export_query(db, name, query, output_dir=None, file_format="csv", batch_size=10000, cache=None, refresh=False):
+    """ Streams the rows of a query through a server side cursor into a file, or prints them without an output
+    directory. Returns the name, path, number of rows and duration of the query.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    name (str): The name of the query.
+    query (str): The query.
+    output_dir (str): The directory of the result files, the rows are printed when it is not set.
+    file_format (str): Either csv, jsonl or parquet.
+    batch_size (int): The number of rows fetched at once.
+    cache (ResultCache): Serves the query from the result cache when its tables did not change.
+    refresh (bool): Run the query on the cluster even when its result is cached.
+    """
+    path = os.path.join(output_dir, name + FORMATS[file_format]) if output_dir else None
+    writer = open_writer(path, file_format) if path else PrintWriter(name)
+    started = perf_counter()
+    try:
+        if cache is not None:
+            rows = cache.stream(db, query, writer.write, batch_size=batch_size, refresh=refresh)
+        else:
+            rows = db.stream(query, writer.write, batch_size=batch_size)
+    finally:
+        writer.close()
+    result = {"name": name, "path": path, "rows": rows, "duration_s": round(perf_counter() - started, 3)}
+    print(f"Query {name} returned {rows} rows in {result['duration_s']:.2f}s")
+    return result
+
+
+def analyze_tables_queries(
+    db, output_dir=None, file_format="csv", concurrency=1, batch_size=10000, cache=None, refresh=False
+):
+    """Analyze the fact and dimension queries, the independent queries run at the same time on their own connections.
         Args:
-            cur (obj): [The database connection cursor to perform sql query execution]
+            db (Warehouse): [The shared connection layer to perform sql query execution]
+            output_dir (str): [The directory of the result files, the rows are printed when it is not set]
+            file_format (str): [Either csv, jsonl or parquet]
+            concurrency (int): [The number of queries running at the same time]
+            batch_size (int): [The number of rows fetched at once from the server side cursor]
+            cache (ResultCache): [Serves the queries whose tables did not change from the result cache]
+            refresh (bool): [Run the queries on the cluster even when their results are cached]
     """
     print("Starting to analyze some queries")
-    for query in analyze_queries:
-        cur.execute(query)
-        rows = cur.fetchall()
-        print(f"--------------------- SQL ----------------------------")
-        print(f"{query}")
-        for row in rows:
-            print(f"--------------------- ROW INFO -----------------------")
-            print(f"{row}")
-
-def main():
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    names = [query_name(index, query) for index, query in enumerate(analyze_queries)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(export_query, db, name, query, output_dir, file_format, batch_size, cache, refresh)
+            for name, query in zip(names, analyze_queries)
+        ]
+        results = [future.result() for future in futures]
+    print(f"--------------------- ANALYSIS -----------------------")
+    print(f"{'query':<36}{'rows':>12}{'duration':>10}  output")
+    for result in results:
+        print(f"{result['name']:<36}{result['rows']:>12}{result['duration_s']:>9.2f}s  {result['path'] or ''}")
+    if cache is not None:
+        cache.report()
+    return results
+
+
+@click.command()
+@click.option(
+    "--output-dir",
+    default=None,
+    help="Stream the result of every query into a file of this directory instead of printing the rows.",
+)
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(sorted(FORMATS)),
+    default="csv",
+    show_default=True,
+    help="The format of the result files, parquet requires pyarrow.",
+)
+@click.option(
+    "--concurrency",
+    default=1,
+    show_default=True,
+    help="The number of queries running at the same time, each on its own connection.",
+)
+@click.option(
+    "--batch-size",
+    default=10000,
+    show_default=True,
+    help="The number of rows fetched at once from the server side cursor.",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Serve the queries whose tables did not change since the last load from the local result cache.",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    default=False,
+    help="Run every query on the cluster and replace its cached result.",
+)
+def main(output_dir, file_format, concurrency, batch_size, cache, refresh):
     """The main wrapper function which first initializes the configuration and calls the analysis query function to analyse
     the fact and dimension table insertions.
     """
-    config = configparser.ConfigParser()
-    config.read("dwh.cfg")
-    HOST = config.get("CLUSTER", "HOST")
-    DB_NAME = config.get("CLUSTER", "DB_NAME")
-    DB_USER = config.get("CLUSTER", "DB_USER")
-    DB_PASSWORD = config.get("CLUSTER", "DB_PASSWORD")
-    DB_PORT = config.get("CLUSTER", "DB_PORT")
-    conn = psycopg2.connect(
-        host=HOST,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT,
-        # keepalives=1,
-        # keepalives_idle=30,
-        # keepalives_interval=10,
-        # keepalives_count=5
+    config = read_config()
+    db = Warehouse(
+        config, pool_size=max(config.getint("DB", "POOL_SIZE", fallback=4), concurrency), workload="analysis"
     )
-    cur = conn.cursor()
-
-    analyze_tables_queries(cur)
 
-    conn.close()
+    try:
+        analyze_tables_queries(
+            db, output_dir, file_format, concurrency, batch_size, from_config(config) if cache else None, refresh
+        )
+    finally:
+        db.close()
 
 
 if __name__ == "__main__":
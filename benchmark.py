@@ -0,0 +1,325 @@
+"""
+This python file provides the benchmark of the ETL:
+1. A seeded generator of Sparkify log data and song data JSON, laid out like the udacity-dend bucket and with the
+   fields of staging_events and staging_songs. The artists popularity follows a Zipf law (hot artists) and the
+   session lengths a lognormal law (long sessions).
+2. A harness which times every stage of the local engine and appends the results, tagged with the git commit,
+   as json lines so that the runs can be compared across commits.
+3. With the redshift backend the harness times create_tables.py (drop and create) and every stage of a full etl.py
+   run on the cluster of dwh.cfg instead. The COPY commands read from S3, which a local Postgres cannot run, so the
+   generated data is uploaded and LOG_DATA and SONG_DATA point at it.
+"""
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import click
+import numpy as np
+import pandas as pd
+
+import create_tables
+import etl
+import instrumentation
+import local_engine
+from db import Warehouse, read_config
+from ddl import TABLES
+from journal import RunJournal, git_commit
+from result_cache import table_versions
+
+# The tables whose rows are counted after every run, like the summary of the local engine.
+COUNTED_TABLES = ("songplays", "users", "songs", "artists", "time")
+
+# Bumped when the generated data changes, so that the data generated by an older version is not reused.
+GENERATOR_VERSION = 2
+
+PAGES = ["Home", "Logout", "Settings", "Help", "About", "Upgrade", "Downgrade", "Save Settings", "Error"]
+USER_AGENTS = [
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    "Mozilla/5.0 (Windows NT 6.3; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0",
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.77.4 (KHTML, like Gecko) Version/7.0.5 Safari/537.77.4"',
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0",
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"',
+]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "New York-Newark-Jersey City, NY-NJ-PA", "Atlanta-Sandy Springs-Roswell, GA",
+             "Chicago-Naperville-Elgin, IL-IN-WI", "Lansing-East Lansing, MI", "Portland-South Portland, ME"]
+
+
+def random_ids(rng, prefix, n):
+    """ Returns n unique ids like the ones of the million song dataset (prefix and 16 upper case characters).
+
+    Args:
+    rng (Generator): The seeded numpy random generator.
+    prefix (str): The id prefix (AR, SO or TR).
+    n (int): The number of ids.
+    """
+    alphabet = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"))
+    ids = set()
+    while len(ids) < n:
+        chars = alphabet[rng.integers(0, len(alphabet), size=(n - len(ids), 16))]
+        ids.update(prefix + "".join(row) for row in chars)
+    return sorted(ids)[:n]
+
+
+def generate_songs(rng, song_data_dir, n_songs, n_artists):
+    """ Writes one song data JSON file per song below song_data_dir/A/B/C and returns the catalog.
+
+    Args:
+    rng (Generator): The seeded numpy random generator.
+    song_data_dir (str): The output directory of the song data.
+    n_songs (int): The number of songs.
+    n_artists (int): The number of artists.
+    """
+    artist_ids = np.array(random_ids(rng, "AR", n_artists))
+    artist_of_song = np.sort(rng.integers(0, n_artists, size=n_songs))
+    has_location = rng.random(n_artists) < 0.4
+    catalog = pd.DataFrame(
+        {
+            "num_songs": 1,
+            "artist_id": artist_ids[artist_of_song],
+            "artist_latitude": np.where(has_location, rng.uniform(-60, 60, n_artists), np.nan)[artist_of_song],
+            "artist_longitude": np.where(has_location, rng.uniform(-150, 150, n_artists), np.nan)[artist_of_song],
+            "artist_location": np.where(has_location, rng.choice(LOCATIONS, n_artists), "")[artist_of_song],
+            "artist_name": np.array([f"Artist {i}" for i in range(n_artists)])[artist_of_song],
+            "song_id": random_ids(rng, "SO", n_songs),
+            "title": [f"Song {i}" for i in range(n_songs)],
+            "duration": np.round(rng.lognormal(5.4, 0.35, n_songs), 5),
+            "year": np.where(rng.random(n_songs) < 0.5, 0, rng.integers(1960, 2011, n_songs)),
+        }
+    )
+    track_ids = random_ids(rng, "TR", n_songs)
+    for record, track_id in zip(catalog.to_dict(orient="records"), track_ids):
+        directory = os.path.join(song_data_dir, track_id[2], track_id[3], track_id[4])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{track_id}.json"), "w") as f:
+            json.dump({k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in record.items()}, f)
+    catalog["artist_index"] = artist_of_song
+    return catalog
+
+
+def generate_users(rng, n_users, start, days):
+    """ Returns the users with their attributes and the day they upgrade from free to paid (or never).
+
+    Args:
+    rng (Generator): The seeded numpy random generator.
+    n_users (int): The number of users.
+    start (datetime): The first day of the log data.
+    days (int): The number of days of the log data.
+    """
+    return pd.DataFrame(
+        {
+            "userId": [str(i) for i in range(1, n_users + 1)],
+            "firstName": [f"First{i}" for i in range(1, n_users + 1)],
+            "lastName": [f"Last{i}" for i in range(1, n_users + 1)],
+            "gender": rng.choice(["F", "M"], n_users),
+            "location": rng.choice(LOCATIONS, n_users),
+            "userAgent": rng.choice(USER_AGENTS, n_users),
+            "registration": (start.timestamp() - rng.uniform(0, 90 * 86400, n_users)).round() * 1000.0,
+            "upgrade_day": np.where(rng.random(n_users) < 0.3, rng.integers(0, days, n_users), days),
+        }
+    )
+
+
+def generate_day(rng, catalog, artist_weights, users, day, day_index, n_events, miss_rate, first_session=0):
+    """ Returns the events of one day, grouped into sessions with lognormal lengths of popularity-skewed songs.
+
+    Args:
+    rng (Generator): The seeded numpy random generator.
+    catalog (DataFrame): The songs as returned by generate_songs.
+    artist_weights (ndarray): The Zipf popularity of every artist.
+    users (DataFrame): The users as returned by generate_users.
+    day (datetime): The day of the events.
+    day_index (int): The index of the day, used for the free to paid upgrades.
+    n_events (int): The number of events of the day.
+    miss_rate (float): The share of NextSong events whose song is not in the catalog.
+    first_session (int): The id of the first session, the ids are unique across the generated chunks and days.
+    """
+    lengths = []
+    while sum(lengths) < n_events:
+        lengths.extend(np.maximum(1, rng.lognormal(2.5, 1.0, 1024).astype(int)).tolist())
+    lengths = np.array(lengths)
+    lengths = lengths[: np.searchsorted(np.cumsum(lengths), n_events) + 1]
+    lengths[-1] -= lengths.sum() - n_events
+    n_sessions = len(lengths)
+
+    session_of_event = np.repeat(np.arange(n_sessions), lengths)
+    item_in_session = np.arange(n_events) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    session_user = rng.integers(0, len(users), n_sessions)
+    session_start = rng.uniform(0, 86400 * 1000, n_sessions)
+    offsets = session_start[session_of_event] + item_in_session * rng.normal(230000, 30000, n_events)
+    ts = (day.timestamp() * 1000 + np.minimum(offsets, 86400 * 1000 - 1)).astype(np.int64)
+
+    user = users.iloc[session_user[session_of_event]].reset_index(drop=True)
+    is_song = rng.random(n_events) < 0.82
+    artist_index = rng.choice(len(artist_weights), n_events, p=artist_weights)
+    artist_first = np.searchsorted(catalog["artist_index"].to_numpy(), artist_index, side="left")
+    artist_last = np.searchsorted(catalog["artist_index"].to_numpy(), artist_index, side="right")
+    has_song = artist_last > artist_first
+    song_index = artist_first + (rng.random(n_events) * np.maximum(artist_last - artist_first, 1)).astype(int)
+    song_index = np.minimum(song_index, len(catalog) - 1)
+    song = catalog.iloc[song_index].reset_index(drop=True)
+    missed = rng.random(n_events) < miss_rate
+    is_song &= has_song
+
+    events = pd.DataFrame(
+        {
+            "artist": np.where(is_song, song["artist_name"], None),
+            "auth": "Logged In",
+            "firstName": user["firstName"],
+            "gender": user["gender"],
+            "itemInSession": item_in_session,
+            "lastName": user["lastName"],
+            "length": np.where(is_song, song["duration"], np.nan),
+            "level": np.where(user["upgrade_day"] <= day_index, "paid", "free"),
+            "location": user["location"],
+            "method": np.where(is_song, "PUT", "GET"),
+            "page": np.where(is_song, "NextSong", rng.choice(PAGES, n_events)),
+            "registration": user["registration"],
+            "sessionId": first_session + session_of_event,
+            "song": np.where(is_song, np.where(missed, "Unknown " + song["title"], song["title"]), None),
+            "status": 200,
+            "ts": ts,
+            "userAgent": user["userAgent"],
+            "userId": user["userId"],
+        }
+    )
+    return events.sort_values("ts", kind="mergesort")
+
+
+def generate(data_dir, n_events, seed=42, days=30, n_songs=None, miss_rate=0.05, chunk_size=1000000):
+    """ Generates the log data and song data below data_dir, one log file per day like log-data/2018/11/.
+    The generation is skipped when data_dir already holds the data of the same parameters.
+
+    Args:
+    data_dir (str): The output directory, holding log-data and song-data.
+    n_events (int): The total number of events.
+    seed (int): The seed of the random generator.
+    days (int): The number of days of the log data, starting at 2018-11-01.
+    n_songs (int): The number of songs, by default one for every 20 events (between 1000 and 400000).
+    miss_rate (float): The share of NextSong events whose song is not in the catalog.
+    chunk_size (int): The maximum number of events generated at once.
+    """
+    n_songs = n_songs or int(min(max(n_events // 20, 1000), 400000))
+    params = {
+        "events": n_events, "seed": seed, "days": days, "songs": n_songs, "miss_rate": miss_rate,
+        "generator": GENERATOR_VERSION,
+    }
+    params_path = os.path.join(data_dir, "params.json")
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                print(f"Reusing the generated data in {data_dir}")
+                return params
+
+    rng = np.random.default_rng(seed)
+    n_artists = max(n_songs // 8, 1)
+    print(f"Generating {n_songs} songs of {n_artists} artists")
+    catalog = generate_songs(rng, os.path.join(data_dir, "song-data"), n_songs, n_artists)
+    artist_weights = 1.0 / np.arange(1, n_artists + 1) ** 1.1
+    artist_weights /= artist_weights.sum()
+
+    start = datetime(2018, 11, 1, tzinfo=timezone.utc)
+    users = generate_users(rng, max(n_events // 1000, 50), start, days)
+    per_day = np.full(days, n_events // days)
+    per_day[: n_events % days] += 1
+    print(f"Generating {n_events} events over {days} days")
+    next_session = 0
+    for day_index, day_events in enumerate(per_day):
+        day = start + timedelta(days=day_index)
+        directory = os.path.join(data_dir, "log-data", f"{day:%Y}", f"{day:%m}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{day:%Y-%m-%d}-events.json"), "w") as f:
+            for offset in range(0, day_events, chunk_size):
+                n = min(chunk_size, day_events - offset)
+                events = generate_day(rng, catalog, artist_weights, users, day, day_index, n, miss_rate, next_session)
+                next_session = int(events["sessionId"].max()) + 1
+                f.write(events.to_json(orient="records", lines=True))
+                f.write("\n")
+
+    with open(params_path, "w") as f:
+        json.dump(params, f)
+    return params
+
+
+def run_warehouse(config):
+    """ Recreates the tables and runs a full ETL on the cluster, timing create_tables and the stages of etl.py.
+    Returns the duration of every stage and the number of rows of the fact and dimension tables.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    recorder = instrumentation.setup(config)
+    db = Warehouse(config, workload="etl")
+    journal = RunJournal(config.get("ETL", "JOURNAL_FILE", fallback="etl_journal.json"))
+    try:
+        with recorder.stage("create_tables"):
+            create_tables.drop_tables(db)
+            create_tables.create_tables(db)
+        etl.run_full(db, journal, config)
+        rows = {table: db.fetchone(f"SELECT COUNT(*) FROM {table};")[0] for table in COUNTED_TABLES}
+    finally:
+        db.close()
+        recorder.close()
+    journal.reset()
+    table_versions(config).bump(TABLES)
+    return {"timings": recorder.stage_timings, "rows": rows, "matches": None}
+
+
+@click.command()
+@click.option("--events", default=10000, show_default=True, help="The number of events, from 10k up to 100M.")
+@click.option("--seed", default=42, show_default=True, help="The seed of the data generator.")
+@click.option("--days", default=30, show_default=True, help="The number of days of the log data.")
+@click.option("--songs", default=None, type=int, help="The number of songs, by default one for every 20 events.")
+@click.option("--data-dir", default="bench_data", show_default=True, help="The directory of the generated data.")
+@click.option("--repeat", default=3, show_default=True, help="The number of timed runs.")
+@click.option("--chunk-size", default=500000, show_default=True, help="The chunk size of the local engine.")
+@click.option("--results", default="bench_results.jsonl", show_default=True, help="The json lines results file.")
+@click.option(
+    "--backend",
+    type=click.Choice(["local", "redshift"]),
+    default="local",
+    show_default=True,
+    help="Time the local engine on the generated data, or create_tables.py and etl.py on the cluster of dwh.cfg.",
+)
+def main(events, seed, days, songs, data_dir, repeat, chunk_size, results, backend):
+    """ Generates the data (once per set of parameters), times every stage of the local ETL and appends one
+    json line per run to the results file. With the redshift backend the tables are recreated and loaded from
+    LOG_DATA and SONG_DATA of dwh.cfg, which should point at the uploaded data.
+    """
+    data_dir = os.path.join(data_dir, f"events-{events}-seed-{seed}")
+    params = generate(data_dir, events, seed=seed, days=days, n_songs=songs)
+    config = read_config() if backend == "redshift" else None
+    if config is not None:
+        params = {**params, "log_data": config.get("S3", "LOG_DATA"), "song_data": config.get("S3", "SONG_DATA")}
+        print(f"The generated data is below {data_dir}, upload it to the prefixes LOG_DATA and SONG_DATA point at")
+    for run in range(1, repeat + 1):
+        if config is not None:
+            summary = run_warehouse(config)
+        else:
+            summary = local_engine.run(
+                os.path.join(data_dir, "log-data"),
+                os.path.join(data_dir, "song-data"),
+                os.path.join(data_dir, "output"),
+                chunk_size,
+            )
+        result = {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "backend": backend,
+            "run": run,
+            "params": params,
+            "chunk_size": chunk_size,
+            "stages": summary["timings"],
+            "total": sum(summary["timings"].values()),
+            "rows": summary["rows"],
+            "matches": summary["matches"],
+        }
+        with open(results, "a") as f:
+            f.write(json.dumps(result) + "\n")
+        print(f"Run {run}/{repeat}: " + ", ".join(f"{k} {v:.2f}s" for k, v in summary["timings"].items()))
+    print(f"The results are appended to {results}")
+
+
+if __name__ == "__main__":
+    main()
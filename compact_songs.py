@@ -0,0 +1,241 @@
+"""
+This python file compacts the small one-record song data JSON files into a few large gzipped JSON lines or Parquet
+objects, so that the staging_songs COPY is not dominated by the per-file overhead. The files are read by several
+processes in bounded windows and the parts are split by size into a multiple of the cluster slices.
+"""
+
+import gzip
+import json
+import os
+import tempfile
+from contextlib import closing
+from itertools import islice
+from multiprocessing import Pool
+
+import boto3
+import click
+
+from db import read_config
+from local_s3 import LocalS3Client
+from manifests import cluster_slices, list_objects, parse_s3_uri
+
+# The columns in the order of staging_songs, COPY FORMAT AS PARQUET maps the columns by position.
+SONG_COLUMNS = [
+    ("artist_id", "string"),
+    ("artist_latitude", "float64"),
+    ("artist_location", "string"),
+    ("artist_longitude", "float64"),
+    ("artist_name", "string"),
+    ("duration", "float64"),
+    ("num_songs", "int32"),
+    ("song_id", "string"),
+    ("title", "string"),
+    ("year", "int32"),
+]
+
+_worker_s3 = None
+
+
+def s3_client(config, local_root=None):
+    """ Creates the s3 client using the credentials of dwh.cfg, or the local stand-in when a local root is given.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    local_root (str): The directory of the local s3 stand-in.
+    """
+    if local_root:
+        return LocalS3Client(local_root)
+    return boto3.client(
+        "s3",
+        region_name=config.get("CLUSTER", "REGION"),
+        aws_access_key_id=config.get("CLUSTER", "ACCESS_KEY"),
+        aws_secret_access_key=config.get("CLUSTER", "SECRET"),
+    )
+
+
+def _init_worker(config_path, local_root):
+    """ Creates one s3 client per reading process, the boto3 clients cannot be shared across processes.
+    """
+    global _worker_s3
+    _worker_s3 = s3_client(read_config(config_path), local_root)
+
+
+def read_records(url):
+    """ Reads the records of a song data file, a file holds one JSON record per line.
+
+    Args:
+    url (str): The s3 uri of the song data file.
+    """
+    bucket, key = parse_s3_uri(url)
+    with closing(_worker_s3.get_object(Bucket=bucket, Key=key)["Body"]) as f:
+        body = f.read()
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+class PartWriter:
+    """ Writes the records into n_parts parts of about the same source size and uploads every completed part to the
+    output prefix. A part is completed once the source bytes written so far reach its share of total_bytes, the last
+    part takes the remaining records, so exactly n_parts parts are written unless there are fewer records.
+
+    Args:
+    s3 (obj): Boto3 s3 client.
+    output_uri (str): The s3 uri prefix of the compacted parts.
+    file_format (str): Either json (gzipped JSON lines) or parquet.
+    total_bytes (int): The (uncompressed) source bytes of all the records.
+    n_parts (int): The number of parts.
+    row_group_size (int): The number of records buffered per Parquet row group.
+    """
+
+    def __init__(self, s3, output_uri, file_format, total_bytes, n_parts, row_group_size=100000):
+        self.s3 = s3
+        self.bucket, self.prefix = parse_s3_uri(output_uri)
+        self.file_format = file_format
+        self.total_bytes = total_bytes
+        self.n_parts = n_parts
+        self.row_group_size = row_group_size
+        self.parts = []
+        self._file = None
+        self._source_bytes = 0
+
+    def _open(self):
+        suffix = ".json.gz" if self.file_format == "json" else ".parquet"
+        fd, self._path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        self._rows = []
+        if self.file_format == "json":
+            self._file = gzip.open(self._path, "wt", encoding="utf-8")
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            self._schema = pa.schema([(name, pa.type_for_alias(dtype)) for name, dtype in SONG_COLUMNS])
+            self._file = pq.ParquetWriter(self._path, self._schema, compression="snappy")
+
+    def _flush_rows(self):
+        if self._rows:
+            import pyarrow as pa
+
+            columns = {name: [row.get(name) for row in self._rows] for name, _ in SONG_COLUMNS}
+            self._file.write_table(pa.Table.from_pydict(columns, schema=self._schema))
+            self._rows = []
+
+    def write(self, record, n_bytes):
+        """ Writes a record and completes the part once the source bytes written reach the end of its share.
+
+        Args:
+        record (dict): The song record.
+        n_bytes (int): The source bytes the record accounts for.
+        """
+        if self._file is None:
+            self._open()
+        if self.file_format == "json":
+            self._file.write(json.dumps(record) + "\n")
+        else:
+            self._rows.append(record)
+            if len(self._rows) >= self.row_group_size:
+                self._flush_rows()
+        self._source_bytes += n_bytes
+        part_end = -(-self.total_bytes * (len(self.parts) + 1) // self.n_parts)
+        if len(self.parts) < self.n_parts - 1 and self._source_bytes >= part_end:
+            self.close_part()
+
+    def close_part(self):
+        """ Closes the current part and uploads it.
+        """
+        if self._file is None:
+            return
+        if self.file_format == "parquet":
+            self._flush_rows()
+        self._file.close()
+        self._file = None
+        suffix = ".json.gz" if self.file_format == "json" else ".parquet"
+        key = f"{self.prefix.rstrip('/')}/part-{len(self.parts):05d}{suffix}"
+        self.s3.upload_file(self._path, self.bucket, key)
+        os.remove(self._path)
+        self.parts.append(f"s3://{self.bucket}/{key}")
+        print(f"Compacted part is uploaded -- s3://{self.bucket}/{key}")
+
+
+def part_count(total_bytes, slices, max_part_bytes):
+    """ Returns the number of parts: the smallest multiple of the slices for which no part exceeds max_part_bytes.
+
+    Args:
+    total_bytes (int): The total size of the source files.
+    slices (int): The total number of slices of the cluster.
+    max_part_bytes (int): The maximum source bytes per part.
+    """
+    return slices * max(1, -(-total_bytes // (slices * max_part_bytes)))
+
+
+def compact(s3, objects, output_uri, file_format, slices, max_part_bytes, processes, config_path, local_root=None):
+    """ Streams the source files through a pool of reading processes into the compacted parts.
+    At most processes * 64 files are in flight at any time, which bounds the memory used.
+
+    Args:
+    s3 (obj): Boto3 s3 client used to upload the parts.
+    objects (list): The source objects as returned by list_objects.
+    output_uri (str): The s3 uri prefix of the compacted parts.
+    file_format (str): Either json (gzipped JSON lines) or parquet.
+    slices (int): The total number of slices of the cluster.
+    max_part_bytes (int): The maximum source bytes per part.
+    processes (int): The number of reading processes.
+    config_path (str): The path of dwh.cfg, read by every process to create its s3 client.
+    local_root (str): The directory of the local s3 stand-in.
+    """
+    total_bytes = sum(obj["size"] for obj in objects)
+    writer = PartWriter(s3, output_uri, file_format, total_bytes, part_count(total_bytes, slices, max_part_bytes))
+    window = processes * 64
+    with Pool(processes, initializer=_init_worker, initargs=(config_path, local_root)) as pool:
+        it = iter(objects)
+        while True:
+            batch = list(islice(it, window))
+            if not batch:
+                break
+            urls = [obj["url"] for obj in batch]
+            for obj, records in zip(batch, pool.imap(read_records, urls, chunksize=16)):
+                # The size of the file is spread over its records without a remainder, so the parts add up.
+                share, rest = divmod(obj["size"], max(1, len(records)))
+                for index, record in enumerate(records):
+                    writer.write(record, share + (index < rest))
+    writer.close_part()
+    return writer.parts
+
+
+@click.command()
+@click.option("--output", default=None, help="The s3 uri prefix of the parts, by default SONG_DATA_COMPACTED of dwh.cfg.")
+@click.option(
+    "--format", "file_format", type=click.Choice(["json", "parquet"]), default=None,
+    help="The format of the parts, by default SONG_DATA_COMPACTED_FORMAT of dwh.cfg.",
+)
+@click.option("--processes", default=os.cpu_count(), show_default=True, help="The number of reading processes.")
+@click.option("--max-part-mb", default=256, show_default=True, help="The maximum source megabytes per part.")
+@click.option("--local-root", default=None, help="Use the local s3 stand-in below this directory instead of AWS.")
+def main(output, file_format, processes, max_part_mb, local_root):
+    """ Compacts the song data of dwh.cfg into the compacted prefix. The prefix should be empty since
+    staging_songs loads every object below it.
+    """
+    config_path = "dwh.cfg"
+    config = read_config(config_path)
+    output = output or config.get("S3", "SONG_DATA_COMPACTED", fallback="").strip("'\"")
+    if not output:
+        raise click.UsageError("Either --output or SONG_DATA_COMPACTED in dwh.cfg must be set")
+    file_format = file_format or config.get("S3", "SONG_DATA_COMPACTED_FORMAT", fallback="json")
+    if file_format == "parquet":
+        # Checked before the listing, so that the compaction does not fail after its first part.
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise click.UsageError("The parquet format requires pyarrow, install it with pip install pyarrow")
+    slices = cluster_slices(config.get("CLUSTER", "DWH_NODE_TYPE"), config.get("CLUSTER", "DWH_NUM_NODES"))
+
+    s3 = s3_client(config, local_root)
+    objects = list(list_objects(s3, config.get("S3", "SONG_DATA")))
+    print(f"Compacting {len(objects)} song data files for {slices} slices")
+    parts = compact(
+        s3, objects, output, file_format, slices, max_part_mb * 1024 * 1024, processes, config_path, local_root
+    )
+    print(f"Compaction is completed -- {len(parts)} parts below {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,42 @@
-import configparser
-import psycopg2
+from ddl import TABLES
+from db import Warehouse, read_config
+from result_cache import table_versions
 from sql_queries import create_table_queries, drop_table_queries
 
 
-def drop_tables(cur, conn):
+def drop_tables(db):
     """ Drops the tables if they exist.
     
     Args:
-    cur (obj): Database cursor obtained from the connection object.
-    conn (obj): Database Connection object obtained.
+    db (Warehouse): The shared connection layer.
     """
     for query in drop_table_queries:
         print(f"Query --> {query}")
-        cur.execute(query)
-        conn.commit()
+        db.run(query)
 
 
-def create_tables(cur, conn):
+def create_tables(db):
     """ Creates the table if not exists based on the queries provided in the sql_queries.
     
     Args:
-    cur (obj): Database cursor obtained from the connection object.
-    conn (obj): Database Connection object obtained.
+    db (Warehouse): The shared connection layer.
     """
     for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+        db.run(query)
         print(f"Table Created --> {query.split(' ')[5]}")
 
 
 def main():
     """ Acts as a wrapper which connects to the redshift cluster, then drops the tables and recreates them.
     """
-    config = configparser.ConfigParser()
-    config.read("dwh.cfg")
-
-    conn = psycopg2.connect(
-        "host={} dbname={} user={} password={} port={}".format(
-            *config["CLUSTER"].values()
-        )
-    )
-    cur = conn.cursor()
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-
-    conn.close()
+    config = read_config()
+    db = Warehouse(config, workload="etl")
+    try:
+        drop_tables(db)
+        create_tables(db)
+    finally:
+        db.close()
+    table_versions(config).bump(TABLES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+"""
+This python file provides the shared connection layer of the entry points (etl.py, create_tables.py,
+analyse_insertion.py):
+1. Reading dwh.cfg in a single place.
+2. A thread safe pool of connections with TCP keepalives and a statement timeout.
+3. Running every step in its own transaction with retry and exponential backoff on transient errors,
+   so a dropped connection only restarts the failed step and not the whole job. The steps which are not idempotent
+   (the songplays inserts and the COPY commands) are not replayed once they may have been committed.
+4. Streaming the rows of a query through a server side cursor in batches, with bounded client memory.
+5. Tagging the sessions with the WLM query group of the entry point (etl or analysis), suffixed with the stage of
+   the recorder (etl-insert_tables), so that the workloads run in their own WLM queues and STL_QUERY labels every
+   statement with its stage.
+"""
+
+import configparser
+from time import sleep
+from uuid import uuid4
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+import instrumentation
+
+# Errors after which the step is retried on a new connection, a statement timeout is not retried.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+NON_TRANSIENT_ERRORS = (psycopg2.extensions.QueryCanceledError,)
+
+
+def read_config(path="dwh.cfg"):
+    """ Reads the configuration of the project.
+
+    Args:
+    path (str): The path of the configuration file.
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def connection_params(config):
+    """ Returns the psycopg2 connection parameters of the cluster, with the TCP keepalives of the DB section.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    return dict(
+        host=config.get("CLUSTER", "HOST"),
+        dbname=config.get("CLUSTER", "DB_NAME"),
+        user=config.get("CLUSTER", "DB_USER"),
+        password=config.get("CLUSTER", "DB_PASSWORD"),
+        port=config.get("CLUSTER", "DB_PORT"),
+        connect_timeout=config.getint("DB", "CONNECT_TIMEOUT", fallback=10),
+        keepalives=1,
+        keepalives_idle=config.getint("DB", "KEEPALIVES_IDLE", fallback=30),
+        keepalives_interval=config.getint("DB", "KEEPALIVES_INTERVAL", fallback=10),
+        keepalives_count=config.getint("DB", "KEEPALIVES_COUNT", fallback=5),
+        cursor_factory=instrumentation.InstrumentedCursor,
+    )
+
+
+def query_group(config, workload):
+    """ Returns the WLM query group of a workload from the WLM section of dwh.cfg, empty when it is not set.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    workload (str): Either etl or analysis.
+    """
+    return config.get("WLM", f"{workload.upper()}_QUERY_GROUP", fallback="") if workload else ""
+
+
+class ConnectionPool(ThreadedConnectionPool):
+    """ Thread safe connection pool setting the statement timeout and the query group on every new connection.
+
+    Args:
+    minconn (int): The number of connections opened upfront.
+    maxconn (int): The maximum number of connections.
+    statement_timeout (int): The statement timeout in milliseconds, 0 disables it.
+    query_group (str): The WLM query group of the sessions, not set when empty.
+    kwargs (dict): The psycopg2 connection parameters.
+    """
+
+    def __init__(self, minconn, maxconn, statement_timeout=0, query_group="", **kwargs):
+        self.statement_timeout = statement_timeout
+        self.query_group = query_group
+        self.labels = {}
+        super().__init__(minconn, maxconn, **kwargs)
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        with psycopg2.extensions.cursor(conn) as cur:
+            cur.execute("SET statement_timeout TO %s", (self.statement_timeout,))
+            if self.query_group:
+                cur.execute("SET query_group TO %s", (self.query_group,))
+        conn.commit()
+        # A new connection reusing the id of a closed one starts over with the query group of the pool.
+        self.labels[id(conn)] = self.query_group
+        return conn
+
+    def label(self, conn):
+        """ Sets the query group of a connection to the query group of the pool suffixed with the current stage of
+        the recorder, unless the connection is already labelled with it. Must be called outside of a transaction.
+
+        Args:
+        conn (connection): A connection of the pool.
+        """
+        if not self.query_group:
+            return
+        stage = instrumentation.recorder.current_stage
+        label = f"{self.query_group}-{stage}" if stage else self.query_group
+        if self.labels.get(id(conn)) == label:
+            return
+        with psycopg2.extensions.cursor(conn) as cur:
+            cur.execute("SET query_group TO %s", (label,))
+        conn.commit()
+        self.labels[id(conn)] = label
+
+
+class Warehouse:
+    """ Runs the queries of the entry points over a pool of connections, each step in its own transaction
+    and retried with exponential backoff on transient errors.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    pool_size (int): The maximum number of connections, by default POOL_SIZE of the DB section.
+    workload (str): Either etl or analysis, the sessions are tagged with the query group of its WLM queue.
+    """
+
+    def __init__(self, config, pool_size=None, workload=None):
+        self.retries = config.getint("DB", "RETRIES", fallback=3)
+        self.backoff = config.getfloat("DB", "RETRY_BACKOFF", fallback=2.0)
+        self.pool = ConnectionPool(
+            0,
+            pool_size or config.getint("DB", "POOL_SIZE", fallback=4),
+            statement_timeout=config.getint("DB", "STATEMENT_TIMEOUT_MS", fallback=0),
+            query_group=query_group(config, workload),
+            **connection_params(config),
+        )
+
+    def _transaction(self, work, autocommit=False, retryable=None):
+        """ Runs work(cursor) in its own transaction and commits it. On a transient error the connection is
+        discarded and the work is retried on a new one.
+
+        Args:
+        work (callable): Called with a cursor of the connection, its result is returned.
+        autocommit (bool): Runs the work outside of a transaction block.
+        retryable (callable): Returns whether the work can still be retried, by default always.
+        """
+        for attempt in range(self.retries + 1):
+            conn = None
+            try:
+                conn = self.pool.getconn()
+                self.pool.label(conn)
+                conn.autocommit = autocommit
+                result = work(conn)
+                conn.commit()
+                conn.autocommit = False
+                self.pool.putconn(conn)
+                return result
+            except TRANSIENT_ERRORS as exc:
+                if conn is not None:
+                    self.pool.putconn(conn, close=True)
+                if (
+                    isinstance(exc, NON_TRANSIENT_ERRORS)
+                    or attempt == self.retries
+                    or (retryable is not None and not retryable())
+                ):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                reason = str(exc).strip().splitlines()[0] if str(exc).strip() else ""
+                print(f"Transient error ({exc.__class__.__name__}: {reason}), retrying in {delay:g}s")
+                sleep(delay)
+            except Exception:
+                if conn is not None:
+                    conn.rollback()
+                    conn.autocommit = False
+                    self.pool.putconn(conn)
+                raise
+
+    def run(self, query, params=None, fetch=False, autocommit=False, statement_timeout=None, idempotent=True):
+        """ Runs a query in its own transaction and commits it. On a transient error the connection is
+        discarded and the query is retried on a new one, so every step must be safe to rerun after a rollback.
+        A query which is not idempotent is only retried until it may have been committed: the connection can drop
+        during the COMMIT (or an autocommitted execute) after the server applied it, and a replay would then
+        apply it twice.
+
+        Args:
+        query (str): The query to be executed.
+        params (dict): The query parameters.
+        fetch (bool): Returns the rows of the query.
+        autocommit (bool): Runs the query outside of a transaction block, as required by VACUUM for example.
+        statement_timeout (int): Overrides the statement timeout of the pool for this query, in milliseconds.
+        idempotent (bool): The query can be replayed after it was committed, for example an upsert.
+        """
+        committing = []
+
+        def work(conn):
+            with conn.cursor() as cur:
+                if statement_timeout is not None:
+                    cur.execute("SET statement_timeout TO %s", (statement_timeout,))
+                if conn.autocommit:
+                    committing.append(True)
+                try:
+                    cur.execute(query, params)
+                    rows = cur.fetchall() if fetch else None
+                except Exception:
+                    # Within a transaction block the rollback also reverts the timeout.
+                    if statement_timeout is not None and conn.autocommit and not conn.closed:
+                        cur.execute("SET statement_timeout TO %s", (self.pool.statement_timeout,))
+                    raise
+                if statement_timeout is not None:
+                    cur.execute("SET statement_timeout TO %s", (self.pool.statement_timeout,))
+            committing.append(True)
+            return rows
+
+        return self._transaction(work, autocommit, retryable=None if idempotent else lambda: not committing)
+
+    def stream(self, query, write, params=None, batch_size=10000):
+        """ Runs a query through a named (server side) cursor and hands its rows to write in batches of
+        batch_size, so that only a single batch is held in the client memory. Returns the number of rows.
+        The query is only retried on a transient error until the first batch is written.
+
+        Args:
+        query (str): The query to be executed.
+        write (callable): Called with the cursor description and every batch of rows, once with an empty
+        batch for an empty result.
+        params (dict): The query parameters.
+        batch_size (int): The number of rows fetched at once.
+        """
+        written = []
+
+        def work(conn):
+            with conn.cursor(name=f"stream_{uuid4().hex}") as cur:
+                cur.itersize = batch_size
+                cur.execute(query, params)
+                n_rows = 0
+                rows = cur.fetchmany(batch_size)
+                while True:
+                    write(cur.description, rows)
+                    written.append(len(rows))
+                    n_rows += len(rows)
+                    if len(rows) < batch_size:
+                        return n_rows
+                    rows = cur.fetchmany(batch_size)
+
+        return self._transaction(work, retryable=lambda: not written)
+
+    def fetchone(self, query, params=None):
+        """ Runs a query and returns its first row.
+
+        Args:
+        query (str): The query to be executed.
+        params (dict): The query parameters.
+        """
+        rows = self.run(query, params, fetch=True)
+        return rows[0] if rows else None
+
+    def close(self):
+        """ Closes all the connections of the pool.
+        """
+        self.pool.closeall()
@@ -0,0 +1,340 @@
+"""
+This python file describes the tables of the warehouse (columns and physical design) and generates their
+CREATE TABLE queries, so that sql_queries.py and the physical design advisor (advisor.py) share one definition:
+1. The columns of every table with their type, constraints and compression encoding.
+2. The physical design: DISTSTYLE (AUTO, EVEN, ALL or KEY with a DISTKEY) and a COMPOUND or INTERLEAVED SORTKEY.
+3. The data profile captured by profiling.py, which sizes the text columns and overrides the encodings.
+"""
+
+import json
+import math
+import os
+import re
+from dataclasses import dataclass, field, replace
+
+
+@dataclass
+class Column:
+    """ A column of a table.
+    """
+    name: str
+    type: str
+    constraints: str = ""
+    encode: str = None
+
+
+@dataclass
+class Design:
+    """ The physical design of a table, the diststyle AUTO leaves the choice to Redshift.
+    """
+    diststyle: str = "AUTO"
+    distkey: str = None
+    sortkey: tuple = ()
+    sortstyle: str = "COMPOUND"
+
+    def describe(self):
+        """ Returns a short description of the design, for example KEY(artist_id) COMPOUND(start_time).
+        """
+        dist = f"KEY({self.distkey})" if self.diststyle == "KEY" else self.diststyle
+        sort = f" {self.sortstyle}({', '.join(self.sortkey)})" if self.sortkey else ""
+        return dist + sort
+
+
+@dataclass
+class Table:
+    """ A table of the warehouse with its columns and physical design.
+    """
+    name: str
+    columns: list
+    design: Design = field(default_factory=Design)
+
+    def column(self, name):
+        return next(column for column in self.columns if column.name == name)
+
+
+def column_definition(column, design):
+    """ Returns the definition of a column in the order of the Redshift grammar: the type, the IDENTITY attribute,
+    the ENCODE attribute and then the constraints.
+
+    Args:
+    column (Column): The column.
+    design (Design): The physical design of the table.
+    """
+    identity, constraints = re.match(r"(IDENTITY\(\d+,\s*\d+\))?\s*(.*)", column.constraints).groups()
+    parts = [column.name, column.type]
+    if identity:
+        parts.append(identity)
+    parts.append(f"ENCODE {column.encode or column_encoding(column, design)}")
+    if constraints:
+        parts.append(constraints)
+    return "    " + " ".join(parts)
+
+
+def create_table_query(table, design=None, name=None):
+    """ Returns the CREATE TABLE query of a table.
+
+    Args:
+    table (Table): The table.
+    design (Design): The physical design, by default the design of the table.
+    name (str): The name of the created table, by default the name of the table (used for the design variants).
+    """
+    design = design or table.design
+    columns = ",\n".join(column_definition(column, design) for column in table.columns)
+    attributes = []
+    if design.diststyle != "AUTO":
+        attributes.append(f"DISTSTYLE {design.diststyle}")
+    if design.diststyle == "KEY":
+        attributes.append(f"DISTKEY({design.distkey})")
+    if design.sortkey:
+        attributes.append(f"{design.sortstyle} SORTKEY({', '.join(design.sortkey)})")
+    suffix = "\n" + "\n".join(attributes) if attributes else ""
+    return f"\nCREATE TABLE IF NOT EXISTS {name or table.name} (\n{columns}\n){suffix};\n"
+
+
+def column_encoding(column, design):
+    """ Returns the recommended compression encoding of a column: RAW for the leading sort key column, so that the
+    range restricted scans read as few blocks as possible, AZ64 for the integer, decimal and time types
+    and ZSTD for the text and floating point types (AZ64 does not support REAL/DOUBLE PRECISION).
+
+    Args:
+    column (Column): The column.
+    design (Design): The physical design of the table.
+    """
+    if design.sortkey and design.sortkey[0] == column.name:
+        return "RAW"
+    base_type = column.type.split("(")[0].upper()
+    if base_type in ("SMALLINT", "INT", "INT2", "INT4", "INT8", "INTEGER", "BIGINT", "DECIMAL", "NUMERIC",
+                     "DATE", "TIMESTAMP", "TIMESTAMPTZ"):
+        return "AZ64"
+    return "ZSTD"
+
+
+def varchar_size(max_length):
+    """ Returns the VARCHAR size of a text column from the longest value (in bytes) seen in the data profile,
+    with a quarter of headroom rounded up to the next power of two and capped at the VARCHAR maximum.
+
+    Args:
+    max_length (int): The longest value in bytes.
+    """
+    return min(65535, max(16, 2 ** math.ceil(math.log2(max(max_length, 1) * 1.25))))
+
+
+def load_profile(path):
+    """ Loads the data profile captured by profiling.py, an empty profile is returned when there is none.
+
+    Args:
+    path (str): The path of the profile json file.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_profile(table, profile):
+    """ Returns the table with its unbounded text columns (TEXT is a VARCHAR(256) in Redshift) sized and its
+    encodings set as per the data profile. The columns missing from the profile are left as they are.
+
+    Args:
+    table (Table): The table.
+    profile (dict): The data profile as returned by load_profile.
+    """
+    columns_profile = profile.get("tables", {}).get(table.name, {}).get("columns", {})
+    columns = []
+    for column in table.columns:
+        column_profile = columns_profile.get(column.name, {})
+        changes = {}
+        if column.type.upper() in ("TEXT", "VARCHAR") and column_profile.get("max_length") is not None:
+            changes["type"] = f"VARCHAR({varchar_size(column_profile['max_length'])})"
+        if column_profile.get("encoding"):
+            changes["encode"] = column_profile["encoding"].upper()
+        columns.append(replace(column, **changes))
+    return Table(table.name, columns, table.design)
+
+
+def with_design(table, **changes):
+    """ Returns a copy of the design of a table with some attributes changed.
+
+    Args:
+    table (Table): The table.
+    changes (dict): The changed attributes of the design, for example diststyle="ALL".
+    """
+    return replace(table.design, **changes)
+
+
+TABLES = {
+    "staging_events": Table(
+        "staging_events",
+        [
+            Column("artist", "TEXT"),
+            Column("auth", "TEXT"),
+            Column("first_name", "TEXT"),
+            Column("gender", "TEXT"),
+            Column("item_in_session", "INT"),
+            Column("last_name", "TEXT"),
+            Column("length", "FLOAT"),
+            Column("level", "TEXT"),
+            Column("location", "TEXT"),
+            Column("method", "TEXT"),
+            Column("page", "TEXT"),
+            Column("registration", "DOUBLE PRECISION"),
+            Column("session_id", "INT"),
+            Column("song", "TEXT"),
+            Column("status", "INT"),
+            Column("ts", "BIGINT"),
+            Column("user_agent", "TEXT"),
+            Column("user_id", "INT"),
+            Column("start_time", "TIMESTAMP"),
+            Column("match_key", "CHAR(32)"),
+        ],
+        # Distributed on the join key of songs so that the songplays join is co-located. COPY fills neither start_time
+        # nor match_key, the enrichment update then writes every row again, and the new rows are distributed on their
+        # key. The update would leave a sort key unsorted, so the table has none.
+        Design("KEY", "match_key"),
+    ),
+    "staging_songs": Table(
+        "staging_songs",
+        [
+            Column("artist_id", "TEXT"),
+            Column("artist_latitude", "FLOAT"),
+            Column("artist_location", "TEXT"),
+            Column("artist_longitude", "FLOAT"),
+            Column("artist_name", "TEXT"),
+            Column("duration", "FLOAT"),
+            Column("num_songs", "INT"),
+            Column("song_id", "TEXT"),
+            Column("title", "TEXT"),
+            Column("year", "INT"),
+        ],
+        Design("EVEN"),
+    ),
+    "songplays": Table(
+        "songplays",
+        [
+            Column("songplay_id", "INT", "IDENTITY(0,1) PRIMARY KEY"),
+            Column("start_time", "TIMESTAMP", "NOT NULL"),
+            Column("user_id", "INT", "NOT NULL REFERENCES users(user_id)"),
+            Column("level", "TEXT"),
+            Column("song_id", "TEXT", "NOT NULL REFERENCES songs(song_id)"),
+            Column("artist_id", "TEXT", "NOT NULL REFERENCES artists(artist_id)"),
+            Column("session_id", "INT", "NOT NULL"),
+            Column("location", "TEXT"),
+            Column("user_agent", "TEXT"),
+        ],
+        Design("KEY", "start_time", ("start_time",)),
+    ),
+    "users": Table(
+        "users",
+        [
+            Column("user_id", "INT", "NOT NULL PRIMARY KEY"),
+            Column("first_name", "TEXT"),
+            Column("last_name", "TEXT"),
+            Column("gender", "TEXT"),
+            Column("level", "TEXT"),
+        ],
+    ),
+    "songs": Table(
+        "songs",
+        [
+            Column("song_id", "TEXT", "NOT NULL PRIMARY KEY"),
+            Column("title", "TEXT"),
+            Column("artist_id", "TEXT", "NOT NULL REFERENCES artists(artist_id)"),
+            Column("year", "INT"),
+            Column("duration", "FLOAT"),
+            Column("match_key", "CHAR(32)"),
+        ],
+        Design("KEY", "match_key"),
+    ),
+    "artists": Table(
+        "artists",
+        [
+            Column("artist_id", "TEXT", "NOT NULL PRIMARY KEY"),
+            Column("name", "TEXT"),
+            Column("location", "TEXT"),
+            Column("latitude", "FLOAT"),
+            Column("longitude", "FLOAT"),
+        ],
+    ),
+    "time": Table(
+        "time",
+        [
+            Column("start_time", "TIMESTAMP", "NOT NULL PRIMARY KEY"),
+            Column("hour", "INT"),
+            Column("day", "INT"),
+            Column("week", "INT"),
+            Column("month", "INT"),
+            Column("year", "INT"),
+            Column("weekday", "INT"),
+        ],
+        Design("KEY", "start_time", ("start_time",)),
+    ),
+    # The user agents parsed into their OS and browser once at load time, small enough to be copied to every node.
+    "user_agents": Table(
+        "user_agents",
+        [
+            Column("user_agent", "TEXT", "NOT NULL PRIMARY KEY"),
+            Column("os", "VARCHAR(32)"),
+            Column("browser", "VARCHAR(32)"),
+        ],
+        Design("ALL"),
+    ),
+    # The rows rejected by the COPY commands, copied from STL_LOAD_ERRORS (which only keeps a few days of history).
+    "load_errors": Table(
+        "load_errors",
+        [
+            Column("loaded_at", "TIMESTAMP", "NOT NULL"),
+            Column("query_id", "INT"),
+            Column("table_name", "VARCHAR(128)"),
+            Column("filename", "VARCHAR(256)"),
+            Column("line_number", "BIGINT"),
+            Column("colname", "VARCHAR(128)"),
+            Column("err_code", "INT"),
+            Column("err_reason", "VARCHAR(100)"),
+            Column("raw_line", "VARCHAR(1024)"),
+            Column("raw_field_value", "VARCHAR(1024)"),
+        ],
+        Design("AUTO", None, ("loaded_at",)),
+    ),
+    # The daily rollups of songplays refreshed by the ETL, the analysis queries read them instead of the fact table.
+    "daily_platform_plays": Table(
+        "daily_platform_plays",
+        [
+            Column("day", "DATE", "NOT NULL"),
+            Column("os", "VARCHAR(32)", "NOT NULL"),
+            Column("browser", "VARCHAR(32)", "NOT NULL"),
+            Column("plays", "BIGINT", "NOT NULL"),
+            Column("users", "BIGINT", "NOT NULL"),
+        ],
+        Design("AUTO", None, ("day",)),
+    ),
+    "daily_level_plays": Table(
+        "daily_level_plays",
+        [
+            Column("day", "DATE", "NOT NULL"),
+            Column("level", "TEXT"),
+            Column("plays", "BIGINT", "NOT NULL"),
+            Column("users", "BIGINT", "NOT NULL"),
+        ],
+        Design("AUTO", None, ("day",)),
+    ),
+    "daily_user_plays": Table(
+        "daily_user_plays",
+        [
+            Column("day", "DATE", "NOT NULL"),
+            Column("user_id", "INT", "NOT NULL"),
+            Column("plays", "BIGINT", "NOT NULL"),
+            Column("sessions", "BIGINT", "NOT NULL"),
+        ],
+        Design("AUTO", None, ("day",)),
+    ),
+    "daily_artist_plays": Table(
+        "daily_artist_plays",
+        [
+            Column("day", "DATE", "NOT NULL"),
+            Column("artist_id", "TEXT", "NOT NULL"),
+            Column("plays", "BIGINT", "NOT NULL"),
+            Column("users", "BIGINT", "NOT NULL"),
+        ],
+        Design("AUTO", None, ("day",)),
+    ),
+}
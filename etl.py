@@ -1,65 +1,621 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, time, timedelta, timezone
+from time import perf_counter
+import boto3
+import click
+import instrumentation
+import lake
+import maintenance
+import wlm
+import local_engine
+from ddl import TABLES
+from db import Warehouse, query_group, read_config
+from journal import RunJournal, fingerprint, listing_fingerprint
+from manifests import cluster_slices, list_log_days, list_objects, write_batch_manifests
+from profiling import print_profile, profile_tables, save_profile
+from quality import load_error_report, run_checks
+from result_cache import table_versions
+from sql_queries import (
+    backfill_copy_query,
+    backfill_enrich_query,
+    backfill_replace_query,
+    backfill_stage_create,
+    backfill_stage_drop,
+    copy_table_queries,
+    enrich_table_queries,
+    songplay_match_report,
+    insert_table_queries,
+    insert_table_dependencies,
+    incremental_insert_table_queries,
+    non_idempotent_inserts,
+    staging_events_manifest_copy,
+    staging_songs_manifest_copy,
+    staging_songs_compacted_manifest_copy,
+    staging_events_truncate,
+    staging_songs_truncate,
+    staging_events_max_ts,
+    staging_quality_checks,
+    table_quality_checks,
+)
+from scheduler import report, run_dag, target_table
+from watermark import WatermarkStore
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(db, journal):
     """ Loads the data into the staging through the COPY command to copy the data from S3 storage and insert for each of the copy table queries list.
-    
+    The bare prefixes are not listed, so the COPY steps are fingerprinted by their query only.
+    Returns the fingerprint of the staged data.
+
     Args:
-    cur (obj): Database cursor obtained from the connection object.
-    conn (obj): Database Connection object obtained.
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
     """
     print("Starting to load the data")
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
-        print("Data loading is completed for query -- ", query)
+    fingerprints = []
+    # The staging tables are emptied first so that loading them again after a failure does not duplicate rows.
+    for truncate_query, query in zip([staging_events_truncate, staging_songs_truncate], copy_table_queries):
+        step_fingerprint = fingerprint(truncate_query, query)
+        fingerprints.append(step_fingerprint)
+        if journal.run(
+            db, instrumentation.statement_name(query), step_fingerprint, [truncate_query, query], idempotent=False
+        ):
+            print("Data loading is completed for query -- ", query)
+    return fingerprint(fingerprints)
+
+
+def enrich_staging_tables(db, journal, staging_fingerprint):
+    """ Fills the normalized match key of the staging tables, which the songplays insert joins on.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    staging_fingerprint (str): The fingerprint of the staged data.
+    """
+    print("Starting to enrich the staging tables")
+    for query in enrich_table_queries:
+        step = instrumentation.statement_name(query)
+        if journal.run(db, step, fingerprint(query, staging_fingerprint), [query]):
+            print(f"Data enrichment is completed for {step.split()[-1]}")
+
+
+def match_report(db):
+    """ Prints how many NextSong events are matched to a song by the exact artist, title and length join
+    and by the normalized match key.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    """
+    events, exact, keyed = db.fetchone(songplay_match_report)
+    print("--------------------- SONGPLAY MATCHES ---------------")
+    print(f"NextSong events          {events:>10}")
+    print(f"Exact join matches       {exact:>10}")
+    print(f"Match key matches        {keyed:>10} ({keyed - exact:+d})")
+
 
+def quality_gate(db, config, stage, checks):
+    """ Runs the data-quality checks of a stage unless CHECKS is disabled in the QUALITY section of dwh.cfg.
 
-def insert_tables(cur, conn):
+    Args:
+    db (Warehouse): The shared connection layer.
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    stage (str): The name of the checked stage.
+    checks (dict): The table name mapped to the FROM clause and the checks of the table.
+    """
+    if config.getboolean("QUALITY", "CHECKS", fallback=True):
+        with instrumentation.recorder.stage(f"quality_{stage}"):
+            run_checks(db, stage, checks)
+
+
+def insert_step_fingerprint(query, params, staging_fingerprint):
+    """ Returns the fingerprint of an insert step, which changes with the query, its parameters and the staged data.
+
+    Args:
+    query (str): The insert query.
+    params (dict): The query parameters.
+    staging_fingerprint (str): The fingerprint of the staged data.
+    """
+    return fingerprint(query, params, staging_fingerprint)
+
+
+def insert_tables(db, journal, staging_fingerprint, queries=insert_table_queries, params=None):
     """ Inserts the data into the fact and dimension tables by utilizing the staging tables.
-    
+
     Args:
-    cur (obj): Database cursor obtained from the connection object.
-    conn (obj): Database Connection object obtained.
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    staging_fingerprint (str): The fingerprint of the staged data.
+    queries (list): The insert queries to be executed, by default the full insert table queries.
+    params (dict): The query parameters, for example the last_ts watermark for the incremental inserts.
     """
     print("Starting to insert the data")
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
-        print("Data insertion is completed for the query -- ", query.split(" ")[2])
+    for query in queries:
+        step_fingerprint = insert_step_fingerprint(query, params, staging_fingerprint)
+        idempotent = target_table(query) not in non_idempotent_inserts
+        if journal.run(db, f"insert {target_table(query)}", step_fingerprint, [query], params, idempotent):
+            print("Data insertion is completed for the query -- ", target_table(query))
+
+
+def insert_tables_parallel(db, journal, staging_fingerprint, concurrency, queries=insert_table_queries, params=None):
+    """ Inserts the data into the fact and dimension tables running the independent inserts at the same time,
+    each on its own connection. The fact table is only inserted once the dimensions it references are completed.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    staging_fingerprint (str): The fingerprint of the staged data.
+    concurrency (int): The maximum number of inserts running at the same time.
+    queries (list): The insert queries to be executed, by default the full insert table queries.
+    params (dict): The query parameters, for example the last_ts watermark for the incremental inserts.
+    """
+    print(f"Starting to insert the data with a concurrency of {concurrency}")
+    fingerprints = {
+        target_table(query): insert_step_fingerprint(query, params, staging_fingerprint) for query in queries
+    }
+    # The completed steps are left out, the steps depending on them are then scheduled right away.
+    steps = {
+        target_table(query): query
+        for query in queries
+        if not journal.skip(f"insert {target_table(query)}", fingerprints[target_table(query)])
+    }
+
+    def on_done(name, timing):
+        journal.mark_done(f"insert {name}", fingerprints[name], timing[1] - timing[0])
+
+    timings = run_dag(db, steps, insert_table_dependencies, concurrency, params, on_done, non_idempotent_inserts)
+    report(timings, insert_table_dependencies)
+
+
+def run_inserts(db, journal, staging_fingerprint, concurrency, queries=insert_table_queries, params=None):
+    """ Runs the inserts one at a time, or in parallel when a concurrency above one is set.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    staging_fingerprint (str): The fingerprint of the staged data.
+    concurrency (int): The maximum number of inserts running at the same time.
+    queries (list): The insert queries to be executed, by default the full insert table queries.
+    params (dict): The query parameters, for example the last_ts watermark for the incremental inserts.
+    """
+    if concurrency > 1:
+        insert_tables_parallel(db, journal, staging_fingerprint, concurrency, queries, params)
+    else:
+        insert_tables(db, journal, staging_fingerprint, queries, params)
+
+
+def list_new_objects(s3, uri, watermark, partitioned=False):
+    """ Lists the objects of a source which were not yet loaded as per its watermark.
+
+    Args:
+    s3 (obj): Boto3 s3 client.
+    uri (str): The s3 uri of the source prefix (LOG_DATA or SONG_DATA).
+    watermark (dict): The watermark of the source holding last_key and last_modified.
+    partitioned (bool): The new objects only arrive in the latest partition, as the year/month ones of the log data.
+    """
+    # The log data is partitioned by year/month, so the listing restarts from the last partition processed.
+    # The new song files arrive below any of the song_data/A/B/C/ prefixes, so the whole prefix is listed.
+    last_key = watermark.get("last_key")
+    start_after = last_key.rsplit("/", 1)[0] + "/" if last_key and partitioned else None
+    last_modified = watermark.get("last_modified")
+    modified_since = datetime.fromisoformat(last_modified) if last_modified else None
+    return list(list_objects(s3, uri, start_after=start_after, modified_since=modified_since))
+
+
+def s3_client(config):
+    """ Creates the boto3 s3 client using the credentials of dwh.cfg.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    return boto3.client(
+        "s3",
+        region_name=config.get("CLUSTER", "REGION"),
+        aws_access_key_id=config.get("CLUSTER", "ACCESS_KEY"),
+        aws_secret_access_key=config.get("CLUSTER", "SECRET"),
+    )
 
 
-def main():
+def manifest_settings(config):
+    """ Returns the manifest prefix, the number of slices of the cluster and the files per slice of each COPY.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    manifest_prefix = config.get("S3", "MANIFEST_PREFIX", fallback="").strip("'\"").rstrip("/")
+    slices = cluster_slices(config.get("CLUSTER", "DWH_NODE_TYPE"), config.get("CLUSTER", "DWH_NUM_NODES"))
+    files_per_slice = config.getint("ETL", "COPY_FILES_PER_SLICE", fallback=1024)
+    return manifest_prefix, slices, files_per_slice
+
+
+def copy_objects(db, journal, source_fingerprint, s3, objects, copy_query, source, manifest_prefix, slices, files_per_slice):
+    """ Writes the objects into manifests of batches sized to the slices of the cluster and runs one COPY per batch.
+    Every batch is committed and journaled on its own, so a retried or resumed load skips the batches before it.
+    The batching is deterministic, so a batch is fingerprinted by the listing of its source and its number.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    source_fingerprint (str): The fingerprint of the listing of the source.
+    s3 (obj): Boto3 s3 client.
+    objects (list): The objects to be loaded as returned by list_objects.
+    copy_query (str): The manifest copy query of the staging table.
+    source (str): The name of the source (log_data or song_data).
+    manifest_prefix (str): The s3 uri prefix of the manifests of this run.
+    slices (int): The total number of slices of the cluster.
+    files_per_slice (int): The number of files every slice loads in a single COPY.
+    """
+    manifests = write_batch_manifests(s3, objects, manifest_prefix, source, slices, files_per_slice)
+    for i, manifest_uri in enumerate(manifests, 1):
+        step_fingerprint = fingerprint(source_fingerprint, copy_query, i, len(manifests))
+        queries = [copy_query.format(manifest_uri)]
+        if journal.run(db, f"copy {source} batch {i}", step_fingerprint, queries, idempotent=False):
+            print(f"Data loading is completed for {source} -- batch {i}/{len(manifests)}")
+
+
+def load_manifest_staging_tables(db, journal, s3, config, sources, listings):
+    """ Truncates the staging tables and loads the listed files of every source through the COPY manifests.
+    Returns the fingerprint of the staged data.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    s3 (obj): Boto3 s3 client.
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    sources (dict): The source name mapped to its s3 uri, truncate and manifest copy query.
+    listings (dict): The source name mapped to the objects to be loaded.
+    """
+    manifest_prefix, slices, files_per_slice = manifest_settings(config)
+    if not manifest_prefix:
+        raise ValueError("MANIFEST_PREFIX must be set in dwh.cfg to load through manifests")
+    run_prefix = f"{manifest_prefix}/{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}"
+    print(f"Starting to load the data through manifests for {slices} slices")
+    fingerprints = []
+    for source, (_, truncate_query, copy_query) in sources.items():
+        objects = listings[source]
+        source_fingerprint = fingerprint(source, truncate_query, listing_fingerprint(objects))
+        fingerprints.append(source_fingerprint)
+        journal.run(db, f"truncate {source}", source_fingerprint, [truncate_query])
+        if not objects:
+            print(f"No new files found for {source}, skipping the load")
+            continue
+        copy_objects(
+            db, journal, source_fingerprint, s3, objects, copy_query, source, run_prefix, slices, files_per_slice
+        )
+    return fingerprint(fingerprints)
+
+
+def staging_sources(config):
+    """ Returns the source name mapped to its s3 uri, truncate and manifest copy query.
+    The song data is loaded from the compacted objects when SONG_DATA_COMPACTED is set.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    song_data_compacted = config.get("S3", "SONG_DATA_COMPACTED", fallback="")
+    if song_data_compacted:
+        song_data = (song_data_compacted, staging_songs_truncate, staging_songs_compacted_manifest_copy)
+    else:
+        song_data = (config.get("S3", "SONG_DATA"), staging_songs_truncate, staging_songs_manifest_copy)
+    return {
+        "log_data": (config.get("S3", "LOG_DATA"), staging_events_truncate, staging_events_manifest_copy),
+        "song_data": song_data,
+    }
+
+
+def run_incremental(db, journal, config, concurrency=1, report_matches=False):
+    """ Loads only the new files since the last run and merges only the new rows into the fact and dimension tables.
+    The watermarks are moved forward once the inserts are committed and passed the data-quality checks.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    concurrency (int): The maximum number of inserts running at the same time.
+    report_matches (bool): Print the events matched by the exact join and by the match key.
+    """
+    started_at = datetime.now(timezone.utc)
+    store = WatermarkStore(config.get("ETL", "WATERMARK_FILE", fallback="watermarks.json"))
+    s3 = s3_client(config)
+    sources = staging_sources(config)
+    new_objects = {
+        source: list_new_objects(s3, uri, store.get(source), partitioned=source == "log_data")
+        for source, (uri, _, _) in sources.items()
+    }
+    with instrumentation.recorder.stage("load_staging_tables"):
+        staging_fingerprint = load_manifest_staging_tables(db, journal, s3, config, sources, new_objects)
+    with instrumentation.recorder.stage("load_errors"):
+        load_error_report(db, started_at)
+    with instrumentation.recorder.stage("enrich_staging_tables"):
+        enrich_staging_tables(db, journal, staging_fingerprint)
+        if report_matches:
+            match_report(db)
+    quality_gate(db, config, "staging", staging_quality_checks)
+
+    last_ts = store.get("log_data").get("last_ts", 0)
+    with instrumentation.recorder.stage("insert_tables"):
+        run_inserts(
+            db, journal, staging_fingerprint, concurrency, incremental_insert_table_queries, {"last_ts": last_ts}
+        )
+    quality_gate(db, config, "tables", table_quality_checks)
+    if lake.lake_prefix(config):
+        with instrumentation.recorder.stage("export_lake"):
+            lake.export_lake(db, journal, s3, lake.lake_prefix(config), staging_fingerprint, lake.staged_days(db))
+
+    with instrumentation.recorder.stage("watermarks"):
+        max_ts = db.fetchone(staging_events_max_ts)[0]
+    if max_ts is not None and max_ts > last_ts:
+        store.update("log_data", last_ts=max_ts)
+    for source, objects in new_objects.items():
+        if not objects:
+            continue
+        store.update(
+            source,
+            last_key=max(obj["key"] for obj in objects),
+            last_modified=max(obj["last_modified"] for obj in objects).isoformat(),
+        )
+    print(f"Watermarks are updated in {store.path}")
+
+
+def run_full(db, journal, config, concurrency=1, report_matches=False):
+    """ Loads the complete S3 prefixes and inserts everything from the staging tables.
+    When MANIFEST_PREFIX is set the prefixes are listed once and loaded in batches sized to the cluster slices,
+    otherwise COPY is pointed at the bare prefixes.
+    The watermarks are initialized once the data-quality checks passed, so that the next incremental run only
+    picks up the newer files.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    concurrency (int): The maximum number of inserts running at the same time.
+    report_matches (bool): Print the events matched by the exact join and by the match key.
+    """
+    started_at = datetime.now(timezone.utc)
+    if config.get("S3", "MANIFEST_PREFIX", fallback=""):
+        s3 = s3_client(config)
+        sources = staging_sources(config)
+        listings = {source: list(list_objects(s3, uri)) for source, (uri, _, _) in sources.items()}
+        with instrumentation.recorder.stage("load_staging_tables"):
+            staging_fingerprint = load_manifest_staging_tables(db, journal, s3, config, sources, listings)
+    else:
+        with instrumentation.recorder.stage("load_staging_tables"):
+            staging_fingerprint = load_staging_tables(db, journal)
+    with instrumentation.recorder.stage("load_errors"):
+        load_error_report(db, started_at)
+    with instrumentation.recorder.stage("enrich_staging_tables"):
+        enrich_staging_tables(db, journal, staging_fingerprint)
+        if report_matches:
+            match_report(db)
+    quality_gate(db, config, "staging", staging_quality_checks)
+    with instrumentation.recorder.stage("insert_tables"):
+        run_inserts(db, journal, staging_fingerprint, concurrency)
+    quality_gate(db, config, "tables", table_quality_checks)
+    if lake.lake_prefix(config):
+        with instrumentation.recorder.stage("export_lake"):
+            lake.export_lake(db, journal, s3_client(config), lake.lake_prefix(config), staging_fingerprint)
+
+    store = WatermarkStore(config.get("ETL", "WATERMARK_FILE", fallback="watermarks.json"))
+    with instrumentation.recorder.stage("watermarks"):
+        max_ts = db.fetchone(staging_events_max_ts)[0]
+    store.update("log_data", last_ts=max_ts, last_modified=started_at.isoformat())
+    store.update("song_data", last_modified=started_at.isoformat())
+
+
+def backfill_day(db, s3, day, objects, stage_table, manifest_prefix, slices, files_per_slice, checks, publish_lock):
+    """ Stages the log files of a day into its own table and replaces the day in the tables derived from the events.
+    The staging table is dropped afterwards, also when the day failed. Returns the duration of the day.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    s3 (obj): Boto3 s3 client.
+    day (date): The backfilled day.
+    objects (list): The log files of the day as returned by list_objects.
+    stage_table (str): The staging table of the day.
+    manifest_prefix (str): The s3 uri prefix of the manifests of this run.
+    slices (int): The total number of slices of the cluster.
+    files_per_slice (int): The number of files every slice loads in a single COPY.
+    checks (bool): Run the data-quality checks of the staged events before the day is replaced.
+    publish_lock (Lock): Serializes the replacements, which write the same tables.
+    """
+    started = perf_counter()
+    day_start = datetime.combine(day, time.min)
+    params = {"day_start": day_start, "day_end": day_start + timedelta(days=1)}
+    copy_query = backfill_copy_query(stage_table)
+    db.run(backfill_stage_create.format(table=stage_table))
+    try:
+        manifests = write_batch_manifests(
+            s3, objects, manifest_prefix, f"log_data-{day.isoformat()}", slices, files_per_slice
+        )
+        for manifest_uri in manifests:
+            db.run(copy_query.format(manifest_uri), idempotent=False)
+        db.run(backfill_enrich_query(stage_table), params)
+        if checks:
+            _, event_checks = staging_quality_checks["staging_events"]
+            run_checks(db, f"backfill {day.isoformat()}", {"staging_events": (stage_table, event_checks)})
+        # The staging of the days runs at the same time, a concurrent DELETE of songplays would conflict.
+        with publish_lock:
+            db.run(backfill_replace_query(stage_table), params, idempotent=False)
+    finally:
+        db.run(backfill_stage_drop.format(table=stage_table))
+    duration = perf_counter() - started
+    print(f"Day {day.isoformat()} is backfilled from {len(objects)} files in {duration:.2f}s")
+    return duration
+
+
+def run_backfill(db, journal, config, start_date, end_date, concurrency=1):
+    """ Reprocesses the log data of a date range: only the year/month partitions of the range are listed, every day
+    is staged into a staging table of its own and replaces that day in songplays, the time dimension and the
+    rollups. Up to concurrency days are staged at the same time. The watermarks are left as they are.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps, a resumed backfill skips the completed days.
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    start_date (date): The first day.
+    end_date (date): The last day, included.
+    concurrency (int): The maximum number of days staged at the same time.
+    """
+    manifest_prefix, slices, files_per_slice = manifest_settings(config)
+    if not manifest_prefix:
+        raise ValueError("MANIFEST_PREFIX must be set in dwh.cfg to backfill through manifests")
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    s3 = s3_client(config)
+    days = list_log_days(s3, config.get("S3", "LOG_DATA"), start_date, end_date)
+    n_days = (end_date - start_date).days + 1
+    print(f"Starting to backfill {len(days)} of the {n_days} days from {start_date} to {end_date}")
+    checks = config.getboolean("QUALITY", "CHECKS", fallback=True)
+    publish_lock = threading.Lock()
+    durations = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for day, objects in sorted(days.items()):
+            step = f"backfill {day.isoformat()}"
+            step_fingerprint = fingerprint(step, listing_fingerprint(objects))
+            if journal.skip(step, step_fingerprint):
+                continue
+            stage_table = f"staging_events_{day:%Y%m%d}_{run_id.lower()}"
+            future = executor.submit(
+                backfill_day, db, s3, day, objects, stage_table, f"{manifest_prefix}/{run_id}", slices,
+                files_per_slice, checks, publish_lock,
+            )
+            futures[future] = (step, step_fingerprint, day)
+        # The completed days are journaled as they complete, so a failed day does not repeat the others.
+        error = None
+        for future in as_completed(futures):
+            step, step_fingerprint, day = futures[future]
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            durations[day] = future.result()
+            journal.mark_done(step, step_fingerprint, durations[day])
+    if error is not None:
+        raise error
+    print("--------------------- BACKFILL -----------------------")
+    for day in sorted(durations):
+        print(f"{day.isoformat():<12}{len(days[day]):>8} files{durations[day]:>9.2f}s")
+    if lake.lake_prefix(config):
+        # Also the days completed by a previous attempt of a resumed backfill are exported.
+        listing = fingerprint([listing_fingerprint(objects) for _, objects in sorted(days.items())])
+        lake.export_lake(db, journal, s3, lake.lake_prefix(config), listing, sorted(days))
+
+
+@click.command()
+@click.option(
+    "--incremental/--full",
+    default=False,
+    help="Load only the files and rows newer than the stored watermarks instead of the complete data.",
+)
+@click.option(
+    "--concurrency",
+    default=1,
+    show_default=True,
+    help="The number of inserts running at the same time, each on its own connection.",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["redshift", "local"]),
+    default="redshift",
+    show_default=True,
+    help="Run on the redshift cluster, or locally with pandas on the directories of the LOCAL section of dwh.cfg.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Skip the steps the journal of the previous failed run recorded as completed for the same inputs.",
+)
+@click.option(
+    "--match-report",
+    "report_matches",
+    is_flag=True,
+    default=False,
+    help="Print how many events the exact artist/title/length join and the normalized match key match.",
+)
+@click.option(
+    "--profile-load",
+    is_flag=True,
+    default=False,
+    help="After the load, run ANALYZE COMPRESSION and measure the text columns, then save the data profile "
+    "used by create_tables.py to pick the encodings and VARCHAR sizes.",
+)
+@click.option(
+    "--start-date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Backfill the log data from this day on: only its partitions are listed and the days are replaced.",
+)
+@click.option(
+    "--end-date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="The last day of the backfill, by default the start date.",
+)
+def main(incremental, concurrency, backend, resume, report_matches, profile_load, start_date, end_date):
     """ Acts as a wrapper which connects to the redshift cluster, then performs:
     1. Extraction of the data from the S3 storage and staging the data into the staging tables.
-    2. Insertion of the data into the fact and dimension tables.
-    """
-    config = configparser.ConfigParser()
-    config.read("dwh.cfg")
-    HOST = config.get("CLUSTER", "HOST")
-    DB_NAME = config.get("CLUSTER", "DB_NAME")
-    DB_USER = config.get("CLUSTER", "DB_USER")
-    DB_PASSWORD = config.get("CLUSTER", "DB_PASSWORD")
-    DB_PORT = config.get("CLUSTER", "DB_PORT")
-    conn = psycopg2.connect(
-        host=HOST,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT,
-        # keepalives=1,
-        # keepalives_idle=30,
-        # keepalives_interval=10,
-        # keepalives_count=5
+    2. Insertion of the data into the fact and dimension tables and refresh of the daily rollups.
+    With the local backend the same tables are produced from the local directories without a cluster.
+    With --start-date only the days of the range are reprocessed, --concurrency days at the same time.
+    Once loaded, the tables over the thresholds of the MAINTENANCE section are analyzed and vacuumed within its budget.
+    Every completed step is recorded into the run journal, which is removed once the run completes.
+    """
+    config = read_config()
+    if end_date is not None and start_date is None:
+        raise click.UsageError("--end-date requires --start-date")
+    if start_date is not None:
+        start_date, end_date = start_date.date(), (end_date or start_date).date()
+        if end_date < start_date:
+            raise click.UsageError("--end-date must not be before --start-date")
+        if incremental or backend == "local":
+            raise click.UsageError("A backfill runs on the redshift backend and replaces the full days")
+    if backend == "local":
+        if incremental or resume or profile_load:
+            raise click.UsageError("The local backend only supports full runs")
+        local_engine.run(
+            config.get("LOCAL", "LOG_DATA_DIR"),
+            config.get("LOCAL", "SONG_DATA_DIR"),
+            config.get("LOCAL", "OUTPUT_DIR"),
+            config.getint("LOCAL", "CHUNK_SIZE", fallback=500000),
+        )
+        if lake.lake_prefix(config):
+            lake.export_local_lake(config)
+        return
+    # Every cursor of the run records its queries into the recorder of the METRICS sinks.
+    recorder = instrumentation.setup(config)
+    db = Warehouse(
+        config, pool_size=max(config.getint("DB", "POOL_SIZE", fallback=4), concurrency), workload="etl"
     )
-    cur = conn.cursor()
 
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    journal = RunJournal(config.get("ETL", "JOURNAL_FILE", fallback="etl_journal.json"), resume)
+    started_at = datetime.now(timezone.utc)
 
-    conn.close()
+    try:
+        if start_date is not None:
+            with instrumentation.recorder.stage("backfill"):
+                run_backfill(db, journal, config, start_date, end_date, concurrency)
+        elif incremental:
+            run_incremental(db, journal, config, concurrency, report_matches)
+        else:
+            run_full(db, journal, config, concurrency, report_matches)
+        if config.getboolean("MAINTENANCE", "ENABLED", fallback=True):
+            with instrumentation.recorder.stage("maintenance"):
+                maintenance.run_maintenance(db, config)
+        if profile_load:
+            with instrumentation.recorder.stage("profile_load"):
+                profile = profile_tables(db, config.getint("ETL", "PROFILE_COMPROWS", fallback=100000))
+            profile_path = config.get("ETL", "PROFILE_FILE", fallback="table_profile.json")
+            save_profile(profile_path, profile)
+            print_profile(profile)
+            print(f"The data profile is saved to {profile_path}, recreate the tables with create_tables.py to use it")
+        if query_group(config, "etl"):
+            wlm.queue_report(db, started_at, query_group(config, "etl"))
+    finally:
+        db.close()
+    journal.reset()
+    # The cached analysis results of the loaded tables are outdated now.
+    table_versions(config).bump(TABLES)
+    recorder.summary()
+    recorder.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,147 @@
+"""
+This python file provides the writers of the analysis results streamed by Warehouse.stream, each appending the
+batches of rows to a file as they are fetched so that a result never has to fit into memory:
+1. csv with a header row.
+2. json lines, one object per row.
+3. parquet (requires pyarrow), one row group per batch with the schema taken from the cursor description.
+"""
+
+import csv
+import json
+import threading
+from decimal import Decimal
+
+FORMATS = {"csv": ".csv", "jsonl": ".jsonl", "parquet": ".parquet"}
+
+# The postgres type oids of the cursor description mapped to the pyarrow type aliases, the others are strings.
+PARQUET_TYPES = {
+    16: "bool",
+    20: "int64",
+    21: "int16",
+    23: "int32",
+    700: "float32",
+    701: "float64",
+    1700: "float64",
+    1082: "date32",
+    1114: "timestamp[us]",
+    1184: "timestamp[us, tz=UTC]",
+}
+
+
+class CsvWriter:
+    """ Writes the rows into a csv file with a header row.
+
+    Args:
+    path (str): The path of the csv file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def write(self, description, rows):
+        if self._file is None:
+            self._file = open(self.path, "w", newline="")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow([column.name for column in description])
+        self._writer.writerows(rows)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class JsonLinesWriter:
+    """ Writes every row as a json object keyed by the column names.
+
+    Args:
+    path (str): The path of the json lines file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def write(self, description, rows):
+        if self._file is None:
+            self._file = open(self.path, "w")
+            self._columns = [column.name for column in description]
+        for row in rows:
+            self._file.write(json.dumps(dict(zip(self._columns, row)), default=str) + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class ParquetWriter:
+    """ Writes every batch of rows as a row group of a parquet file.
+
+    Args:
+    path (str): The path of the parquet file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = None
+
+    def write(self, description, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._writer is None:
+            self._schema = pa.schema(
+                [(column.name, pa.type_for_alias(PARQUET_TYPES.get(column.type_code, "string"))) for column in description]
+            )
+            self._writer = pq.ParquetWriter(self.path, self._schema, compression="snappy")
+        if not rows:
+            return
+        columns = {}
+        for index, field in enumerate(self._schema):
+            values = [row[index] for row in rows]
+            if pa.types.is_floating(field.type):
+                values = [float(value) if isinstance(value, Decimal) else value for value in values]
+            elif pa.types.is_string(field.type):
+                values = [None if value is None else str(value) for value in values]
+            columns[field.name] = values
+        self._writer.write_table(pa.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class PrintWriter:
+    """ Prints the rows, every batch at once so that the results of concurrent queries do not interleave.
+
+    Args:
+    name (str): The name of the query printed above its rows.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+
+    def write(self, description, rows):
+        with self._lock:
+            print(f"--------------------- {self.name} ---------------------")
+            print(tuple(column.name for column in description))
+            for row in rows:
+                print(row)
+
+    def close(self):
+        pass
+
+
+def open_writer(path, file_format):
+    """ Creates the writer of a file format.
+
+    Args:
+    path (str): The path of the written file.
+    file_format (str): Either csv, jsonl or parquet.
+    """
+    writers = {"csv": CsvWriter, "jsonl": JsonLinesWriter, "parquet": ParquetWriter}
+    if file_format not in writers:
+        raise ValueError(f"Unknown format {file_format}, expected one of {sorted(writers)}")
+    return writers[file_format](path)
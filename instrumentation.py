@@ -0,0 +1,235 @@
+"""
+This python file instruments every query executed by the ETL. The connections are created with the
+InstrumentedCursor cursor factory, which records for every cur.execute:
+1. The stage of the ETL, the statement (for example insert songplays) and the wall time.
+2. The rows affected (cur.rowcount) and optionally the Redshift query id, elapsed time and bytes scanned
+   looked up from STL_QUERY/SVL_QUERY_SUMMARY.
+The metrics are emitted to pluggable sinks (json lines, prometheus text file or any class with emit/close)
+and a summary table is printed at the end of the run.
+"""
+
+import importlib
+import json
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter
+
+import psycopg2.extensions
+
+QUERY_STATS_QUERY = """
+SELECT q.query, DATEDIFF(ms, q.starttime, q.endtime), COALESCE(SUM(s.bytes), 0)
+FROM stl_query q
+LEFT JOIN svl_query_summary s ON s.query = q.query
+WHERE q.query = pg_last_query_id()
+GROUP BY q.query, q.starttime, q.endtime;
+"""
+
+
+def statement_name(query):
+    """ Returns a short name of the statement, for example insert songplays or copy staging_events.
+    The upserts are named after the table they insert into last.
+
+    Args:
+    query (str): The query text.
+    """
+    inserts = re.findall(r"INSERT INTO (\w+)", query, re.IGNORECASE)
+    if inserts:
+        return f"insert {inserts[-1]}"
+    match = re.search(
+        r"\b(copy|truncate|delete from|update|create table if not exists|drop table if exists|select .*? from)\s+(\w+)",
+        query,
+        re.IGNORECASE | re.DOTALL,
+    )
+    if match:
+        return f"{match.group(1).split()[0].lower()} {match.group(2)}"
+    return " ".join(query.split()[:2]).lower()
+
+
+class JsonLinesSink:
+    """ Appends every metric as a json line to a file.
+
+    Args:
+    path (str): The path of the json lines file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, metric):
+        with self._lock, open(self.path, "a") as f:
+            f.write(json.dumps(metric, default=str) + "\n")
+
+    def close(self):
+        pass
+
+
+class PrometheusSink:
+    """ Writes the metrics in the prometheus text format on close, for example for the node exporter
+    textfile collector. The statements executed several times are summed up.
+
+    Args:
+    path (str): The path of the .prom file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.metrics = []
+
+    def emit(self, metric):
+        self.metrics.append(metric)
+
+    def close(self):
+        lines = [
+            "# HELP sparkify_etl_query_duration_seconds Wall time of the ETL statements.",
+            "# TYPE sparkify_etl_query_duration_seconds gauge",
+        ]
+        rows = [
+            "# HELP sparkify_etl_query_rows Rows affected by the ETL statements.",
+            "# TYPE sparkify_etl_query_rows gauge",
+        ]
+        totals = {}
+        for metric in self.metrics:
+            labels = f'stage="{metric["stage"]}",statement="{metric["statement"]}",status="{metric["status"]}"'
+            duration, n_rows = totals.get(labels, (0.0, 0))
+            totals[labels] = (duration + metric["duration_s"], n_rows + max(metric["rows"], 0))
+        for labels, (duration, n_rows) in totals.items():
+            lines.append(f"sparkify_etl_query_duration_seconds{{{labels}}} {duration:.6f}")
+            rows.append(f"sparkify_etl_query_rows{{{labels}}} {n_rows}")
+        with open(self.path, "w") as f:
+            f.write("\n".join(lines + rows) + "\n")
+
+
+class Recorder:
+    """ Collects the metrics of the executed queries and forwards them to the sinks.
+
+    Args:
+    sinks (list): The sinks, objects with emit(metric) and close() methods.
+    query_stats (bool): Look up the Redshift query id, elapsed time and bytes scanned of every statement.
+    """
+
+    def __init__(self, sinks=None, query_stats=False):
+        self.sinks = sinks or []
+        self.query_stats = query_stats
+        self.current_stage = None
+        self.metrics = []
+        # The wall time of every stage, summed over the blocks of the same name.
+        self.stage_timings = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """ Labels the queries executed within the block with the stage name.
+
+        Args:
+        name (str): The name of the stage, for example load_staging_tables.
+        """
+        previous, self.current_stage = self.current_stage, name
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.current_stage = previous
+            self.stage_timings[name] = self.stage_timings.get(name, 0) + perf_counter() - started
+
+    def record(self, query, duration, rows, status, stats=None):
+        """ Records the metric of a single statement and emits it to the sinks.
+
+        Args:
+        query (str): The query text.
+        duration (float): The wall time in seconds.
+        rows (int): The rows affected as per cur.rowcount.
+        status (str): Either ok or error.
+        stats (tuple): The query id, elapsed milliseconds and bytes scanned as per STL_QUERY/SVL_QUERY_SUMMARY.
+        """
+        metric = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "stage": self.current_stage,
+            "statement": statement_name(query),
+            "duration_s": round(duration, 6),
+            "rows": rows,
+            "status": status,
+        }
+        if stats:
+            metric.update(query_id=stats[0], elapsed_ms=stats[1], bytes_scanned=stats[2])
+        with self._lock:
+            self.metrics.append(metric)
+        for sink in self.sinks:
+            sink.emit(metric)
+
+    def summary(self):
+        """ Prints the summary table of the statements of the run.
+        """
+        if not self.metrics:
+            return
+        print("--------------------- QUERY METRICS ------------------")
+        print(f"{'stage':<24}{'statement':<32}{'duration':>10}{'rows':>12}{'bytes':>16}  status")
+        for metric in self.metrics:
+            print(
+                f"{str(metric['stage']):<24}{metric['statement']:<32}{metric['duration_s']:>9.2f}s"
+                f"{metric['rows']:>12}{metric.get('bytes_scanned', ''):>16}  {metric['status']}"
+            )
+        print(f"Total {sum(metric['duration_s'] for metric in self.metrics):.2f}s over {len(self.metrics)} statements")
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+# The recorder used by the InstrumentedCursor, replaced by setup().
+recorder = Recorder()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """ psycopg2 cursor recording the wall time and rows affected of every execute into the recorder.
+    """
+
+    def execute(self, query, vars=None):
+        started = perf_counter()
+        status = "error"
+        try:
+            result = super().execute(query, vars)
+            status = "ok"
+            return result
+        finally:
+            duration = perf_counter() - started
+            rows = self.rowcount
+            stats = None
+            if status == "ok" and recorder.query_stats and self.description is None:
+                with psycopg2.extensions.cursor(self.connection) as stats_cur:
+                    stats_cur.execute(QUERY_STATS_QUERY)
+                    stats = stats_cur.fetchone()
+            recorder.record(query, duration, rows, status, stats)
+
+
+def load_sink(name, config):
+    """ Creates a sink by name: jsonl, prometheus or the dotted path of a custom class (module.Class),
+    which is created with the METRICS section of dwh.cfg.
+
+    Args:
+    name (str): The name of the sink.
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    if name == "jsonl":
+        return JsonLinesSink(config.get("METRICS", "JSONL_PATH", fallback="etl_metrics.jsonl"))
+    if name == "prometheus":
+        return PrometheusSink(config.get("METRICS", "PROMETHEUS_PATH", fallback="etl_metrics.prom"))
+    module_name, _, class_name = name.rpartition(".")
+    return getattr(importlib.import_module(module_name), class_name)(config["METRICS"])
+
+
+def setup(config):
+    """ Creates the recorder of the run with the sinks listed in the METRICS section of dwh.cfg.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    global recorder
+    names = [name.strip() for name in config.get("METRICS", "SINKS", fallback="").split(",") if name.strip()]
+    recorder = Recorder(
+        [load_sink(name, config) for name in names],
+        config.getboolean("METRICS", "QUERY_STATS", fallback=False),
+    )
+    return recorder
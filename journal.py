@@ -0,0 +1,136 @@
+"""
+This python file keeps the run journal of etl.py, which records every completed step of the load and insert stages
+with the fingerprint of its inputs (the query, its parameters and the files or staging data it reads).
+A run started with --resume skips the steps recorded with the same fingerprint, so a failed run restarts at the
+failed step instead of repeating the COPY commands and inserts which already succeeded.
+The journal is removed once a run completes.
+The runs of the benchmark and of the load window are tagged with the git commit returned by git_commit.
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+from datetime import datetime, timezone
+from time import perf_counter
+
+
+def git_commit():
+    """ Returns the current git commit of the repository, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fingerprint(*parts):
+    """ Returns a short stable hash of the inputs of a step.
+
+    Args:
+    parts (list): Any json serializable values, for example the query text, its parameters and the object listing.
+    """
+    payload = json.dumps(parts, default=str, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+
+def listing_fingerprint(objects):
+    """ Returns the fingerprint of the objects listed from S3, by key, size and modification time.
+
+    Args:
+    objects (list): The objects as returned by list_objects.
+    """
+    return fingerprint(sorted((obj["key"], obj["size"], obj["last_modified"]) for obj in objects))
+
+
+class RunJournal:
+    """ Persists the completed steps of the current run into a local json file.
+
+    Args:
+    path (str): The path of the json file holding the journal.
+    resume (bool): Keep the steps of the previous (failed) run, otherwise the journal is started empty.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        if not resume:
+            self.reset()
+
+    def load(self):
+        """ Loads the completed steps, an empty dictionary is returned when no run is in progress.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def is_done(self, step, step_fingerprint):
+        """ Returns whether the step was completed for the same inputs.
+
+        Args:
+        step (str): The name of the step, for example copy staging_events or insert songplays.
+        step_fingerprint (str): The fingerprint of the inputs of the step.
+        """
+        return self.load().get(step, {}).get("fingerprint") == step_fingerprint
+
+    def mark_done(self, step, step_fingerprint, duration=None):
+        """ Records the step as completed and writes the journal atomically.
+
+        Args:
+        step (str): The name of the step.
+        step_fingerprint (str): The fingerprint of the inputs of the step.
+        duration (float): The duration of the step in seconds.
+        """
+        steps = self.load()
+        steps[step] = {
+            "fingerprint": step_fingerprint,
+            "completed_at": datetime.now(timezone.utc).isoformat(),
+            "duration_s": None if duration is None else round(duration, 3),
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(steps, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def skip(self, step, step_fingerprint):
+        """ Returns whether the step can be skipped and prints it.
+
+        Args:
+        step (str): The name of the step.
+        step_fingerprint (str): The fingerprint of the inputs of the step.
+        """
+        if self.is_done(step, step_fingerprint):
+            print(f"Step {step} is already completed for the same inputs, skipping it")
+            return True
+        return False
+
+    def run(self, db, step, step_fingerprint, queries, params=None, idempotent=True):
+        """ Runs the queries of a step unless it is already completed for the same inputs, then records it.
+        Returns whether the step was run.
+
+        Args:
+        db (Warehouse): The shared connection layer.
+        step (str): The name of the step.
+        step_fingerprint (str): The fingerprint of the inputs of the step.
+        queries (list): The queries of the step, each committed on its own.
+        params (dict): The query parameters.
+        idempotent (bool): The queries can be replayed after they were committed.
+        """
+        if self.skip(step, step_fingerprint):
+            return False
+        started = perf_counter()
+        for query in queries:
+            db.run(query, params, idempotent=idempotent)
+        self.mark_done(step, step_fingerprint, perf_counter() - started)
+        return True
+
+    def reset(self):
+        """ Removes the journal, called when a new run starts or a run completes.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
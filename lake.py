@@ -0,0 +1,250 @@
+"""
+This python file provides the Parquet lake of the fact and dimension tables, for the analysis off the cluster:
+1. The export stage of etl.py unloads the tables below LAKE_PREFIX partitioned by start_date/level. A full run
+   rewrites every table, an incremental run or a backfill only rewrites the day partitions of its events.
+2. A manifest (_manifest.json at the root of the lake) lists the files of every partition with the time they were
+   exported, only the rewritten partitions are listed again.
+3. The local backend writes the same layout from its csv files into the directory of the local s3 stand-in.
+4. A DuckDB query layer (requires duckdb) answers the analyze_queries of sql_queries.py from the Parquet files,
+   deriving the daily rollups they read from songplays.
+"""
+
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+
+import click
+
+from db import read_config
+from journal import fingerprint
+from local_s3 import LocalS3Client
+from manifests import list_objects, parse_s3_uri
+from sql_queries import (
+    analyze_queries,
+    lake_tables,
+    lake_unload_query,
+    staged_days_query,
+    user_agent_browser_expression,
+    user_agent_os_expression,
+)
+
+MANIFEST_NAME = "_manifest.json"
+
+# The rollups read by the analysis queries, computed from songplays with the same expressions as on the cluster.
+LAKE_VIEWS = {
+    "daily_level_plays": """
+SELECT CAST(start_time AS DATE) AS day, level, COUNT(*) AS plays, COUNT(DISTINCT user_id) AS users
+FROM songplays
+GROUP BY 1, 2
+""",
+    "daily_platform_plays": f"""
+SELECT CAST(start_time AS DATE) AS day,
+{user_agent_os_expression} AS os,
+{user_agent_browser_expression} AS browser,
+COUNT(*) AS plays, COUNT(DISTINCT user_id) AS users
+FROM songplays
+GROUP BY 1, 2, 3
+""",
+}
+
+
+def lake_prefix(config):
+    """ Returns the s3 uri of the lake (PREFIX of the LAKE section of dwh.cfg), empty when the export is disabled.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    return config.get("LAKE", "PREFIX", fallback="").strip("'\"").rstrip("/")
+
+
+def local_lake_dir(config):
+    """ Returns the directory of the lake in the local s3 stand-in (LOCAL_ROOT of the LAKE section of dwh.cfg).
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    bucket, prefix = parse_s3_uri(lake_prefix(config))
+    return os.path.join(config.get("LAKE", "LOCAL_ROOT", fallback="output/s3"), bucket, *prefix.split("/"))
+
+
+def read_manifest(s3, uri):
+    """ Returns the manifest of the lake, an empty manifest before the first export.
+
+    Args:
+    s3 (obj): Boto3 s3 client.
+    uri (str): The s3 uri of the lake.
+    """
+    bucket, prefix = parse_s3_uri(uri)
+    key = f"{prefix}/{MANIFEST_NAME}"
+    if not any(obj["key"] == key for obj in list_objects(s3, f"s3://{bucket}/{key}")):
+        return {"tables": {}}
+    return json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+
+def write_lake_manifest(s3, uri, rewritten):
+    """ Lists the rewritten directories of the lake again and updates their partitions in the manifest.
+
+    Args:
+    s3 (obj): Boto3 s3 client.
+    uri (str): The s3 uri of the lake.
+    rewritten (list): The rewritten directories relative to the lake, for example songplays/start_date=2018-11-12/.
+    """
+    bucket, prefix = parse_s3_uri(uri)
+    manifest = read_manifest(s3, uri)
+    exported_at = datetime.now(timezone.utc).isoformat()
+    for directory in rewritten:
+        table = directory.split("/", 1)[0]
+        entry = manifest["tables"].setdefault(table, {"partition_by": list(lake_tables[table][0]), "partitions": {}})
+        partitions = entry["partitions"]
+        for partition in [partition for partition in partitions if f"{table}/{partition}/".startswith(directory)]:
+            del partitions[partition]
+        for obj in list_objects(s3, f"{uri}/{directory}"):
+            if not obj["key"].endswith(".parquet"):
+                continue
+            path = obj["key"][len(prefix) + 1 :]
+            partition = path[len(table) + 1 :].rpartition("/")[0]
+            files = partitions.setdefault(partition, {"files": [], "bytes": 0, "exported_at": exported_at})
+            files["files"].append(path)
+            files["bytes"] += obj["size"]
+    manifest["updated_at"] = exported_at
+    s3.put_object(
+        Bucket=bucket, Key=f"{prefix}/{MANIFEST_NAME}", Body=json.dumps(manifest, indent=2, sort_keys=True).encode()
+    )
+    return manifest
+
+
+def staged_days(db):
+    """ Returns the days of the staged events.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    """
+    return [row[0] for row in db.run(staged_days_query, fetch=True)]
+
+
+def export_lake(db, journal, s3, uri, step_fingerprint, days=None):
+    """ Unloads the tables into the lake and updates its manifest. The tables partitioned by start_date only rewrite
+    the partitions of the given days, the other tables are rewritten completely.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    journal (RunJournal): The journal of the completed steps.
+    s3 (obj): Boto3 s3 client.
+    uri (str): The s3 uri of the lake.
+    step_fingerprint (str): The fingerprint of the loaded data, for example of the staged data.
+    days (list): The day partitions to rewrite, every table is rewritten completely without them.
+    """
+    print("Starting to export the tables into the lake")
+    rewritten = []
+    for table, (partition_by, _) in lake_tables.items():
+        if days is not None and "start_date" in partition_by:
+            steps = [(f"export {table} {day.isoformat()}", lake_unload_query(table, day)) for day in days]
+            rewritten.extend(f"{table}/start_date={day.isoformat()}/" for day in days)
+        else:
+            steps = [(f"export {table}", lake_unload_query(table))]
+            rewritten.append(f"{table}/")
+        for step, query in steps:
+            journal.run(db, step, fingerprint(query, step_fingerprint), [query])
+        print(f"Data export is completed for {table} ({len(steps)} unloads)")
+    manifest = write_lake_manifest(s3, uri, rewritten)
+    print(f"The lake manifest lists {sum(len(entry['partitions']) for entry in manifest['tables'].values())} partitions")
+
+
+def write_local_lake(output_dir, lake_dir):
+    """ Writes the csv files of the local backend into the lake layout as Parquet (requires duckdb).
+
+    Args:
+    output_dir (str): The directory of the csv files written by local_engine.run.
+    lake_dir (str): The directory of the lake.
+    """
+    import duckdb
+
+    con = duckdb.connect()
+    try:
+        for table, (partition_by, time_column) in lake_tables.items():
+            target = os.path.join(lake_dir, table)
+            shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(target)
+            source = f"read_csv_auto('{os.path.join(output_dir, table + '.csv')}')"
+            if time_column:
+                select = f"SELECT *, CAST({time_column} AS DATE) AS start_date FROM {source}"
+            else:
+                select = f"SELECT * FROM {source}"
+            if partition_by:
+                con.execute(f"COPY ({select}) TO '{target}' (FORMAT PARQUET, PARTITION_BY ({', '.join(partition_by)}))")
+            else:
+                con.execute(f"COPY ({select}) TO '{os.path.join(target, 'data_0.parquet')}' (FORMAT PARQUET)")
+            print(f"Data export is completed for {table}")
+    finally:
+        con.close()
+
+
+def export_local_lake(config):
+    """ Writes the lake of the local backend into the local s3 stand-in and its manifest.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    print("Starting to export the tables into the local lake")
+    write_local_lake(config.get("LOCAL", "OUTPUT_DIR"), local_lake_dir(config))
+    s3 = LocalS3Client(config.get("LAKE", "LOCAL_ROOT", fallback="output/s3"))
+    manifest = write_lake_manifest(s3, lake_prefix(config), [f"{table}/" for table in lake_tables])
+    print(f"The lake manifest lists {sum(len(entry['partitions']) for entry in manifest['tables'].values())} partitions")
+
+
+def connect_lake(root, config=None):
+    """ Returns a DuckDB connection with a view per table of the lake and the rollups of LAKE_VIEWS (requires duckdb).
+
+    Args:
+    root (str): The directory or s3 uri of the lake.
+    config (ConfigParser): The parsed dwh.cfg configuration, for the credentials of an s3 lake.
+    """
+    import duckdb
+
+    con = duckdb.connect()
+    if root.startswith("s3://"):
+        con.execute("INSTALL httpfs")
+        con.execute("LOAD httpfs")
+        if config is not None:
+            con.execute(f"SET s3_region = '{config.get('CLUSTER', 'REGION')}'")
+            con.execute(f"SET s3_access_key_id = '{config.get('CLUSTER', 'ACCESS_KEY')}'")
+            con.execute(f"SET s3_secret_access_key = '{config.get('CLUSTER', 'SECRET')}'")
+    for table in lake_tables:
+        con.execute(
+            f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{root}/{table}/**/*.parquet', hive_partitioning = true)"
+        )
+    for view, query in LAKE_VIEWS.items():
+        con.execute(f"CREATE VIEW {view} AS {query}")
+    return con
+
+
+@click.command()
+@click.option(
+    "--local",
+    is_flag=True,
+    default=False,
+    help="Query the lake written by the local backend into the local s3 stand-in instead of LAKE_PREFIX.",
+)
+def main(local):
+    """ Answers the analysis queries of analyse_insertion.py from the Parquet lake with DuckDB, without the cluster.
+    """
+    config = read_config()
+    if not lake_prefix(config):
+        raise click.UsageError("PREFIX must be set in the LAKE section of dwh.cfg")
+    root = local_lake_dir(config) if local else lake_prefix(config)
+    con = connect_lake(root, config)
+    try:
+        for query in analyze_queries:
+            cursor = con.execute(query)
+            print("--------------------- QUERY --------------------------")
+            print(" ".join(query.split()))
+            print(tuple(column[0] for column in cursor.description))
+            for row in cursor.fetchall():
+                print(row)
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
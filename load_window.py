@@ -0,0 +1,164 @@
+"""
+This python file runs a load inside a window of the cluster lifecycle, so that the cluster does not have to run
+24/7 nor be created from scratch before every load:
+1. The paused cluster is resumed and elastically resized to LOAD_NUM_NODES nodes for the load.
+2. create_tables.py, etl.py and analyse_insertion.py are run one after the other.
+3. The cluster is resized back to DWH_NUM_NODES and paused again, also when a phase failed.
+The duration of every phase is printed and appended, with the node counts and the git commit, to the json lines file
+WINDOW_RESULTS, to compare whether the larger cluster shortens the load enough to pay for the resizes.
+"""
+
+import json
+import subprocess
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+
+import click
+
+from db import read_config
+from IaC import aws_clients, init, pause_cluster, poll_settings, resize_cluster, resume_cluster
+from journal import git_commit
+
+
+def run_phase(window, name, action):
+    """ Runs a phase of the window and records its duration, the failed phase is recorded before it is raised.
+
+    Args:
+    window (dict): The window record, the duration is added to its phases.
+    name (str): The name of the phase.
+    action (callable): The phase.
+    """
+    print(f"--------------------- {name.upper()} ---------------------")
+    started = perf_counter()
+    try:
+        action()
+    except BaseException:
+        window["failed_phase"] = window["failed_phase"] or name
+        raise
+    finally:
+        window["phases"][name] = round(perf_counter() - started, 3)
+
+
+def run_script(script, *args):
+    """ Runs one of the scripts of the repository with the same python interpreter, raising when it fails.
+
+    Args:
+    script (str): The script, for example etl.py.
+    args (list): The command line arguments of the script.
+    """
+    subprocess.run([sys.executable, script, *args], check=True)
+
+
+def node_hours(window):
+    """ Returns the node hours spent by the phases of the window: the load phases run on the load nodes, the
+    lifecycle phases are counted at the larger of both sizes.
+
+    Args:
+    window (dict): The window record.
+    """
+    load_phases = ("create_tables", "etl", "analyse_insertion")
+    peak = max(window["load_nodes"], window["base_nodes"])
+    seconds = sum(
+        duration * (window["load_nodes"] if name in load_phases else peak)
+        for name, duration in window["phases"].items()
+    )
+    return round(seconds / 3600, 4)
+
+
+def print_window(window):
+    """ Prints the duration of every phase of the window.
+
+    Args:
+    window (dict): The window record.
+    """
+    print("--------------------- LOAD WINDOW --------------------")
+    print(f"nodes: {window['base_nodes']} -> {window['load_nodes']} ({window['node_type']})")
+    for name, duration in window["phases"].items():
+        print(f"{name:<20}{duration:>10.1f}s")
+    print(f"{'total':<20}{sum(window['phases'].values()):>10.1f}s")
+    print(f"{'node hours':<20}{window['node_hours']:>11}")
+
+
+def record_window(path, window):
+    """ Appends the window record as a json line, the phases are kept in the order they ran.
+
+    Args:
+    path (str): The path of the json lines results file.
+    window (dict): The window record.
+    """
+    with open(path, "a") as f:
+        f.write(json.dumps(window) + "\n")
+
+
+@click.command(context_settings={"ignore_unknown_options": True})
+@click.option(
+    "--load-nodes",
+    type=int,
+    default=None,
+    help="The number of nodes during the load, by default LOAD_NUM_NODES of the IAC section (or no resize).",
+)
+@click.option(
+    "--create-tables/--keep-tables",
+    default=False,
+    help="Recreate (drop) the tables with create_tables.py before a full load, by default they are kept.",
+)
+@click.option(
+    "--pause/--no-pause",
+    default=True,
+    help="Pause the cluster once the window is over.",
+)
+@click.option(
+    "--endpoint-url",
+    default=None,
+    help="The endpoint of the AWS services, for example a local moto server (http://localhost:5000) in CI.",
+)
+@click.argument("etl_args", nargs=-1, type=click.UNPROCESSED)
+def main(load_nodes, create_tables, pause, endpoint_url, etl_args):
+    """ Resumes and resizes the cluster, runs create_tables.py (with --create-tables), etl.py (with the extra
+    ETL_ARGS, for example --incremental --concurrency 4) and analyse_insertion.py, then resizes the cluster back and
+    pauses it.
+    """
+    # Recreating the tables drops the loaded history, which an incremental or resumed run does not load again.
+    if create_tables and {"--incremental", "--resume"} & set(etl_args):
+        raise click.UsageError("--create-tables drops the loaded tables, it cannot be combined with --incremental or --resume")
+    config = read_config()
+    envs = init()
+    if envs == -1:
+        raise click.UsageError("The required envs cannot be empty in the env file")
+    poll = poll_settings(config)
+    _, redshift, _ = aws_clients(envs, endpoint_url)
+    base_nodes = int(envs["n_nodes"])
+    load_nodes = load_nodes or int(config.get("IAC", "LOAD_NUM_NODES", fallback="") or base_nodes)
+    window = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "node_type": envs["node_type"],
+        "base_nodes": base_nodes,
+        "load_nodes": load_nodes,
+        "etl_args": list(etl_args),
+        "phases": {},
+        "failed_phase": None,
+    }
+    try:
+        run_phase(window, "resume", lambda: resume_cluster(redshift, envs, poll))
+        run_phase(window, "resize_up", lambda: resize_cluster(redshift, envs, load_nodes, poll))
+        if create_tables:
+            run_phase(window, "create_tables", lambda: run_script("create_tables.py"))
+        run_phase(window, "etl", lambda: run_script("etl.py", *etl_args))
+        run_phase(window, "analyse_insertion", lambda: run_script("analyse_insertion.py"))
+    finally:
+        # The cluster is always brought back to its base size (and paused), so a failed load is not billed at the
+        # load size until somebody notices.
+        try:
+            run_phase(window, "resize_down", lambda: resize_cluster(redshift, envs, base_nodes, poll))
+            if pause:
+                run_phase(window, "pause", lambda: pause_cluster(redshift, envs, poll))
+        finally:
+            window["node_hours"] = node_hours(window)
+            print_window(window)
+            record_window(config.get("IAC", "WINDOW_RESULTS", fallback="window_results.jsonl"), window)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+This python file provides a local backend of the ETL, which reads the log data and song data JSON from a directory
+and produces the songplays, users, songs, artists and time tables with pandas, without a Redshift cluster.
+The transforms follow the semantics of the insert queries in sql_queries.py:
+1. songplays: the NextSong events joined to the songs on the normalized match key, deduplicated.
+2. users: the latest event (ts) of every user.
+3. songs/artists: one row per key, picked with the same ordering as the upserts.
+4. time: the distinct start times of the songplays.
+The events are streamed in chunks, only the song catalog and the (small) dimensions are kept in memory. The songplays
+are spilled into a csv file per day and deduplicated one day at a time.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+# The log data keys mapped to the staging_events columns, as per the LOG_JSONPATH file.
+EVENT_COLUMNS = {
+    "artist": "artist",
+    "auth": "auth",
+    "firstName": "first_name",
+    "gender": "gender",
+    "itemInSession": "item_in_session",
+    "lastName": "last_name",
+    "length": "length",
+    "level": "level",
+    "location": "location",
+    "method": "method",
+    "page": "page",
+    "registration": "registration",
+    "sessionId": "session_id",
+    "song": "song",
+    "status": "status",
+    "ts": "ts",
+    "userAgent": "user_agent",
+    "userId": "user_id",
+}
+
+SONG_COLUMNS = [
+    "artist_id",
+    "artist_latitude",
+    "artist_location",
+    "artist_longitude",
+    "artist_name",
+    "duration",
+    "num_songs",
+    "song_id",
+    "title",
+    "year",
+]
+
+SONGPLAY_COLUMNS = ["start_time", "user_id", "level", "song_id", "artist_id", "session_id", "location", "user_agent"]
+
+
+def list_files(directory):
+    """ Lists the JSON (optionally gzipped) files below a directory in path order.
+
+    Args:
+    directory (str): The directory holding the log data or song data.
+    """
+    paths = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith((".json", ".json.gz")):
+                paths.append(os.path.join(dirpath, filename))
+    return sorted(paths)
+
+
+def _open(path):
+    return gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8")
+
+
+def iter_record_chunks(paths, chunk_size):
+    """ Yields DataFrames of at most chunk_size records read from JSON lines files.
+
+    Args:
+    paths (list): The JSON lines files.
+    chunk_size (int): The maximum number of records per DataFrame.
+    """
+    records = []
+    for path in paths:
+        with _open(path) as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+                    if len(records) >= chunk_size:
+                        yield pd.DataFrame.from_records(records)
+                        records = []
+    if records:
+        yield pd.DataFrame.from_records(records)
+
+
+def to_staging_events(chunk):
+    """ Renames and types a chunk of log data records like the staging_events table.
+
+    Args:
+    chunk (DataFrame): The raw log data records.
+    """
+    events = chunk.reindex(columns=list(EVENT_COLUMNS)).rename(columns=EVENT_COLUMNS)
+    for column in ["item_in_session", "session_id", "status", "user_id"]:
+        events[column] = pd.to_numeric(events[column], errors="coerce").astype("Int64")
+    events["length"] = pd.to_numeric(events["length"], errors="coerce")
+    # ts is a BIGINT and registration a DOUBLE PRECISION in staging_events, start_time is materialized once like the
+    # enrichment step.
+    events["ts"] = pd.to_numeric(events["ts"], errors="coerce").astype("Int64")
+    events["registration"] = pd.to_numeric(events["registration"], errors="coerce")
+    events["start_time"] = epoch_start_time(events["ts"])
+    return events
+
+
+def to_staging_songs(chunk):
+    """ Types a chunk of song data records like the staging_songs table.
+
+    Args:
+    chunk (DataFrame): The raw song data records.
+    """
+    songs = chunk.reindex(columns=SONG_COLUMNS)
+    for column in ["artist_latitude", "artist_longitude", "duration"]:
+        songs[column] = pd.to_numeric(songs[column], errors="coerce")
+    for column in ["num_songs", "year"]:
+        songs[column] = pd.to_numeric(songs[column], errors="coerce").astype("Int64")
+    return songs
+
+
+def epoch_start_time(ts):
+    """ Converts the ts (epoch milliseconds) like timestamp 'epoch' + ts / 1000 * interval '1 second',
+    the integer division truncates to the second.
+
+    Args:
+    ts (Series): The ts column of staging_events.
+    """
+    seconds = pd.to_numeric(ts, errors="coerce").astype("Int64") // 1000
+    return pd.to_datetime(seconds, unit="s")
+
+
+def match_key(artist, title, duration):
+    """ Computes the normalized match key like match_key_expression: the MD5 of the trimmed and lower cased artist and
+    title with the duration rounded to a tenth of a second, missing when any part is missing.
+
+    Args:
+    artist (Series): The artist names.
+    title (Series): The song titles.
+    duration (Series): The durations in seconds.
+    """
+    # TRIM only strips blanks and ROUND rounds half away from zero, the durations are positive.
+    rounded = np.floor(pd.to_numeric(duration, errors="coerce") * 10 + 0.5).astype("Int64").astype("string")
+    parts = (
+        artist.astype("string").str.strip(" ").str.lower()
+        + "|"
+        + title.astype("string").str.strip(" ").str.lower()
+        + "|"
+        + rounded
+    )
+    return parts.map(lambda part: hashlib.md5(part.encode("utf-8")).hexdigest(), na_action="ignore")
+
+
+def first_per_key(df, key, order_by):
+    """ Keeps the first row of every non null key ordered by order_by (nulls last), like ROW_NUMBER() ... rank=1.
+
+    Args:
+    df (DataFrame): The rows.
+    key (str): The partition column.
+    order_by (list): The ordering columns.
+    """
+    df = df[df[key].notna()]
+    return df.sort_values(order_by, na_position="last", kind="mergesort").drop_duplicates(key, keep="first")
+
+
+def build_songs(song_data_dir, chunk_size):
+    """ Loads the song data like staging_songs and derives the songs and artists dimensions.
+
+    Args:
+    song_data_dir (str): The directory holding the song data.
+    chunk_size (int): The number of records parsed per chunk.
+    """
+    chunks = [to_staging_songs(chunk) for chunk in iter_record_chunks(list_files(song_data_dir), chunk_size)]
+    staging_songs = pd.concat(chunks, ignore_index=True) if chunks else to_staging_songs(pd.DataFrame())
+    staging_songs["match_key"] = match_key(
+        staging_songs["artist_name"], staging_songs["title"], staging_songs["duration"]
+    )
+    songs = first_per_key(staging_songs, "song_id", ["song_id", "title", "artist_id", "year", "duration"])[
+        ["song_id", "title", "artist_id", "year", "duration", "match_key"]
+    ]
+    artists = first_per_key(
+        staging_songs,
+        "artist_id",
+        ["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"],
+    )[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]]
+    artists.columns = ["artist_id", "name", "location", "latitude", "longitude"]
+    return staging_songs, songs, artists
+
+
+def next_song_events(events):
+    """ Returns the NextSong events of a chunk with their match key, like staging_events_match_key_update.
+
+    Args:
+    events (DataFrame): A chunk of staging_events.
+    """
+    plays = events[events["page"] == "NextSong"].copy()
+    plays["match_key"] = match_key(plays["artist"], plays["song"], plays["length"])
+    return plays
+
+
+def match_songplays(plays, songs):
+    """ Joins the NextSong events to the songs dimension on the match key like songplay_table_insert.
+    The rows with a null key are dropped since they never match in SQL.
+
+    Args:
+    plays (DataFrame): The NextSong events of a chunk as returned by next_song_events.
+    songs (DataFrame): The songs dimension with the match key of every song.
+    """
+    matched = plays.dropna(subset=["match_key"]).merge(
+        songs[["song_id", "artist_id", "match_key"]].dropna(subset=["match_key"]),
+        on="match_key",
+        how="inner",
+    )
+    return matched[SONGPLAY_COLUMNS].drop_duplicates()
+
+
+def spill_songplays(songplays, days_dir):
+    """ Appends the songplays of a chunk to the csv file of their day, so that the DISTINCT only ever holds a day.
+
+    Args:
+    songplays (DataFrame): The songplays of a chunk as returned by match_songplays.
+    days_dir (str): The directory of the csv file per day.
+    """
+    for day, rows in songplays.groupby(songplays["start_time"].dt.strftime("%Y-%m-%d")):
+        path = os.path.join(days_dir, f"{day}.csv")
+        rows.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+def write_songplays(days_dir, path):
+    """ Writes the songplays of every day without their duplicates (like the DISTINCT of songplay_table_insert,
+    duplicates share their start_time and thus their day) and numbers them. Returns the number of songplays.
+
+    Args:
+    days_dir (str): The directory of the csv file per day written by spill_songplays.
+    path (str): The path of the songplays csv file.
+    """
+    songplay_id = 0
+    with open(path, "w", newline="") as songplays_file:
+        songplays_file.write(",".join(["songplay_id"] + SONGPLAY_COLUMNS) + "\n")
+        for name in sorted(os.listdir(days_dir)):
+            # The rows are compared as written, so the missing values stay empty.
+            day = pd.read_csv(os.path.join(days_dir, name), dtype=str, keep_default_na=False).drop_duplicates()
+            day.insert(0, "songplay_id", range(songplay_id, songplay_id + len(day)))
+            songplay_id += len(day)
+            day.to_csv(songplays_file, header=False, index=False)
+    return songplay_id
+
+
+def count_matches(plays, staging_songs):
+    """ Counts the NextSong events matched by the exact artist, title and length join and by the match key,
+    like songplay_match_report.
+
+    Args:
+    plays (DataFrame): The NextSong events of a chunk as returned by next_song_events.
+    staging_songs (DataFrame): The song catalog as staging_songs.
+    """
+    exact_keys = staging_songs[["artist_name", "title", "duration"]].dropna().drop_duplicates()
+    exact = plays.merge(
+        exact_keys, left_on=["artist", "song", "length"], right_on=["artist_name", "title", "duration"], how="left",
+        indicator=True,
+    )
+    keyed = plays["match_key"].isin(set(staging_songs["match_key"].dropna()))
+    return int((exact["_merge"] == "both").sum()), int(keyed.sum())
+
+
+def time_attributes(start_times):
+    """ Derives the time dimension like the EXTRACT calls of time_table_insert.
+    EXTRACT(week) is the ISO week and EXTRACT(dayofweek) counts from Sunday (0).
+
+    Args:
+    start_times (Series): The distinct start times.
+    """
+    start_times = pd.Series(np.sort(start_times.dropna().unique()), name="start_time")
+    dt = start_times.dt
+    return pd.DataFrame(
+        {
+            "start_time": start_times,
+            "hour": dt.hour,
+            "day": dt.day,
+            "week": dt.isocalendar().week.astype(int).values,
+            "month": dt.month,
+            "year": dt.year,
+            "weekday": (dt.dayofweek + 1) % 7,
+        }
+    )
+
+
+def run(log_data_dir, song_data_dir, output_dir, chunk_size=500000):
+    """ Runs the complete ETL locally and writes one csv file per table into the output directory.
+    Returns the duration of every stage and the number of rows of every table.
+
+    Args:
+    log_data_dir (str): The directory holding the log data.
+    song_data_dir (str): The directory holding the song data.
+    output_dir (str): The directory where the tables are written.
+    chunk_size (int): The number of events processed per chunk.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    timings = {}
+    started = perf_counter()
+    print("Starting to load the song data")
+    staging_songs, songs, artists = build_songs(song_data_dir, chunk_size)
+    songs.to_csv(os.path.join(output_dir, "songs.csv"), index=False)
+    artists.to_csv(os.path.join(output_dir, "artists.csv"), index=False)
+    print(f"Data insertion is completed for songs ({len(songs)}) and artists ({len(artists)})")
+    timings["load_songs"], started = perf_counter() - started, perf_counter()
+
+    print("Starting to process the log data")
+    days_dir = os.path.join(output_dir, "songplays_days")
+    shutil.rmtree(days_dir, ignore_errors=True)
+    os.makedirs(days_dir)
+    latest_users = None
+    start_times = np.array([], dtype="datetime64[ns]")
+    next_songs, exact_matches, key_matches = 0, 0, 0
+    for chunk in iter_record_chunks(list_files(log_data_dir), chunk_size):
+        events = to_staging_events(chunk)
+        plays = next_song_events(events)
+        exact, keyed = count_matches(plays, staging_songs)
+        next_songs, exact_matches, key_matches = next_songs + len(plays), exact_matches + exact, key_matches + keyed
+
+        # songplays: deduplicated within the chunk, then across the chunks per day once all the chunks are spilled.
+        matched = match_songplays(plays, songs)
+        spill_songplays(matched, days_dir)
+
+        # users: the row of the latest ts per user across the chunks.
+        users = events.loc[events["user_id"].notna(), ["user_id", "first_name", "last_name", "gender", "level", "ts"]]
+        latest_users = users if latest_users is None else pd.concat([latest_users, users], ignore_index=True)
+        latest_users = latest_users.sort_values("ts", ascending=False, kind="mergesort").drop_duplicates(
+            "user_id", keep="first"
+        )
+
+        # time: only the distinct start times of the songplays are kept, at most one per second of the log data.
+        start_times = np.union1d(start_times, matched["start_time"].dropna().unique())
+    songplay_id = write_songplays(days_dir, os.path.join(output_dir, "songplays.csv"))
+    shutil.rmtree(days_dir)
+    print(f"Data insertion is completed for songplays ({songplay_id})")
+    print(
+        f"NextSong events {next_songs}, matched by the exact join {exact_matches}, by the match key {key_matches}"
+    )
+    timings["process_events"], started = perf_counter() - started, perf_counter()
+
+    users = latest_users.drop(columns="ts") if latest_users is not None else pd.DataFrame()
+    users.to_csv(os.path.join(output_dir, "users.csv"), index=False)
+    print(f"Data insertion is completed for users ({len(users)})")
+    time = time_attributes(pd.Series(start_times))
+    time.to_csv(os.path.join(output_dir, "time.csv"), index=False)
+    print(f"Data insertion is completed for time ({len(time)})")
+    timings["write_dimensions"] = perf_counter() - started
+    rows = {"songplays": songplay_id, "users": len(users), "songs": len(songs), "artists": len(artists), "time": len(time)}
+    matches = {"next_song_events": next_songs, "exact_join": exact_matches, "match_key": key_matches}
+    return {"timings": timings, "rows": rows, "matches": matches}
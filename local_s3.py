@@ -0,0 +1,77 @@
+"""
+This python file provides a local stand-in for the boto3 s3 client, backed by a directory where every bucket is
+a sub directory. Only the calls used by the ETL are supported, so the listing and manifest logic can run without AWS.
+"""
+
+import os
+from datetime import datetime, timezone
+
+
+class LocalPaginator:
+    """ Stand-in for the list_objects_v2 paginator of the boto3 s3 client.
+
+    Args:
+    client (LocalS3Client): The local s3 client.
+    page_size (int): The number of keys returned per page.
+    """
+
+    def __init__(self, client, page_size=1000):
+        self.client = client
+        self.page_size = page_size
+
+    def paginate(self, Bucket, Prefix="", StartAfter=None):
+        """ Yields the pages of the objects below the prefix in key order, as list_objects_v2 does.
+        """
+        bucket_dir = os.path.join(self.client.root, Bucket)
+        keys = []
+        for dirpath, _, filenames in os.walk(bucket_dir):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), bucket_dir).replace(os.sep, "/")
+                if key.startswith(Prefix) and (StartAfter is None or key > StartAfter):
+                    keys.append(key)
+        keys.sort()
+        for i in range(0, max(len(keys), 1), self.page_size):
+            contents = []
+            for key in keys[i : i + self.page_size]:
+                stat = os.stat(os.path.join(bucket_dir, key))
+                contents.append(
+                    {
+                        "Key": key,
+                        "Size": stat.st_size,
+                        "LastModified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                    }
+                )
+            yield {"Contents": contents, "KeyCount": len(contents)}
+
+
+class LocalS3Client:
+    """ Stand-in for the boto3 s3 client storing the objects below a local directory.
+
+    Args:
+    root (str): The directory holding one sub directory per bucket.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        path = os.path.join(self.root, bucket, *key.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def get_paginator(self, operation_name):
+        if operation_name != "list_objects_v2":
+            raise NotImplementedError(operation_name)
+        return LocalPaginator(self)
+
+    def put_object(self, Bucket, Key, Body):
+        with open(self._path(Bucket, Key), "wb") as f:
+            f.write(Body if isinstance(Body, bytes) else Body.read())
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": open(self._path(Bucket, Key), "rb")}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f)
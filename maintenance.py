@@ -0,0 +1,150 @@
+"""
+This python file provides the maintenance stage of etl.py, run after the loads within a time budget:
+1. The state of the fact, dimension and rollup tables is read from SVV_TABLE_INFO: the unsorted rows, the deleted
+   rows not yet reclaimed and how outdated the statistics are.
+2. Only the tables over the thresholds of the MAINTENANCE section of dwh.cfg are maintained, with ANALYZE
+   PREDICATE COLUMNS, VACUUM DELETE ONLY and VACUUM SORT ONLY.
+3. The statistics are refreshed first since they are cheap and the planner depends on them, then the vacuums run
+   from the largest unsorted or deleted region down. Every command runs with the remaining budget as its statement
+   timeout, the commands left once the budget is spent are skipped until the next run.
+"""
+
+from time import perf_counter
+
+import click
+import psycopg2.extensions
+
+from db import Warehouse, read_config
+from ddl import TABLES
+from sql_queries import analyze_table_query, table_maintenance_info, vacuum_delete_query, vacuum_sort_query
+
+# The staging tables are truncated before every load, so they are never maintained.
+MAINTAINED_TABLES = tuple(name for name in TABLES if not name.startswith("staging_"))
+
+
+def maintenance_settings(config):
+    """ Returns the thresholds and the time budget of the MAINTENANCE section of dwh.cfg.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    return dict(
+        stats_off=config.getfloat("MAINTENANCE", "STATS_OFF_PCT", fallback=10),
+        unsorted=config.getfloat("MAINTENANCE", "UNSORTED_PCT", fallback=5),
+        deleted=config.getfloat("MAINTENANCE", "DELETED_PCT", fallback=5),
+        sort_to=config.getint("MAINTENANCE", "SORT_TO_PERCENT", fallback=95),
+        budget=config.getfloat("MAINTENANCE", "BUDGET_SECONDS", fallback=900),
+    )
+
+
+def table_states(db, tables=MAINTAINED_TABLES):
+    """ Returns the state of the non-empty tables from SVV_TABLE_INFO, keyed by the table name.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    tables (tuple): The names of the tables.
+    """
+    rows = db.run(table_maintenance_info, {"tables": tuple(tables)}, fetch=True)
+    return {
+        table.strip(): dict(
+            rows=tbl_rows, size_mb=size_mb, unsorted=float(unsorted), deleted=float(deleted), stats_off=float(stats_off)
+        )
+        for table, tbl_rows, size_mb, unsorted, deleted, stats_off in rows
+    }
+
+
+def plan_maintenance(states, settings):
+    """ Returns the commands for the tables over the thresholds, as (table, operation, query) in the order they run:
+    the ANALYZE commands first, then the vacuums of the tables by the size of
+    their unsorted or deleted region, largest first.
+
+    Args:
+    states (dict): The state of every table as returned by table_states.
+    settings (dict): The thresholds as returned by maintenance_settings.
+    """
+    analyzes = [
+        (table, "analyze", analyze_table_query.format(table=table))
+        for table, state in sorted(states.items())
+        if state["stats_off"] > settings["stats_off"]
+    ]
+    vacuums = []
+    for table, state in states.items():
+        commands = []
+        # The deletes of a table run before its sort, which then has fewer rows to sort.
+        if state["deleted"] > settings["deleted"]:
+            commands.append((table, "vacuum delete", vacuum_delete_query.format(table=table)))
+        if state["unsorted"] > settings["unsorted"]:
+            query = vacuum_sort_query.format(table=table, percent=settings["sort_to"])
+            commands.append((table, "vacuum sort", query))
+        if commands:
+            vacuums.append((state["size_mb"] * max(state["deleted"], state["unsorted"]), commands))
+    vacuums.sort(key=lambda vacuum: -vacuum[0])
+    return analyzes + [command for _, commands in vacuums for command in commands]
+
+
+def run_maintenance(db, config):
+    """ Analyzes and vacuums the tables over the thresholds within the time budget and prints the report.
+    Returns the commands which were skipped or stopped by the budget.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    settings = maintenance_settings(config)
+    started = perf_counter()
+    states = table_states(db)
+    commands = plan_maintenance(states, settings)
+    print(f"--------------------- MAINTENANCE ({settings['budget']:g}s) ----------")
+    print(f"{'table':<22}{'rows':>12}{'unsorted':>10}{'deleted':>9}{'stats off':>11}")
+    for table, state in sorted(states.items()):
+        print(
+            f"{table:<22}{state['rows']:>12}{state['unsorted']:>9.1f}%{state['deleted']:>8.1f}%"
+            f"{state['stats_off']:>10.1f}%"
+        )
+    if not commands:
+        print("Every table is within the thresholds, nothing to maintain")
+        return []
+    left = []
+    for table, operation, query in commands:
+        remaining = settings["budget"] - (perf_counter() - started)
+        if left or remaining < 1:
+            left.append((table, operation, query))
+            print(f"{table:<22}{operation:<16}{'skipped, the budget is spent':>30}")
+            continue
+        command_started = perf_counter()
+        try:
+            # VACUUM cannot run within a transaction block.
+            db.run(query, autocommit=True, statement_timeout=int(remaining * 1000))
+        except psycopg2.extensions.QueryCanceledError:
+            left.append((table, operation, query))
+            print(f"{table:<22}{operation:<16}{'stopped at the end of the budget':>30}")
+            continue
+        print(f"{table:<22}{operation:<16}{perf_counter() - command_started:>29.2f}s")
+    print(f"Maintenance is completed in {perf_counter() - started:.2f}s, {len(left)} of {len(commands)} commands left")
+    return left
+
+
+@click.command()
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Only print the commands for the tables over the thresholds, without running them.",
+)
+def main(dry_run):
+    """ Analyzes and vacuums the tables over the thresholds of the MAINTENANCE section of dwh.cfg.
+    """
+    config = read_config()
+    db = Warehouse(config, workload="etl")
+    try:
+        if dry_run:
+            for table, operation, query in plan_maintenance(table_states(db), maintenance_settings(config)):
+                print(f"{table:<22}{operation:<16}{query}")
+        else:
+            run_maintenance(db, config)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
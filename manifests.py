@@ -0,0 +1,170 @@
+"""
+This python file provides the helpers to list the source objects in S3 and to write the COPY manifests,
+so that only the selected files are staged into Redshift.
+"""
+
+import json
+import re
+from datetime import date
+
+
+def parse_s3_uri(uri):
+    """ Splits a s3 uri as found in dwh.cfg (optionally quoted) into the bucket and the key prefix.
+
+    Args:
+    uri (str): The s3 uri, for example 's3://udacity-dend/log-data'.
+    """
+    uri = uri.strip().strip("'\"")
+    if not uri.startswith("s3://"):
+        raise ValueError(f"Not a valid s3 uri -- {uri}")
+    bucket, _, prefix = uri[len("s3://") :].partition("/")
+    return bucket, prefix
+
+
+def list_objects(s3, uri, start_after=None, modified_since=None):
+    """ Lists the objects below a s3 prefix in key order.
+
+    Args:
+    s3 (obj): Boto3 s3 client.
+    uri (str): The s3 uri of the prefix to be listed.
+    start_after (str): Only keys after this key (or partition prefix) are listed.
+    modified_since (datetime): Only objects modified after this time are returned.
+    """
+    bucket, prefix = parse_s3_uri(uri)
+    params = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        params["StartAfter"] = start_after
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(**params):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/"):
+                continue
+            if modified_since is not None and obj["LastModified"] <= modified_since:
+                continue
+            yield {
+                "url": f"s3://{bucket}/{obj['Key']}",
+                "key": obj["Key"],
+                "size": obj["Size"],
+                "last_modified": obj["LastModified"],
+            }
+
+
+# The day of a log file, taken from its name (log-data/2018/11/2018-11-12-events.json).
+LOG_DAY_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+
+
+def month_prefixes(uri, start_date, end_date):
+    """ Returns the uris of the year/month partitions of the log data between two dates.
+
+    Args:
+    uri (str): The s3 uri of the log data prefix (LOG_DATA).
+    start_date (date): The first day.
+    end_date (date): The last day, included.
+    """
+    uri = uri.strip().strip("'\"").rstrip("/")
+    year, month = start_date.year, start_date.month
+    prefixes = []
+    while (year, month) <= (end_date.year, end_date.month):
+        prefixes.append(f"{uri}/{year:04d}/{month:02d}/")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return prefixes
+
+
+def list_log_days(s3, uri, start_date, end_date):
+    """ Lists the log files of the days between two dates, only the year/month partitions of the range are listed.
+    Returns the days mapped to their objects, the files without a day in their name are left out.
+
+    Args:
+    s3 (obj): Boto3 s3 client.
+    uri (str): The s3 uri of the log data prefix (LOG_DATA).
+    start_date (date): The first day.
+    end_date (date): The last day, included.
+    """
+    days = {}
+    for prefix in month_prefixes(uri, start_date, end_date):
+        for obj in list_objects(s3, prefix):
+            match = LOG_DAY_PATTERN.search(obj["key"].rsplit("/", 1)[-1])
+            if match is None:
+                continue
+            day = date(*(int(part) for part in match.groups()))
+            if start_date <= day <= end_date:
+                days.setdefault(day, []).append(obj)
+    return days
+
+
+def write_manifest(s3, objects, manifest_uri):
+    """ Writes a Redshift COPY manifest listing the given objects.
+
+    Args:
+    s3 (obj): Boto3 s3 client.
+    objects (list): The objects as returned by list_objects.
+    manifest_uri (str): The s3 uri where the manifest is written.
+    """
+    bucket, key = parse_s3_uri(manifest_uri)
+    manifest = {
+        "entries": [
+            {"url": obj["url"], "mandatory": True, "meta": {"content_length": obj["size"]}}
+            for obj in objects
+        ]
+    }
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode("utf-8"))
+    return manifest_uri
+
+
+# Number of slices per node of every Redshift node type.
+NODE_SLICES = {
+    "dc2.large": 2,
+    "dc2.8xlarge": 16,
+    "ds2.xlarge": 2,
+    "ds2.8xlarge": 16,
+    "ra3.xlplus": 2,
+    "ra3.4xlarge": 4,
+    "ra3.16xlarge": 16,
+}
+
+
+def cluster_slices(node_type, n_nodes):
+    """ Returns the total number of slices of the cluster, which is the number of files a COPY loads in parallel.
+
+    Args:
+    node_type (str): The node type of the cluster (DWH_NODE_TYPE).
+    n_nodes (str): The number of nodes of the cluster (DWH_NUM_NODES).
+    """
+    if node_type not in NODE_SLICES:
+        raise ValueError(f"The slices of the node type {node_type} are not known")
+    return NODE_SLICES[node_type] * int(n_nodes)
+
+
+def batch_objects(objects, slices, files_per_slice):
+    """ Groups the objects into batches of slices * files_per_slice files, so that every slice of the cluster
+    receives the same number of files in each COPY. The largest files are spread first to balance the bytes.
+
+    Args:
+    objects (list): The objects as returned by list_objects.
+    slices (int): The total number of slices of the cluster.
+    files_per_slice (int): The number of files every slice loads in a single COPY.
+    """
+    objects = sorted(objects, key=lambda obj: obj["size"], reverse=True)
+    batch_size = slices * files_per_slice
+    n_batches = max(1, -(-len(objects) // batch_size))
+    batches = [[] for _ in range(n_batches)]
+    for i, obj in enumerate(objects):
+        batches[i % n_batches].append(obj)
+    return [batch for batch in batches if batch]
+
+
+def write_batch_manifests(s3, objects, manifest_prefix, source, slices, files_per_slice):
+    """ Writes one COPY manifest per batch of objects and returns their s3 uris.
+
+    Args:
+    s3 (obj): Boto3 s3 client.
+    objects (list): The objects as returned by list_objects.
+    manifest_prefix (str): The s3 uri prefix where the manifests are written.
+    source (str): The name of the source, used as the manifest file name.
+    slices (int): The total number of slices of the cluster.
+    files_per_slice (int): The number of files every slice loads in a single COPY.
+    """
+    return [
+        write_manifest(s3, batch, f"{manifest_prefix}/{source}-{i:05d}.manifest")
+        for i, batch in enumerate(batch_objects(objects, slices, files_per_slice))
+    ]
@@ -0,0 +1,111 @@
+"""
+This python file captures the data profile of the loaded tables, used by ddl.py to create the tables of the
+later runs with:
+1. The compression encoding of every column as recommended by ANALYZE COMPRESSION on a sample of COMPROWS rows.
+2. The longest value (in bytes) of every text column, to size the VARCHARs instead of the TEXT default of 256.
+The profile is persisted into a local json file, the tables have to be recreated with create_tables.py to use it.
+"""
+
+import json
+import os
+from datetime import datetime, timezone
+
+from ddl import TABLES, column_encoding, varchar_size
+
+ANALYZE_COMPRESSION_QUERY = "ANALYZE COMPRESSION {table} COMPROWS {comprows};"
+
+ROW_COUNT_QUERY = "SELECT COUNT(*) FROM {table};"
+
+MAX_LENGTH_QUERY = "SELECT {lengths} FROM {table};"
+
+
+def text_columns(table):
+    """ Returns the names of the text columns of a table.
+
+    Args:
+    table (Table): The table.
+    """
+    return [column.name for column in table.columns if column.type.upper().startswith(("TEXT", "VARCHAR", "CHAR"))]
+
+
+def profile_table(db, table, comprows):
+    """ Profiles a single table: the encodings recommended by ANALYZE COMPRESSION and the longest text values.
+    Returns None for an empty table since there is nothing to sample.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    table (Table): The table.
+    comprows (int): The number of rows sampled by ANALYZE COMPRESSION.
+    """
+    rows = db.fetchone(ROW_COUNT_QUERY.format(table=table.name))[0]
+    if not rows:
+        return None
+    columns = {column.name: {} for column in table.columns}
+    compression = db.run(
+        ANALYZE_COMPRESSION_QUERY.format(table=table.name, comprows=comprows), fetch=True, autocommit=True
+    )
+    for _, column, encoding, est_reduction_pct in compression:
+        if column in columns:
+            columns[column].update(encoding=encoding, est_reduction_pct=float(est_reduction_pct))
+    names = text_columns(table)
+    if names:
+        lengths = ", ".join(f"MAX(OCTET_LENGTH({name}))" for name in names)
+        max_lengths = db.fetchone(MAX_LENGTH_QUERY.format(lengths=lengths, table=table.name))
+        for name, max_length in zip(names, max_lengths):
+            columns[name]["max_length"] = max_length or 0
+    return {"rows": rows, "columns": columns}
+
+
+def profile_tables(db, comprows=100000, tables=None):
+    """ Profiles the loaded tables and returns the data profile.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    comprows (int): The number of rows sampled by ANALYZE COMPRESSION.
+    tables (list): The names of the tables, by default all the tables of ddl.py.
+    """
+    profile = {"profiled_at": datetime.now(timezone.utc).isoformat(), "comprows": comprows, "tables": {}}
+    for name in tables or TABLES:
+        table_profile = profile_table(db, TABLES[name], comprows)
+        if table_profile is None:
+            print(f"Table {name} is empty, skipping its profile")
+            continue
+        profile["tables"][name] = table_profile
+        print(f"Profile is captured for {name} ({table_profile['rows']} rows)")
+    return profile
+
+
+def save_profile(path, profile):
+    """ Writes the data profile atomically so that a failed run never leaves a broken file.
+
+    Args:
+    path (str): The path of the profile json file.
+    profile (dict): The data profile as returned by profile_tables.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f, indent=2, sort_keys=True, default=str)
+    os.replace(tmp_path, path)
+
+
+def print_profile(profile):
+    """ Prints the encoding and size of every profiled column next to the default of ddl.py.
+
+    Args:
+    profile (dict): The data profile as returned by profile_tables.
+    """
+    print("--------------------- DATA PROFILE -------------------")
+    print(f"{'column':<36}{'default':>10}{'profiled':>10}{'reduction':>11}{'max bytes':>11}{'type':>16}")
+    for name, table_profile in profile["tables"].items():
+        table = TABLES[name]
+        for column in table.columns:
+            column_profile = table_profile["columns"].get(column.name, {})
+            max_length = column_profile.get("max_length")
+            resized = max_length is not None and column.type.upper() in ("TEXT", "VARCHAR")
+            sized = f"VARCHAR({varchar_size(max_length)})" if resized else column.type
+            print(
+                f"{name + '.' + column.name:<36}{column_encoding(column, table.design):>10}"
+                f"{column_profile.get('encoding', '').upper():>10}"
+                f"{column_profile.get('est_reduction_pct', 0):>10.1f}%"
+                f"{'' if max_length is None else max_length:>11}{sized:>16}"
+            )
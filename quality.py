@@ -0,0 +1,65 @@
+"""
+This python file provides the data-quality gate of etl.py:
+1. The rows rejected by the COPY commands (up to MAXERROR of the QUALITY section) are quarantined into the
+   load_errors table from STL_LOAD_ERRORS, and triaged after the load by table, error code and reason.
+2. The checks of a table are computed together in a single scan of the staged or freshly loaded rows
+   (null keys, duplicate keys, orphan foreign keys) and the run is stopped at the first failing table,
+   before the watermarks move forward.
+"""
+
+from time import perf_counter
+
+from sql_queries import load_errors_report, quality_check_query
+
+
+class DataQualityError(Exception):
+    """ Raised when a data-quality check found failed rows.
+    """
+
+
+def load_error_report(db, since):
+    """ Prints the rows rejected by the COPY commands since the start of the run, grouped by table and reason.
+    Returns the number of rejected rows.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    since (datetime): The start of the run.
+    """
+    rows = db.run(load_errors_report, {"since": since}, fetch=True)
+    rejected = sum(row[3] for row in rows)
+    print("--------------------- LOAD ERRORS --------------------")
+    if not rejected:
+        print("No rows were rejected by the COPY commands")
+        return 0
+    print(f"{'table':<18}{'code':>6}{'rows':>8}  reason (first file:line)")
+    for table_name, err_code, err_reason, count, first_file, first_line in rows:
+        print(f"{table_name:<18}{err_code:>6}{count:>8}  {err_reason.strip()} ({first_file.strip()}:{first_line})")
+    print(f"{rejected} rows were quarantined into load_errors")
+    return rejected
+
+
+def run_checks(db, stage, checks):
+    """ Runs the checks of every table in a single pass per table and prints their results.
+    Raises DataQualityError at the first table with failed rows, the later tables are not checked.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    stage (str): The name of the checked stage, printed in the report.
+    checks (dict): The table name mapped to the FROM clause and the checks of the table, see sql_queries.
+    """
+    print(f"--------------------- QUALITY CHECKS ({stage}) -------")
+    for table, (source, table_checks) in checks.items():
+        started = perf_counter()
+        counts = db.fetchone(quality_check_query(source, table_checks))
+        duration = perf_counter() - started
+        # The sums of an empty selection are NULL.
+        failed = {name: count or 0 for name, count in zip(table_checks, counts)}
+        for name, count in failed.items():
+            print(f"{table:<16}{name:<28}{count:>10}  {'FAILED' if count else 'ok'}")
+        print(f"{table:<16}{'(single pass)':<28}{duration:>9.2f}s")
+        failures = {name: count for name, count in failed.items() if count}
+        if failures:
+            raise DataQualityError(
+                f"The {stage} checks of {table} failed: "
+                + ", ".join(f"{name}={count}" for name, count in failures.items())
+            )
@@ -0,0 +1,296 @@
+"""
+This python file provides the local result cache of the analysis queries (analyse_insertion.py and the notebooks):
+1. Every table has a version stamp in a local json file, bumped by etl.py and create_tables.py once they changed
+   the tables.
+2. A result is cached under the normalized query text, its parameters and the versions of the tables it reads,
+   so that a load invalidates the results of the changed tables and a repeated refresh is served locally.
+3. The cache is bounded in size and evicts the least recently used results, the hits, misses and the query time
+   saved are kept with the cache.
+The rows are pickled to keep their types (Decimal, datetime), the cache directory must therefore not be shared with
+untrusted users.
+"""
+
+import json
+import os
+import pickle
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from time import perf_counter
+from uuid import uuid4
+
+from ddl import TABLES
+from journal import fingerprint
+
+# Stands in for the psycopg2 cursor description of the replayed results.
+CachedColumn = namedtuple("CachedColumn", ["name", "type_code"])
+
+
+def normalize_query(query):
+    """ Returns the query without comments, trailing semicolons and redundant whitespace, lower cased outside of
+    the string literals, so that formatting changes do not miss the cache.
+
+    Args:
+    query (str): The query.
+    """
+    query = re.sub(r"--[^\n]*", " ", query)
+    parts = query.split("'")
+    # The even parts are outside of the string literals.
+    parts = [re.sub(r"\s+", " ", part).lower() if index % 2 == 0 else part for index, part in enumerate(parts)]
+    return "'".join(parts).strip().rstrip(";").strip()
+
+
+def query_tables(query, tables):
+    """ Returns the known tables a query reads from.
+
+    Args:
+    query (str): The query.
+    tables (list): The names of the tables of the warehouse.
+    """
+    names = {name.lower() for name in re.findall(r"\b(?:from|join)\s+(\w+)", query, re.IGNORECASE)}
+    return sorted(name for name in tables if name in names)
+
+
+class TableVersions:
+    """ Persists a version stamp per table into a local json file.
+
+    Args:
+    path (str): The path of the json file holding the versions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+
+    def load(self):
+        """ Loads the versions, an empty dictionary is returned when no table was versioned before.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def bump(self, tables):
+        """ Gives the tables a new version and writes the versions atomically.
+
+        Args:
+        tables (list): The names of the changed tables.
+        """
+        with self._lock:
+            versions = self.load()
+            for table in tables:
+                versions[table] = f"{datetime.now(timezone.utc).isoformat()}-{uuid4().hex[:8]}"
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(versions, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+    def get(self, tables):
+        """ Returns the versions of the tables, the tables without a version are versioned first since their
+        state is unknown.
+
+        Args:
+        tables (list): The names of the tables.
+        """
+        with self._lock:
+            versions = self.load()
+            missing = [table for table in tables if table not in versions]
+            if missing:
+                self.bump(missing)
+                versions = self.load()
+        return {table: versions[table] for table in tables}
+
+
+class ResultCache:
+    """ Caches the results of the analysis queries on disk, keyed on the query and the versions of its tables.
+
+    Args:
+    directory (str): The directory of the cached results and of the cache index.
+    versions (TableVersions): The version stamps of the tables.
+    tables (list): The names of the tables of the warehouse.
+    max_bytes (int): The size of the cache, the least recently used results are evicted beyond it.
+    """
+
+    def __init__(self, directory, versions, tables, max_bytes=256 * 1024 ** 2):
+        self.directory = directory
+        self.versions = versions
+        self.tables = list(tables)
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.session = {"hits": 0, "misses": 0, "saved_s": 0.0}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def load_index(self):
+        """ Loads the cached entries and the statistics of the cache.
+        """
+        if not os.path.exists(self.index_path):
+            return {"entries": {}, "stats": {"hits": 0, "misses": 0, "saved_s": 0.0}}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _save_index(self, index):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def key(self, query, params=None):
+        """ Returns the cache key of a query: the normalized query, its parameters and the versions of its tables.
+
+        Args:
+        query (str): The query.
+        params (dict): The query parameters.
+        """
+        return fingerprint(normalize_query(query), params, self.versions.get(query_tables(query, self.tables)))
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pickle")
+
+    def _replay(self, key, entry, write, batch_size):
+        description = [CachedColumn(*column) for column in entry["description"]]
+        with open(self._path(key), "rb") as f:
+            batches = 0
+            while True:
+                try:
+                    rows = pickle.load(f)
+                except EOFError:
+                    break
+                for start in range(0, len(rows), batch_size):
+                    write(description, rows[start:start + batch_size])
+                    batches += 1
+            if not batches:
+                write(description, [])
+
+    def stream(self, db, query, write, params=None, batch_size=10000, refresh=False):
+        """ Hands the rows of a query to write in batches like Warehouse.stream, from the cache when the tables
+        did not change since the result was cached. Otherwise the query is streamed from the cluster and its rows
+        are cached at the same time. Returns the number of rows.
+
+        Args:
+        db (Warehouse): The shared connection layer.
+        query (str): The query.
+        write (callable): Called with the cursor description and every batch of rows.
+        params (dict): The query parameters.
+        batch_size (int): The number of rows fetched at once.
+        refresh (bool): Run the query on the cluster even when its result is cached.
+        """
+        key = self.key(query, params)
+        with self._lock:
+            index = self.load_index()
+            entry = index["entries"].get(key)
+            if entry is not None and not refresh and os.path.exists(self._path(key)):
+                entry["last_used"] = datetime.now(timezone.utc).isoformat()
+                for stats in (index["stats"], self.session):
+                    stats["hits"] += 1
+                    stats["saved_s"] = round(stats["saved_s"] + entry["duration_s"], 3)
+                self._save_index(index)
+            else:
+                entry = None
+        if entry is not None:
+            self._replay(key, entry, write, batch_size)
+            return entry["rows"]
+
+        tmp_path = f"{self._path(key)}.{uuid4().hex}.tmp"
+        state = {"description": None, "bytes": 0}
+
+        def tee(description, rows):
+            write(description, rows)
+            state["description"] = [(column.name, column.type_code) for column in description]
+            if rows and state["bytes"] <= self.max_bytes:
+                with open(tmp_path, "ab") as f:
+                    pickle.dump(rows, f)
+                    state["bytes"] = f.tell()
+
+        started = perf_counter()
+        try:
+            n_rows = db.stream(query, tee, params, batch_size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        duration = perf_counter() - started
+        with self._lock:
+            index = self.load_index()
+            index["stats"]["misses"] += 1
+            self.session["misses"] += 1
+            if state["bytes"] <= self.max_bytes:
+                if os.path.exists(tmp_path):
+                    os.replace(tmp_path, self._path(key))
+                else:
+                    open(self._path(key), "wb").close()
+                index["entries"][key] = {
+                    "query": normalize_query(query)[:200],
+                    "description": state["description"],
+                    "rows": n_rows,
+                    "bytes": state["bytes"],
+                    "duration_s": round(duration, 3),
+                    "last_used": datetime.now(timezone.utc).isoformat(),
+                }
+                self._evict(index)
+            elif os.path.exists(tmp_path):
+                # A result larger than the whole cache is never cached.
+                os.remove(tmp_path)
+            self._save_index(index)
+        return n_rows
+
+    def fetch(self, db, query, params=None):
+        """ Returns all the rows of a query, from the cache when possible, for the notebooks.
+
+        Args:
+        db (Warehouse): The shared connection layer.
+        query (str): The query.
+        params (dict): The query parameters.
+        """
+        rows = []
+        self.stream(db, query, lambda description, batch: rows.extend(batch), params)
+        return rows
+
+    def _evict(self, index):
+        entries = index["entries"]
+        total = sum(entry["bytes"] for entry in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key]["bytes"]
+            del entries[key]
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+
+    def report(self):
+        """ Prints the hits, misses and query time saved by the cache in this session and since it was created.
+        """
+        index = self.load_index()
+        size = sum(entry["bytes"] for entry in index["entries"].values())
+        print("--------------------- RESULT CACHE -------------------")
+        for label, stats in (("session", self.session), ("total", index["stats"])):
+            lookups = stats["hits"] + stats["misses"]
+            print(
+                f"{label:<8} hits {stats['hits']}, misses {stats['misses']}"
+                f" (hit rate {stats['hits'] / lookups if lookups else 0:.0%}), saved {stats['saved_s']:.2f}s of query time"
+            )
+        print(f"{len(index['entries'])} results cached in {size / 1024 ** 2:.1f}MB of {self.max_bytes / 1024 ** 2:.0f}MB")
+
+
+def from_config(config):
+    """ Creates the result cache with the CACHE section of dwh.cfg.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    return ResultCache(
+        config.get("CACHE", "DIR", fallback=".result_cache"),
+        table_versions(config),
+        TABLES,
+        int(config.getfloat("CACHE", "MAX_MB", fallback=256) * 1024 ** 2),
+    )
+
+
+def table_versions(config):
+    """ Returns the table version stamps of the VERSIONS_FILE of the CACHE section of dwh.cfg.
+
+    Args:
+    config (ConfigParser): The parsed dwh.cfg configuration.
+    """
+    return TableVersions(config.get("CACHE", "VERSIONS_FILE", fallback="table_versions.json"))
@@ -0,0 +1,118 @@
+"""
+This python file provides a small dependency-aware scheduler, which runs the insert steps of the ETL at the same time
+over the pool of the shared connection layer once the steps they depend on are completed, and reports the critical path.
+"""
+
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
+
+
+def target_table(query):
+    """ Returns the table a insert or upsert query writes into, the upserts insert from their temp table last.
+
+    Args:
+    query (str): The insert or upsert query.
+    """
+    return re.findall(r"INSERT INTO (\w+)", query)[-1]
+
+
+def run_step(db, name, query, params=None, idempotent=True):
+    """ Runs a single step in its own transaction on a connection of the shared pool, retried on transient errors.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    name (str): The name of the step.
+    query (str): The query of the step.
+    params (dict): The query parameters.
+    idempotent (bool): The step can be replayed after it was committed.
+    """
+    started = perf_counter()
+    db.run(query, params, idempotent=idempotent)
+    finished = perf_counter()
+    print(f"Step {name} is completed in {finished - started:.2f}s")
+    return started, finished
+
+
+def run_dag(db, steps, dependencies, concurrency, params=None, on_done=None, non_idempotent=()):
+    """ Runs the steps as soon as all the steps they depend on are completed, at most concurrency at the same time.
+    A failed step stops the scheduling of new steps and is raised once the running steps are completed.
+
+    Args:
+    db (Warehouse): The shared connection layer, its pool should hold at least concurrency connections.
+    steps (dict): The step name mapped to its query.
+    dependencies (dict): The step name mapped to the names of the steps it depends on.
+    concurrency (int): The maximum number of steps running at the same time.
+    params (dict): The query parameters passed to every step.
+    on_done (callable): Called with the name and (started, finished) times of every completed step.
+    non_idempotent (set): The names of the steps which are not retried once they may have been committed.
+    """
+    pending = dict(steps)
+    timings = {}
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while pending or running:
+            ready = [
+                name
+                for name in pending
+                if all(dep in timings for dep in dependencies.get(name, []) if dep in steps)
+            ]
+            if not ready and not running:
+                raise ValueError(f"The steps {sorted(pending)} have cyclic dependencies")
+            for name in ready:
+                step = executor.submit(run_step, db, name, pending.pop(name), params, name not in non_idempotent)
+                running[step] = name
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    # The steps already running are still recorded when they complete.
+                    error = error or future.exception()
+                    pending.clear()
+                    continue
+                timings[name] = future.result()
+                if on_done is not None:
+                    on_done(name, timings[name])
+    if error is not None:
+        raise error
+    return timings
+
+
+def critical_path(timings, dependencies):
+    """ Returns the chain of steps which determined the total run time, starting from the step finishing last
+    and walking back through the dependency which finished last.
+
+    Args:
+    timings (dict): The step name mapped to its (started, finished) times as returned by run_dag.
+    dependencies (dict): The step name mapped to the names of the steps it depends on.
+    """
+    if not timings:
+        return []
+    path = [max(timings, key=lambda name: timings[name][1])]
+    while True:
+        deps = [dep for dep in dependencies.get(path[-1], []) if dep in timings]
+        if not deps:
+            break
+        path.append(max(deps, key=lambda name: timings[name][1]))
+    return list(reversed(path))
+
+
+def report(timings, dependencies):
+    """ Prints the duration of every step, the total run time and the critical path.
+
+    Args:
+    timings (dict): The step name mapped to its (started, finished) times as returned by run_dag.
+    dependencies (dict): The step name mapped to the names of the steps it depends on.
+    """
+    if not timings:
+        return
+    start = min(started for started, _ in timings.values())
+    end = max(finished for _, finished in timings.values())
+    print("--------------------- STEPS --------------------------")
+    for name, (started, finished) in sorted(timings.items(), key=lambda item: item[1][0]):
+        print(f"{name:<12} start {started - start:8.2f}s  duration {finished - started:8.2f}s")
+    path = critical_path(timings, dependencies)
+    path_time = sum(timings[name][1] - timings[name][0] for name in path)
+    print(f"Total time {end - start:.2f}s")
+    print(f"Critical path {' -> '.join(path)} ({path_time:.2f}s)")
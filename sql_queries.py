@@ -5,11 +5,11 @@ This python file provides the queries for the ingestion of the data from:
 3. Verify by analyzing the fact and dimension tables via queries.
 """
 
-import configparser
+from db import read_config
+from ddl import TABLES, apply_profile, create_table_query, load_profile
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read("dwh.cfg")
+config = read_config()
 
 
 # Region
@@ -22,6 +22,16 @@ IAM_ARN = config.get("IAM_ROLE", "ARN")
 LOG_DATA = config.get("S3", "LOG_DATA")
 LOG_DATA_PATH = config.get("S3", "LOG_JSONPATH")
 SONG_DATA = config.get("S3", "SONG_DATA")
+SONG_DATA_COMPACTED = config.get("S3", "SONG_DATA_COMPACTED", fallback="")
+SONG_DATA_COMPACTED_FORMAT = config.get("S3", "SONG_DATA_COMPACTED_FORMAT", fallback="json")
+MANIFEST_PREFIX = config.get("S3", "MANIFEST_PREFIX", fallback="")
+LAKE_PREFIX = config.get("LAKE", "PREFIX", fallback="").strip("'\"").rstrip("/")
+
+# Rejected rows tolerated per COPY, they are quarantined into load_errors from STL_LOAD_ERRORS.
+MAXERROR = config.getint("QUALITY", "MAXERROR", fallback=0)
+
+# Data profile captured by profiling.py (VARCHAR sizes and encodings), empty before the first profile load.
+PROFILE = load_profile(config.get("ETL", "PROFILE_FILE", fallback="table_profile.json"))
 
 
 # DROP TABLES
@@ -33,135 +43,197 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+user_agent_table_drop = "DROP TABLE IF EXISTS user_agents;"
+daily_platform_plays_table_drop = "DROP TABLE IF EXISTS daily_platform_plays;"
+daily_level_plays_table_drop = "DROP TABLE IF EXISTS daily_level_plays;"
+daily_user_plays_table_drop = "DROP TABLE IF EXISTS daily_user_plays;"
+daily_artist_plays_table_drop = "DROP TABLE IF EXISTS daily_artist_plays;"
+load_errors_table_drop = "DROP TABLE IF EXISTS load_errors;"
 
 # CREATE TABLES
 
-staging_events_table_create = """
-CREATE TABLE IF NOT EXISTS staging_events (
-    artist TEXT,
-    auth TEXT,
-    first_name TEXT,
-    gender TEXT,
-    item_in_session INT,
-    last_name TEXT,
-    length FLOAT,
-    level TEXT,
-    location TEXT,
-    method TEXT,
-    page TEXT,
-    registration VARCHAR,
-    session_id INT,
-    song TEXT,
-    status INT,
-    ts VARCHAR,
-    user_agent TEXT,
-    user_id INT
-);
-"""
+# The columns and the physical design of the tables are described in ddl.py, the text columns are sized and the
+# encodings chosen from the data profile once it is captured.
+staging_events_table_create = create_table_query(apply_profile(TABLES["staging_events"], PROFILE))
+staging_songs_table_create = create_table_query(apply_profile(TABLES["staging_songs"], PROFILE))
+songplay_table_create = create_table_query(apply_profile(TABLES["songplays"], PROFILE))
+user_table_create = create_table_query(apply_profile(TABLES["users"], PROFILE))
+song_table_create = create_table_query(apply_profile(TABLES["songs"], PROFILE))
+artist_table_create = create_table_query(apply_profile(TABLES["artists"], PROFILE))
+time_table_create = create_table_query(apply_profile(TABLES["time"], PROFILE))
+user_agent_table_create = create_table_query(apply_profile(TABLES["user_agents"], PROFILE))
+daily_platform_plays_table_create = create_table_query(apply_profile(TABLES["daily_platform_plays"], PROFILE))
+daily_level_plays_table_create = create_table_query(apply_profile(TABLES["daily_level_plays"], PROFILE))
+daily_user_plays_table_create = create_table_query(apply_profile(TABLES["daily_user_plays"], PROFILE))
+daily_artist_plays_table_create = create_table_query(apply_profile(TABLES["daily_artist_plays"], PROFILE))
+load_errors_table_create = create_table_query(TABLES["load_errors"])
 
-staging_songs_table_create = """
-CREATE TABLE IF NOT EXISTS staging_songs (
-    artist_id TEXT,
-    artist_latitude FLOAT,
-    artist_location TEXT,
-    artist_longitude FLOAT,
-    artist_name TEXT,
-    duration FLOAT,
-    num_songs INT,
-    song_id TEXT,
-    title TEXT,
-    year INT
-);
-"""
+# STAGING TABLES
 
-songplay_table_create = """
-CREATE TABLE IF NOT EXISTS songplays (
-    songplay_id INT IDENTITY(0,1) PRIMARY KEY,
-    start_time TIMESTAMP SORTKEY DISTKEY NOT NULL,
-    user_id INT NOT NULL REFERENCES users(user_id),
-    level TEXT,
-    song_id TEXT NOT NULL REFERENCES songs(song_id),
-    artist_id TEXT NOT NULL REFERENCES artists(artist_id),
-    session_id INT NOT NULL,
-    location TEXT,
-    user_agent TEXT
-);
-"""
+# The COPY commands list the loaded columns, the match_key and start_time are filled by the enrichment step after the
+# load. ts is loaded as a BIGINT through the same jsonpaths, so the inserts neither cast it nor sort it as a string.
+# registration is a float in the log data (1540919166796.0), which COPY rejects for a BIGINT column.
+# Every column declares its ENCODE, so COPY would never apply the automatic compression anyway: compupdate off only
+# skips the sampling. The encodings are chosen by ANALYZE COMPRESSION in the profile load of profiling.py instead.
+staging_events_columns = (
+    "(artist, auth, first_name, gender, item_in_session, last_name, length, level, location, method, page, "
+    "registration, session_id, song, status, ts, user_agent, user_id)"
+)
+staging_songs_columns = (
+    "(artist_id, artist_latitude, artist_location, artist_longitude, artist_name, duration, num_songs, song_id, "
+    "title, year)"
+)
 
-user_table_create = """
-CREATE TABLE IF NOT EXISTS users (
-    user_id INT NOT NULL PRIMARY KEY,
-    first_name TEXT,
-    last_name TEXT,
-    gender TEXT,
-    level TEXT
-);
-"""
+# The rows rejected by a COPY (at most MAXERROR, beyond that the COPY fails) are copied from STL_LOAD_ERRORS into the
+# quarantine table right after it. pg_last_copy_id() is scoped to the session, so the insert runs in the same execute.
+def quarantined(copy_query, table):
+    """ Returns the COPY query followed by the insert of its rejected rows into the load_errors quarantine table.
 
-song_table_create = """
-CREATE TABLE IF NOT EXISTS songs (
-    song_id TEXT NOT NULL PRIMARY KEY,
-    title TEXT,
-    artist_id TEXT NOT NULL DISTKEY REFERENCES artists(artist_id),
-    year INT,
-    duration FLOAT
-);
+    Args:
+    copy_query (str): The COPY query.
+    table (str): The staging table loaded by the COPY.
+    """
+    return copy_query + f"""
+INSERT INTO load_errors (loaded_at, query_id, table_name, filename, line_number, colname, err_code, err_reason,
+                         raw_line, raw_field_value)
+SELECT GETDATE(), query, '{table}', TRIM(filename), line_number, TRIM(colname), err_code, TRIM(err_reason),
+TRIM(raw_line), TRIM(raw_field_value)
+FROM stl_load_errors
+WHERE query = pg_last_copy_id();
 """
 
-artist_table_create = """
-CREATE TABLE IF NOT EXISTS artists (
-    artist_id TEXT NOT NULL PRIMARY KEY,
-    name TEXT,
-    location TEXT,
-    latitude FLOAT,
-    longitude FLOAT
-);
-"""
 
-time_table_create = """
-CREATE TABLE IF NOT EXISTS time (
-    start_time TIMESTAMP NOT NULL SORTKEY DISTKEY PRIMARY KEY,
-    hour INT,
-    day INT,
-    week INT,
-    month INT,
-    year INT,
-    weekday INT
-);
-"""
+staging_events_copy = quarantined(
+    """
+copy staging_events {} from {}
+    iam_role '{}'
+    json {} maxerror {} compupdate off region '{}';
+""".format(staging_events_columns, LOG_DATA, IAM_ARN, LOG_DATA_PATH, MAXERROR, REGION),
+    "staging_events",
+)
 
-# STAGING TABLES
+staging_songs_copy = quarantined(
+    """
+copy staging_songs {} from {}
+    iam_role '{}'
+    TRUNCATECOLUMNS json 'auto' maxerror {} compupdate off region '{}';
+""".format(staging_songs_columns, SONG_DATA, IAM_ARN, MAXERROR, REGION),
+    "staging_songs",
+)
 
-staging_events_copy = (
+# Compacted song data written by compact_songs.py: gzipped JSON lines or Parquet (columns in the staging_songs order).
+# MAXERROR does not apply to the columnar formats, a Parquet COPY fails on the first rejected row.
+compacted_songs_format = {
+    "json": "TRUNCATECOLUMNS json 'auto' GZIP maxerror {} compupdate off region '{}'".format(MAXERROR, REGION),
+    "parquet": "FORMAT AS PARQUET",
+}[SONG_DATA_COMPACTED_FORMAT]
+
+staging_songs_compacted_copy = quarantined(
     """
-copy staging_events from {}
+copy staging_songs {} from {}
     iam_role '{}'
-    json {} compupdate off region '{}';
-"""
-).format(LOG_DATA, IAM_ARN, LOG_DATA_PATH, REGION)
+    {};
+""".format(staging_songs_columns, SONG_DATA_COMPACTED, IAM_ARN, compacted_songs_format),
+    "staging_songs",
+)
+
+staging_songs_compacted_manifest_copy = quarantined(
+    """
+copy staging_songs {} from '{{}}'
+    iam_role '{}'
+    manifest {};
+""".format(staging_songs_columns, IAM_ARN, compacted_songs_format),
+    "staging_songs",
+)
+
+# Incremental staging: the staging tables only hold the delta, the new files are listed in a manifest.
+staging_events_truncate = "TRUNCATE staging_events;"
+staging_songs_truncate = "TRUNCATE staging_songs;"
+
+staging_events_manifest_copy = quarantined(
+    """
+copy staging_events {} from '{{}}'
+    iam_role '{}'
+    json {} manifest maxerror {} compupdate off region '{}';
+""".format(staging_events_columns, IAM_ARN, LOG_DATA_PATH, MAXERROR, REGION),
+    "staging_events",
+)
 
-staging_songs_copy = (
+staging_songs_manifest_copy = quarantined(
     """
-copy staging_songs from {}
+copy staging_songs {} from '{{}}'
     iam_role '{}'
-    TRUNCATECOLUMNS json 'auto' compupdate off region '{}';
+    TRUNCATECOLUMNS json 'auto' manifest maxerror {} compupdate off region '{}';
+""".format(staging_songs_columns, IAM_ARN, MAXERROR, REGION),
+    "staging_songs",
+)
+
+staging_events_max_ts = """
+SELECT MAX(ts) FROM staging_events;
 """
-).format(SONG_DATA, IAM_ARN, REGION)
+
+# MATCH KEY ENRICHMENT
+
+# The songplays join used to compare artist, title and a FLOAT equality on length = duration, which missed the
+# matches differing only in case, surrounding blanks or float noise. It joins on a normalized key instead: the trimmed
+# and lower cased artist and title with the duration rounded to a tenth of a second, hashed with MD5. The key is NULL
+# when any part is NULL. The key of a song is computed once from its staged artist_name when the song is upserted
+# and stored in songs, the key of an event is filled into staging_events after the load.
+match_key_expression = (
+    "MD5(LOWER(TRIM({artist})) || '|' || LOWER(TRIM({title})) || '|' "
+    "|| CAST(CAST(ROUND({duration} * 10) AS BIGINT) AS VARCHAR))"
+)
+
+# The epoch conversion of the typed ts (epoch milliseconds) is materialized once into start_time, truncated to the
+# second like the time dimension, which the songplays insert, the time dimension and the rollups read instead of
+# deriving it again. Both columns are set in the same pass over the table, only the NextSong events get a key. The
+# update writes every row again, so the events are then distributed on their key like the songs they are joined to.
+def staging_events_enrich_query(table="staging_events"):
+    """ Returns the update filling start_time and the match key of the staged events.
+
+    Args:
+    table (str): The staging table of the events, the backfills stage into their own tables.
+    """
+    return """
+UPDATE {}
+SET start_time = timestamp 'epoch' + ts / 1000 * interval '1 second',
+match_key = CASE WHEN page = 'NextSong' THEN {} END;
+""".format(table, match_key_expression.format(artist="artist", title="song", duration="length"))
+
+
+staging_events_match_key_update = staging_events_enrich_query()
+
+staging_songs_match_key = match_key_expression.format(artist="artist_name", title="title", duration="duration")
+
+# Number of NextSong events matched by the exact three column join and by the match key.
+songplay_match_report = """
+SELECT
+    (SELECT COUNT(*) FROM staging_events WHERE page = 'NextSong') AS next_song_events,
+    (SELECT COUNT(*) FROM staging_events se
+      WHERE se.page = 'NextSong'
+        AND EXISTS (SELECT 1 FROM staging_songs ss
+                     WHERE se.artist = ss.artist_name AND se.song = ss.title AND se.length = ss.duration)
+    ) AS exact_join_matches,
+    (SELECT COUNT(*) FROM staging_events se
+      WHERE se.page = 'NextSong'
+        AND EXISTS (SELECT 1 FROM staging_songs WHERE {} = se.match_key)
+    ) AS match_key_matches;
+""".format(staging_songs_match_key)
 
 # FINAL TABLES
 
 songplay_table_insert = """
 INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-SELECT DISTINCT timestamp 'epoch' + cast(ts AS bigint)/1000 * interval '1 second' as start_time,
+SELECT DISTINCT se.start_time as start_time,
 se.user_id as user_id,
 se.level as level,
-ss.song_id as song_id,
-ss.artist_id as artist_id,
+s.song_id as song_id,
+s.artist_id as artist_id,
 se.session_id as session_id,
 se.location as location,
 se.user_agent as user_agent
 FROM staging_events se
-JOIN staging_songs ss ON (se.artist = ss.artist_name AND se.song = ss.title AND se.length = ss.duration)
+JOIN songs s ON (se.match_key = s.match_key)
 WHERE se.page = 'NextSong';
 """
 # Older working approach: However, still keeps the duplicate user_id because level can change as the user time evolves.
@@ -174,8 +246,26 @@ WHERE se.page = 'NextSong';
 ##########################################################
 
 # New Approach as per review:
+#user_table_insert = """
+#INSERT INTO users (user_id, first_name, last_name, gender, level)
+#with unique_staging_events as (
+#    SELECT user_id, first_name, last_name, gender, level, ROW_NUMBER() OVER(PARTITION BY user_id ORDER BY ts DESC) AS rank
+#     FROM staging_events 
+#    WHERE user_id IS NOT NULL
+#)
+#SELECT user_id, first_name, last_name, gender, level
+# FROM unique_staging_events
+#WHERE rank=1;
+#"""
+##########################################################
+
+# Upsert approach: Redshift does not enforce the primary keys, so a rerun used to duplicate the dimensions.
+# The deduplicated rows are staged into a temp table, the matching keys are deleted and the staged rows inserted,
+# all in the same transaction. The users keep the level of their latest event (ROW_NUMBER() by ts).
 user_table_insert = """
-INSERT INTO users (user_id, first_name, last_name, gender, level)
+CREATE TEMP TABLE users_stage (LIKE users);
+
+INSERT INTO users_stage (user_id, first_name, last_name, gender, level)
 with unique_staging_events as (
     SELECT user_id, first_name, last_name, gender, level, ROW_NUMBER() OVER(PARTITION BY user_id ORDER BY ts DESC) AS rank
      FROM staging_events 
@@ -184,33 +274,527 @@ with unique_staging_events as (
 SELECT user_id, first_name, last_name, gender, level
  FROM unique_staging_events
 WHERE rank=1;
+
+DELETE FROM users USING users_stage WHERE users.user_id = users_stage.user_id;
+
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level FROM users_stage;
+
+DROP TABLE users_stage;
 """
 
 
 song_table_insert = """
-INSERT INTO songs (song_id, title, artist_id, year, duration)
-SELECT DISTINCT(song_id) as song_id, title, artist_id, year, duration
-FROM staging_songs;
-"""
+CREATE TEMP TABLE songs_stage (LIKE songs);
+
+INSERT INTO songs_stage (song_id, title, artist_id, year, duration, match_key)
+with unique_staging_songs as (
+    SELECT song_id, title, artist_id, year, duration, {} AS match_key,
+    ROW_NUMBER() OVER(PARTITION BY song_id ORDER BY title, artist_id, year, duration) AS rank
+     FROM staging_songs
+    WHERE song_id IS NOT NULL
+)
+SELECT song_id, title, artist_id, year, duration, match_key
+ FROM unique_staging_songs
+WHERE rank=1;
+
+DELETE FROM songs USING songs_stage WHERE songs.song_id = songs_stage.song_id;
+
+INSERT INTO songs (song_id, title, artist_id, year, duration, match_key)
+SELECT song_id, title, artist_id, year, duration, match_key FROM songs_stage;
+
+DROP TABLE songs_stage;
+""".format(staging_songs_match_key)
 
 artist_table_insert = """
+CREATE TEMP TABLE artists_stage (LIKE artists);
+
+INSERT INTO artists_stage (artist_id, name, location, latitude, longitude)
+with unique_staging_artists as (
+    SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude,
+    ROW_NUMBER() OVER(PARTITION BY artist_id ORDER BY artist_name, artist_location, artist_latitude, artist_longitude) AS rank
+     FROM staging_songs
+    WHERE artist_id IS NOT NULL
+)
+SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+ FROM unique_staging_artists
+WHERE rank=1;
+
+DELETE FROM artists USING artists_stage WHERE artists.artist_id = artists_stage.artist_id;
+
 INSERT INTO artists (artist_id, name, location, latitude, longitude)
-SELECT DISTINCT(artist_id) as artist_id, artist_name, artist_location, artist_latitude, artist_longitude
-FROM staging_songs;
+SELECT artist_id, name, location, latitude, longitude FROM artists_stage;
+
+DROP TABLE artists_stage;
 """
 
-time_table_insert = """
+# The time dimension holds the start times of the songplays. It is generated from a calendar instead of a DISTINCT
+# over the events: the days between the first and the last new songplay (their day, week, month, year and weekday
+# extracted once per day) crossed with the seconds of a day, from a cross join of digits (up to 10000 days). The dense
+# calendar used to write every second of the range, 86400 rows per day whatever the number of events, so it is limited
+# by a semi-join on the start times of songplays, which reads the range through the sort key of songplays instead of
+# scanning the staged events again. It runs once songplays is inserted, and only the missing keys are inserted.
+def time_table_query(where=""):
+    """ Returns the insert of the missing keys of the time dimension for the start times of the new songplays.
+
+    Args:
+    where (str): The filter of the new songplays, for example the watermark of the incremental runs.
+    """
+    digits = "\n    UNION ALL ".join(f"SELECT {digit} AS d" for digit in range(10))
+    return f"""
 INSERT INTO time (start_time, hour, day, week, month, year, weekday)
-SELECT DISTINCT timestamp 'epoch' + cast(ts AS bigint)/1000 * interval '1 second' as start_time,
-EXTRACT(hour from start_time) as hour,
-EXTRACT(day from start_time) as day,
-EXTRACT(week from start_time) as week,
-EXTRACT(month from start_time) as month,
-EXTRACT(year from start_time) as year,
-EXTRACT(dayofweek from start_time) as weekday
-FROM staging_events;
+WITH digits AS (
+    {digits}
+),
+new_range AS (
+    SELECT MIN(start_time) AS first_time, MAX(start_time) AS last_time
+    FROM songplays
+    {where}
+),
+calendar AS (
+    SELECT day_start,
+    EXTRACT(day from day_start) as day,
+    EXTRACT(week from day_start) as week,
+    EXTRACT(month from day_start) as month,
+    EXTRACT(year from day_start) as year,
+    EXTRACT(dayofweek from day_start) as weekday
+    FROM (
+        SELECT DATEADD(day, d1.d + 10 * d2.d + 100 * d3.d + 1000 * d4.d, TRUNC(r.first_time)) AS day_start
+        FROM new_range r, digits d1, digits d2, digits d3, digits d4
+        WHERE d1.d + 10 * d2.d + 100 * d3.d + 1000 * d4.d <= DATEDIFF(day, TRUNC(r.first_time), TRUNC(r.last_time))
+    ) days
+),
+seconds AS (
+    SELECT d1.d + 10 * d2.d + 100 * d3.d + 1000 * d4.d + 10000 * d5.d AS second_of_day
+    FROM digits d1, digits d2, digits d3, digits d4, digits d5
+    WHERE d1.d + 10 * d2.d + 100 * d3.d + 1000 * d4.d + 10000 * d5.d < 86400
+),
+new_times AS (
+    SELECT DATEADD(second, s.second_of_day, c.day_start) AS start_time,
+    s.second_of_day / 3600 as hour,
+    c.day, c.week, c.month, c.year, c.weekday
+    FROM calendar c
+    CROSS JOIN seconds s
+)
+SELECT nt.start_time, nt.hour, nt.day, nt.week, nt.month, nt.year, nt.weekday
+FROM new_times nt
+JOIN new_range r ON (nt.start_time BETWEEN r.first_time AND r.last_time)
+WHERE EXISTS (
+    SELECT 1 FROM songplays sp
+    WHERE sp.start_time = nt.start_time
+    AND sp.start_time BETWEEN (SELECT first_time FROM new_range) AND (SELECT last_time FROM new_range)
+)
+AND NOT EXISTS (
+    SELECT 1 FROM time t
+    WHERE t.start_time = nt.start_time
+    AND t.start_time BETWEEN (SELECT first_time FROM new_range) AND (SELECT last_time FROM new_range)
+);
 """
 
+
+time_table_insert = time_table_query()
+
+# Incremental approach: the staging tables only hold the new files, so the dimension upserts above already merge
+# only the new rows. The events are additionally filtered on the log data watermark (last_ts) and, like the full
+# insert, joined to the songs dimension on the match key it stores.
+songplay_table_incremental_insert = """
+INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT DISTINCT se.start_time as start_time,
+se.user_id as user_id,
+se.level as level,
+s.song_id as song_id,
+s.artist_id as artist_id,
+se.session_id as session_id,
+se.location as location,
+se.user_agent as user_agent
+FROM staging_events se
+JOIN songs s ON (se.match_key = s.match_key)
+WHERE se.page = 'NextSong'
+AND se.ts > %(last_ts)s;
+"""
+
+# The start times are truncated to the second, so the second of the watermark is included.
+time_table_incremental_insert = time_table_query(
+    "WHERE start_time >= timestamp 'epoch' + %(last_ts)s / 1000 * interval '1 second'"
+)
+
+# USER AGENTS AND ROLLUPS
+
+# The user agents are parsed once when they are first seen instead of a LIKE '%...%' scan of songplays per question.
+# The order of the checks matters: the iPhone agents contain "like Mac OS X" and the Chrome agents contain "Safari".
+# STRPOS is used instead of LIKE so that the queries stay free of % signs when run with the incremental parameters.
+user_agent_os_expression = """CASE
+    WHEN STRPOS(user_agent, 'Windows') > 0 THEN 'Windows'
+    WHEN STRPOS(user_agent, 'iPhone') > 0 OR STRPOS(user_agent, 'iPad') > 0 THEN 'iOS'
+    WHEN STRPOS(user_agent, 'Android') > 0 THEN 'Android'
+    WHEN STRPOS(user_agent, 'Mac OS') > 0 THEN 'Mac OS'
+    WHEN STRPOS(user_agent, 'Linux') > 0 THEN 'Linux'
+    ELSE 'Other'
+END"""
+user_agent_browser_expression = """CASE
+    WHEN STRPOS(user_agent, 'Edge') > 0 THEN 'Edge'
+    WHEN STRPOS(user_agent, 'Chrome') > 0 THEN 'Chrome'
+    WHEN STRPOS(user_agent, 'Firefox') > 0 THEN 'Firefox'
+    WHEN STRPOS(user_agent, 'MSIE') > 0 OR STRPOS(user_agent, 'Trident') > 0 THEN 'Internet Explorer'
+    WHEN STRPOS(user_agent, 'Safari') > 0 THEN 'Safari'
+    ELSE 'Other'
+END"""
+
+def user_agent_insert_query(source="staging_events"):
+    """ Returns the insert of the user agents of the staged events which are not parsed yet.
+
+    Args:
+    source (str): The staging table of the events.
+    """
+    return f"""
+INSERT INTO user_agents (user_agent, os, browser)
+SELECT user_agent,
+{user_agent_os_expression} AS os,
+{user_agent_browser_expression} AS browser
+FROM (
+    SELECT DISTINCT user_agent
+    FROM {source}
+    WHERE user_agent IS NOT NULL
+) new_agents
+WHERE NOT EXISTS (SELECT 1 FROM user_agents ua WHERE ua.user_agent = new_agents.user_agent);
+"""
+
+
+user_agent_table_insert = user_agent_insert_query()
+
+# The rollups are refreshed for the days of the staged events only: those days are recomputed completely from
+# songplays, which also holds the rows of the earlier loads of the same day. The range on start_time lets the
+# sort key of songplays skip the other days, so the refresh does not grow with the fact table.
+rollup_days_query = """
+SELECT DISTINCT TRUNC(start_time) AS day
+FROM {source}
+WHERE page = 'NextSong'
+"""
+
+
+def rollup_refresh_query(table, dimensions, measures, joins="", source="staging_events"):
+    """ Returns the query refreshing the days of the staged events in a daily rollup of songplays.
+
+    Args:
+    table (str): The rollup table.
+    dimensions (dict): The grouping columns of the rollup mapped to their expression.
+    measures (dict): The aggregated columns of the rollup mapped to their expression.
+    joins (str): The joins of songplays (sp) to the dimensions the grouping expressions read.
+    source (str): The staging table of the events.
+    """
+    columns = ", ".join(["day", *dimensions, *measures])
+    expressions = ",\n".join(
+        ["TRUNC(sp.start_time) AS day"]
+        + [f"{expression} AS {name}" for name, expression in {**dimensions, **measures}.items()]
+    )
+    group_by = ", ".join(str(position) for position in range(1, len(dimensions) + 2))
+    return f"""
+CREATE TEMP TABLE {table}_days AS {rollup_days_query.format(source=source).strip()};
+
+DELETE FROM {table} USING {table}_days d WHERE {table}.day = d.day;
+
+INSERT INTO {table} ({columns})
+SELECT {expressions}
+FROM songplays sp
+{joins}
+WHERE sp.start_time >= (SELECT MIN(day) FROM {table}_days)
+AND sp.start_time < (SELECT DATEADD(day, 1, MAX(day)) FROM {table}_days)
+AND TRUNC(sp.start_time) IN (SELECT day FROM {table}_days)
+GROUP BY {group_by};
+
+DROP TABLE {table}_days;
+"""
+
+
+# The grouping and aggregated columns of every rollup with its joins.
+rollups = {
+    "daily_platform_plays": (
+        {"os": "COALESCE(ua.os, 'Other')", "browser": "COALESCE(ua.browser, 'Other')"},
+        {"plays": "COUNT(*)", "users": "COUNT(DISTINCT sp.user_id)"},
+        "LEFT JOIN user_agents ua ON (ua.user_agent = sp.user_agent)",
+    ),
+    "daily_level_plays": (
+        {"level": "sp.level"},
+        {"plays": "COUNT(*)", "users": "COUNT(DISTINCT sp.user_id)"},
+        "",
+    ),
+    "daily_user_plays": (
+        {"user_id": "sp.user_id"},
+        {"plays": "COUNT(*)", "sessions": "COUNT(DISTINCT sp.session_id)"},
+        "",
+    ),
+    "daily_artist_plays": (
+        {"artist_id": "sp.artist_id"},
+        {"plays": "COUNT(*)", "users": "COUNT(DISTINCT sp.user_id)"},
+        "",
+    ),
+}
+
+daily_platform_plays_refresh = rollup_refresh_query("daily_platform_plays", *rollups["daily_platform_plays"])
+daily_level_plays_refresh = rollup_refresh_query("daily_level_plays", *rollups["daily_level_plays"])
+daily_user_plays_refresh = rollup_refresh_query("daily_user_plays", *rollups["daily_user_plays"])
+daily_artist_plays_refresh = rollup_refresh_query("daily_artist_plays", *rollups["daily_artist_plays"])
+
+# BACKFILL
+
+# A backfill stages the log files of every day into a table of its own, named after the day and the run, so that the
+# days are loaded at the same time without touching staging_events. The events outside of the day are removed, the
+# day is then replaced in songplays, the time dimension and the rollups in a single transaction. Like the incremental
+# inserts, the songplays are matched against the songs dimension since staging_songs holds only the last
+# load. The users and user agents first seen on that day are added, the existing users keep their latest level.
+backfill_stage_create = """
+DROP TABLE IF EXISTS {table};
+CREATE TABLE {table} (LIKE staging_events);
+"""
+
+backfill_stage_drop = "DROP TABLE IF EXISTS {table};"
+
+
+def backfill_copy_query(table):
+    """ Returns the manifest COPY of the log files of a day into its staging table.
+
+    Args:
+    table (str): The staging table of the day.
+    """
+    return quarantined(
+        """
+copy {} {} from '{{}}'
+    iam_role '{}'
+    json {} manifest maxerror {} compupdate off region '{}';
+""".format(table, staging_events_columns, IAM_ARN, LOG_DATA_PATH, MAXERROR, REGION),
+        table,
+    )
+
+
+def backfill_enrich_query(table):
+    """ Returns the enrichment of the staged events of a day, removing the events outside of the day.
+
+    Args:
+    table (str): The staging table of the day.
+    """
+    return staging_events_enrich_query(table) + f"""
+DELETE FROM {table} WHERE start_time < %(day_start)s OR start_time >= %(day_end)s;
+"""
+
+
+def backfill_replace_query(table):
+    """ Returns the replacement of a day in songplays, the time dimension and the rollups from its staged events.
+
+    Args:
+    table (str): The staging table of the day.
+    """
+    rollup_refreshes = "".join(
+        rollup_refresh_query(name, *rollup, source=table) for name, rollup in rollups.items()
+    )
+    return f"""
+DELETE FROM songplays WHERE start_time >= %(day_start)s AND start_time < %(day_end)s;
+
+INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT DISTINCT se.start_time as start_time,
+se.user_id as user_id,
+se.level as level,
+s.song_id as song_id,
+s.artist_id as artist_id,
+se.session_id as session_id,
+se.location as location,
+se.user_agent as user_agent
+FROM {table} se
+JOIN songs s ON (se.match_key = s.match_key)
+WHERE se.page = 'NextSong';
+
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level
+FROM (
+    SELECT user_id, first_name, last_name, gender, level, ROW_NUMBER() OVER(PARTITION BY user_id ORDER BY ts DESC) AS rank
+     FROM {table}
+    WHERE user_id IS NOT NULL
+) day_users
+WHERE rank=1
+AND NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = day_users.user_id);
+{user_agent_insert_query(table)}
+DELETE FROM time WHERE start_time >= %(day_start)s AND start_time < %(day_end)s;
+{time_table_query("WHERE start_time >= %(day_start)s AND start_time < %(day_end)s")}{rollup_refreshes}"""
+
+
+# LAKE EXPORT
+
+# The fact and dimension tables are unloaded as Parquet below LAKE_PREFIX, one directory per table and one
+# sub directory per partition (songplays/start_date=2018-11-12/level=free/), for the analysis off the cluster.
+# The tables are mapped to their partition columns and the time column the start_date partition is derived from.
+# The time dimension already has a day column (the day of the month), hence the start_date name.
+lake_tables = {
+    "songplays": (("start_date", "level"), "start_time"),
+    "time": (("start_date",), "start_time"),
+    "users": (("level",), None),
+    "songs": ((), None),
+    "artists": ((), None),
+}
+
+# The days of the staged events, which are the only day partitions an incremental run changes.
+staged_days_query = """
+SELECT DISTINCT TRUNC(start_time) AS day
+FROM staging_events
+WHERE start_time IS NOT NULL
+ORDER BY day;
+"""
+
+
+def lake_unload_query(table, day=None):
+    """ Returns the UNLOAD of a table into its lake directory, or of a single day into its day partition.
+    CLEANPATH removes the files of the directory first, so a rewritten partition never keeps stale files.
+
+    Args:
+    table (str): The table, one of lake_tables.
+    day (date): The day partition to rewrite, the complete table is rewritten without it.
+    """
+    partition_by, time_column = lake_tables[table]
+    uri = f"{LAKE_PREFIX}/{table}/"
+    if day is None:
+        select = f"SELECT *, TRUNC({time_column}) AS start_date FROM {table}" if time_column else f"SELECT * FROM {table}"
+    else:
+        # The literals are quoted twice since the query is itself a literal of the UNLOAD.
+        select = (
+            f"SELECT * FROM {table} WHERE {time_column} >= ''{day.isoformat()}'' "
+            f"AND {time_column} < DATEADD(day, 1, ''{day.isoformat()}'')"
+        )
+        uri += f"start_date={day.isoformat()}/"
+        partition_by = tuple(column for column in partition_by if column != "start_date")
+    partition = f"\nPARTITION BY ({', '.join(partition_by)})" if partition_by else ""
+    return f"""
+UNLOAD ('{select}')
+TO '{uri}'
+IAM_ROLE '{IAM_ARN}'
+FORMAT AS PARQUET{partition}
+CLEANPATH;
+"""
+
+
+# WORKLOAD MANAGEMENT
+
+# The queue wait and execution time of the statements of a query group since a time, per label (the query group
+# suffixed with the stage) and WLM queue (service class), with the statements run on a concurrency scaling cluster.
+wlm_queue_report = """
+SELECT TRIM(q.label) AS label, w.service_class, COUNT(*) AS queries,
+SUM(w.total_queue_time) / 1000000.0 AS queue_s,
+SUM(w.total_exec_time) / 1000000.0 AS exec_s,
+MAX(w.total_queue_time) / 1000000.0 AS max_queue_s,
+SUM(CASE WHEN q.concurrency_scaling_status = 1 THEN 1 ELSE 0 END) AS scaled
+FROM stl_wlm_query w
+JOIN stl_query q ON (q.query = w.query)
+WHERE q.starttime >= %(since)s
+AND (TRIM(q.label) = %(query_group)s OR TRIM(q.label) LIKE %(label_pattern)s)
+GROUP BY 1, 2
+ORDER BY queue_s DESC;
+"""
+
+
+# MAINTENANCE
+
+# The state of the tables after a load: the percentage of unsorted rows (NULL without a sort key), of the rows
+# marked for deletion but not yet reclaimed and how outdated the planner statistics are. SVV_TABLE_INFO does not
+# list empty tables.
+table_maintenance_info = """
+SELECT "table", tbl_rows, size AS size_mb,
+COALESCE(unsorted, 0) AS unsorted,
+CASE WHEN tbl_rows > 0 THEN 100.0 * (tbl_rows - estimated_visible_rows) / tbl_rows ELSE 0 END AS deleted,
+COALESCE(stats_off, 0) AS stats_off
+FROM svv_table_info
+WHERE schema = 'public' AND "table" IN %(tables)s;
+"""
+
+# Only the columns used in the filters, joins and group bys of the previous queries are analyzed.
+analyze_table_query = "ANALYZE {table} PREDICATE COLUMNS;"
+
+vacuum_delete_query = "VACUUM DELETE ONLY {table};"
+
+vacuum_sort_query = "VACUUM SORT ONLY {table} TO {percent} PERCENT;"
+
+
+# DATA QUALITY
+
+# The rejected rows quarantined by the COPY commands of the current run.
+load_errors_report = """
+SELECT table_name, err_code, err_reason, COUNT(*) AS rejected, MIN(filename) AS first_file, MIN(line_number) AS first_line
+FROM load_errors
+WHERE loaded_at >= %(since)s
+GROUP BY table_name, err_code, err_reason
+ORDER BY rejected DESC;
+"""
+
+
+def count_if(condition):
+    return f"SUM(CASE WHEN {condition} THEN 1 ELSE 0 END)"
+
+
+def quality_check_query(source, checks):
+    """ Returns the query computing all the checks of a table in a single pass, each check counting its failed rows.
+
+    Args:
+    source (str): The FROM clause of the checks, restricted to the rows of the current load.
+    checks (dict): The name of every check mapped to the expression counting its failed rows.
+    """
+    expressions = ",\n".join(f"{expression} AS {name}" for name, expression in checks.items())
+    return f"\nSELECT {expressions}\nFROM {source};\n"
+
+
+# The checks of the staged data run before the inserts, so that bad data is never published.
+staging_quality_checks = {
+    "staging_events": (
+        "staging_events",
+        {
+            "null_ts": count_if("ts IS NULL"),
+            "next_song_without_user_id": count_if("page = 'NextSong' AND user_id IS NULL"),
+        },
+    ),
+    "staging_songs": (
+        "staging_songs",
+        {
+            "null_song_id": count_if("song_id IS NULL"),
+            "null_artist_id": count_if("artist_id IS NULL"),
+        },
+    ),
+}
+
+# The checks of the loaded tables only read the keys and the time range of the staged data (the sort key of
+# songplays), so they do not scan the complete tables on every run. They run in this order and stop at the first
+# failed table: songplays is joined to the dimensions, whose duplicate keys would multiply its rows.
+table_quality_checks = {
+    "users": (
+        "users WHERE user_id IN (SELECT user_id FROM staging_events)",
+        {
+            "duplicate_user_id": "COUNT(*) - COUNT(DISTINCT user_id)",
+            "null_level": count_if("level IS NULL"),
+        },
+    ),
+    "songs": (
+        "songs WHERE song_id IN (SELECT song_id FROM staging_songs)",
+        {
+            "duplicate_song_id": "COUNT(*) - COUNT(DISTINCT song_id)",
+            "null_artist_id": count_if("artist_id IS NULL"),
+        },
+    ),
+    "artists": (
+        "artists WHERE artist_id IN (SELECT artist_id FROM staging_songs)",
+        {
+            "duplicate_artist_id": "COUNT(*) - COUNT(DISTINCT artist_id)",
+        },
+    ),
+    "songplays": (
+        """songplays sp
+LEFT JOIN songs s ON (s.song_id = sp.song_id)
+LEFT JOIN artists a ON (a.artist_id = sp.artist_id)
+LEFT JOIN users u ON (u.user_id = sp.user_id)
+LEFT JOIN time t ON (t.start_time = sp.start_time)
+WHERE sp.start_time BETWEEN (SELECT MIN(start_time) FROM staging_events) AND (SELECT MAX(start_time) FROM staging_events)""",
+        {
+            "orphan_song_id": count_if("s.song_id IS NULL"),
+            "orphan_artist_id": count_if("a.artist_id IS NULL"),
+            "orphan_user_id": count_if("u.user_id IS NULL"),
+            "orphan_start_time": count_if("t.start_time IS NULL"),
+        },
+    ),
+}
+
 # QUERY LISTS
 
 create_table_queries = [
@@ -221,6 +805,12 @@ create_table_queries = [
     song_table_create,
     time_table_create,
     songplay_table_create,
+    user_agent_table_create,
+    daily_platform_plays_table_create,
+    daily_level_plays_table_create,
+    daily_user_plays_table_create,
+    daily_artist_plays_table_create,
+    load_errors_table_create,
 ]
 
 drop_table_queries = [
@@ -231,14 +821,65 @@ drop_table_queries = [
     artist_table_drop,
     user_table_drop,
     time_table_drop,
+    user_agent_table_drop,
+    daily_platform_plays_table_drop,
+    daily_level_plays_table_drop,
+    daily_user_plays_table_drop,
+    daily_artist_plays_table_drop,
+    load_errors_table_drop,
+]
+copy_table_queries = [
+    staging_events_copy,
+    staging_songs_compacted_copy if SONG_DATA_COMPACTED else staging_songs_copy,
+]
+enrich_table_queries = [
+    staging_events_match_key_update,
 ]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
+# songplays is matched against the songs dimension, so it is inserted after the dimensions. The time dimension is
+# generated for the start times of songplays, so it follows it.
 insert_table_queries = [
-    songplay_table_insert,
     user_table_insert,
     song_table_insert,
+    artist_table_insert,
+    songplay_table_insert,
     time_table_insert,
+    user_agent_table_insert,
+    daily_platform_plays_refresh,
+    daily_level_plays_refresh,
+    daily_user_plays_refresh,
+    daily_artist_plays_refresh,
+]
+# songplays is only appended to, unlike the upserted dimensions and the replaced days of the rollups. Replaying its
+# insert after a commit which failed on the client side would duplicate its rows, so it is not retried once it may have
+# been committed. The same holds for the COPY commands and the backfill of a day.
+non_idempotent_inserts = {"songplays"}
+# The fact table references the dimensions and is matched against songs, the dimensions only read the staging tables
+# and are independent, except the time dimension generated for the start times of songplays.
+insert_table_dependencies = {
+    "users": [],
+    "songs": [],
+    "artists": [],
+    "songplays": ["users", "songs", "artists"],
+    "time": ["songplays"],
+    "user_agents": [],
+    # The rollups are refreshed from songplays once it holds the new rows.
+    "daily_platform_plays": ["songplays", "user_agents"],
+    "daily_level_plays": ["songplays"],
+    "daily_user_plays": ["songplays"],
+    "daily_artist_plays": ["songplays"],
+}
+# The dimensions are merged before songplays since songplays is matched against songs and artists.
+incremental_insert_table_queries = [
+    user_table_insert,
+    song_table_insert,
     artist_table_insert,
+    songplay_table_incremental_insert,
+    time_table_incremental_insert,
+    user_agent_table_insert,
+    daily_platform_plays_refresh,
+    daily_level_plays_refresh,
+    daily_user_plays_refresh,
+    daily_artist_plays_refresh,
 ]
 
 ## Analyze queries
@@ -256,21 +897,29 @@ SELECT COUNT(*) FROM users;
 time_query = """
 SELECT COUNT(*) FROM time;
 """
+# The songplays questions are answered from the daily rollups, which stay small as the fact table grows.
 songplays_query = """
-SELECT COUNT(*) FROM songplays;
+SELECT SUM(plays) FROM daily_level_plays;
 """
 songs_count_query = """
 SELECT COUNT(*) FROM songs;
 """
+# The rollups count the iPhone agents ("like Mac OS X") as iOS, the former LIKE '%Mac OS%' counted them as Mac.
 songplays_query_windows = """
-SELECT COUNT(*) as windows_users
-FROM songplays
-WHERE songplays.user_agent LIKE '%Windows%'; 
+SELECT SUM(plays) as windows_users
+FROM daily_platform_plays
+WHERE os = 'Windows';
 """
 songplays_query_mac = """
-SELECT COUNT(*) as mac_users
-FROM songplays
-WHERE songplays.user_agent LIKE '%Mac OS%'; 
+SELECT SUM(plays) as mac_users
+FROM daily_platform_plays
+WHERE os = 'Mac OS';
+"""
+daily_activity_query = """
+SELECT day, level, plays, users
+FROM daily_level_plays
+ORDER BY day DESC, level
+LIMIT 30;
 """
 
 user_count_query = """
@@ -287,4 +936,5 @@ analyze_queries = [
     songplays_query,
     songplays_query_windows,
     songplays_query_mac,
+    daily_activity_query,
 ]
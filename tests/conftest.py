@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the repository are flat top-level modules.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from local_s3 import LocalS3Client  # noqa: E402
+
+
+@pytest.fixture
+def s3(tmp_path):
+    """ The local s3 stand-in below a temporary directory.
+    """
+    return LocalS3Client(str(tmp_path / "s3"))
+
+
+def put(s3, uri, body=b"{}", mtime=None):
+    """ Writes an object into the local s3 stand-in, optionally with its modification time (epoch seconds).
+    """
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    s3.put_object(Bucket=bucket, Key=key, Body=body)
+    if mtime is not None:
+        os.utime(os.path.join(s3.root, bucket, *key.split("/")), (mtime, mtime))
@@ -0,0 +1,41 @@
+import gzip
+import json
+import sys
+
+from click.testing import CliRunner
+
+from compact_songs import compact, main, part_count
+from conftest import put
+from manifests import list_objects
+
+
+def test_the_parts_are_a_multiple_of_the_slices():
+    assert part_count(0, 4, 100) == 4
+    assert part_count(400, 4, 100) == 4
+    assert part_count(401, 4, 100) == 8
+
+
+def test_the_song_files_are_compacted_into_one_part_per_slice(s3):
+    songs = [{"song_id": f"S{i:03d}", "title": f"title {i}", "num_songs": 1} for i in range(10)]
+    for song in songs:
+        put(s3, f"s3://songs/song-data/{song['song_id']}.json", body=json.dumps(song).encode())
+    objects = list(list_objects(s3, "s3://songs/song-data"))
+
+    parts = compact(s3, objects, "s3://songs/compacted", "json", 4, 1024, 2, "dwh.cfg", s3.root)
+
+    assert len(parts) == 4
+    records = []
+    for part in parts:
+        key = part[len("s3://songs/"):]
+        with gzip.open(s3.get_object(Bucket="songs", Key=key)["Body"], "rt") as f:
+            records.extend(json.loads(line) for line in f)
+    assert sorted(records, key=lambda record: record["song_id"]) == songs
+
+
+def test_parquet_without_pyarrow_is_a_usage_error(monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+
+    result = CliRunner().invoke(main, ["--output", "s3://songs/compacted", "--format", "parquet"])
+
+    assert result.exit_code == 2
+    assert "requires pyarrow" in result.output
@@ -0,0 +1,109 @@
+import configparser
+
+import psycopg2
+import pytest
+
+from db import Warehouse
+
+
+class StubCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.conn.executed.append(query)
+        if self.conn.fail_on == "execute":
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class StubConnection:
+    """ A connection whose first execute or commit drops, the later ones succeed.
+    """
+
+    def __init__(self, pool, fail_on):
+        self.pool = pool
+        self.fail_on = fail_on
+        self.executed = pool.executed
+        self.autocommit = False
+        self.closed = False
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def commit(self):
+        if self.fail_on == "commit":
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    def rollback(self):
+        pass
+
+
+class StubPool:
+    statement_timeout = 0
+
+    def __init__(self, fail_on):
+        self.fail_on = [fail_on]
+        self.executed = []
+
+    def getconn(self):
+        return StubConnection(self, self.fail_on.pop() if self.fail_on else None)
+
+    def putconn(self, conn, close=False):
+        pass
+
+    def label(self, conn):
+        pass
+
+
+def warehouse(fail_on):
+    config = configparser.ConfigParser()
+    config.read_dict(
+        {
+            "CLUSTER": {"HOST": "localhost", "DB_NAME": "dwh", "DB_USER": "dwh", "DB_PASSWORD": "", "DB_PORT": "5439"},
+            "DB": {"RETRIES": "3", "RETRY_BACKOFF": "0"},
+        }
+    )
+    db = Warehouse(config)
+    db.pool = StubPool(fail_on)
+    return db
+
+
+@pytest.mark.parametrize("fail_on", ["execute", "commit"])
+def test_an_idempotent_query_is_retried(fail_on):
+    db = warehouse(fail_on)
+
+    db.run("INSERT INTO users_stage SELECT 1;")
+
+    assert db.pool.executed == ["INSERT INTO users_stage SELECT 1;"] * 2
+
+
+def test_a_query_failed_before_its_commit_is_retried():
+    db = warehouse("execute")
+
+    db.run("INSERT INTO songplays SELECT 1;", idempotent=False)
+
+    assert len(db.pool.executed) == 2
+
+
+def test_a_query_which_may_be_committed_is_not_replayed():
+    db = warehouse("commit")
+
+    with pytest.raises(psycopg2.OperationalError):
+        db.run("INSERT INTO songplays SELECT 1;", idempotent=False)
+
+    assert len(db.pool.executed) == 1
+
+
+def test_an_autocommitted_query_is_not_replayed():
+    db = warehouse("execute")
+
+    with pytest.raises(psycopg2.OperationalError):
+        db.run("COPY staging_events FROM 's3://bucket/manifest';", autocommit=True, idempotent=False)
+
+    assert len(db.pool.executed) == 1
@@ -0,0 +1,174 @@
+import configparser
+import types
+
+import boto3
+import pytest
+from click.testing import CliRunner
+
+from IaC import do_work, wait_for_cluster, write_cluster_config
+
+POLL = dict(timeout=5, initial_delay=0, max_delay=0)
+
+
+class ClusterNotFoundFault(Exception):
+    pass
+
+
+class StubRedshift:
+    """ A redshift client answering describe_clusters with the scripted statuses, the last one is repeated. A status
+    of None means the cluster is gone.
+    """
+
+    exceptions = types.SimpleNamespace(ClusterNotFoundFault=ClusterNotFoundFault)
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def describe_clusters(self, ClusterIdentifier):
+        status = self.statuses[min(self.calls, len(self.statuses) - 1)]
+        self.calls += 1
+        if status is None:
+            raise ClusterNotFoundFault(ClusterIdentifier)
+        status, pending = status if isinstance(status, tuple) else (status, {})
+        return {"Clusters": [{"ClusterStatus": status, "PendingModifiedValues": pending, "NumberOfNodes": 2}]}
+
+
+def test_waits_until_the_cluster_is_available():
+    redshift = StubRedshift("creating", "creating", "Available")
+
+    props = wait_for_cluster(redshift, "dwh", "available", **POLL)
+
+    assert props["NumberOfNodes"] == 2
+    assert redshift.calls == 3
+
+
+def test_settled_waits_for_the_pending_modifications():
+    redshift = StubRedshift(("available", {"NumberOfNodes": 4}), "available")
+
+    wait_for_cluster(redshift, "dwh", "available", settled=True, **POLL)
+
+    assert redshift.calls == 2
+
+
+def test_a_deleted_cluster_is_gone():
+    redshift = StubRedshift("deleting", None)
+
+    assert wait_for_cluster(redshift, "dwh", "deleted", **POLL) is None
+
+
+def test_a_missing_cluster_is_raised_unless_it_is_deleted():
+    with pytest.raises(ClusterNotFoundFault):
+        wait_for_cluster(StubRedshift(None), "dwh", "available", **POLL)
+
+
+def test_the_timeout_stops_the_polling():
+    with pytest.raises(TimeoutError):
+        wait_for_cluster(StubRedshift("modifying"), "dwh", "available", timeout=0.05, initial_delay=0.02, max_delay=0.02)
+
+
+def test_the_endpoint_is_written_back_keeping_the_configuration(tmp_path):
+    path = tmp_path / "dwh.cfg"
+    path.write_text("[CLUSTER]\nHOST=\nDB_NAME=dwh\n\n[IAM_ROLE]\nARN=\n\n[S3]\nLOG_DATA=s3://udacity-dend/log_data\n")
+
+    write_cluster_config(str(path), host="dwh.abc.us-west-2.redshift.amazonaws.com", role_arn="arn:aws:iam::1:role/x")
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(path)
+    assert config["CLUSTER"]["HOST"] == "dwh.abc.us-west-2.redshift.amazonaws.com"
+    assert config["CLUSTER"]["DB_NAME"] == "dwh"
+    assert config["IAM_ROLE"]["ARN"] == "arn:aws:iam::1:role/x"
+    assert config["S3"]["LOG_DATA"] == "s3://udacity-dend/log_data"
+    assert not (tmp_path / "dwh.cfg.tmp").exists()
+
+
+CLUSTER_CONFIG = """[CLUSTER]
+HOST=
+DB_NAME=dwh
+DB_USER=dwhuser
+DB_PASSWORD=Passw0rd
+DB_PORT=5439
+ACCESS_KEY=testing
+SECRET=testing
+REGION=us-west-2
+DWH_CLUSTER_TYPE=multi-node
+DWH_NUM_NODES=2
+DWH_NODE_TYPE=dc2.large
+DWH_IAM_ROLE_NAME=dwh-test-role
+DWH_CLUSTER_IDENTIFIER=dwh-test
+
+[IAM_ROLE]
+ARN=
+
+[IAC]
+POLL_TIMEOUT=5
+POLL_INITIAL_DELAY=0
+POLL_MAX_DELAY=0
+
+[WLM]
+PARAMETER_GROUP=
+ETL_QUERY_GROUP=etl
+ETL_CONCURRENCY=3
+ETL_MEMORY_PERCENT=60
+ANALYSIS_QUERY_GROUP=analysis
+ANALYSIS_CONCURRENCY=5
+ANALYSIS_MEMORY_PERCENT=30
+"""
+
+
+@pytest.fixture
+def aws(tmp_path, monkeypatch):
+    """ A project directory with a filled dwh.cfg, against the AWS services mocked by moto.
+    """
+    moto = pytest.importorskip("moto")
+    (tmp_path / "dwh.cfg").write_text(CLUSTER_CONFIG)
+    monkeypatch.chdir(tmp_path)
+    # The role of the cluster is attached to the AWS managed AmazonS3ReadOnlyAccess policy.
+    monkeypatch.setenv("MOTO_IAM_LOAD_MANAGED_POLICIES", "true")
+    with moto.mock_aws():
+        yield boto3.client(
+            "redshift", region_name="us-west-2", aws_access_key_id="testing", aws_secret_access_key="testing"
+        )
+
+
+def read_cfg(path="dwh.cfg"):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def test_create_writes_the_endpoint_and_the_role_arn(aws):
+    result = CliRunner().invoke(do_work, ["--name", "create"])
+
+    assert result.exit_code == 0, result.output
+    config = read_cfg()
+    assert config["CLUSTER"]["HOST"] == aws.describe_clusters()["Clusters"][0]["Endpoint"]["Address"]
+    assert config["CLUSTER"]["HOST"].startswith("dwh-test.")
+    assert config["IAM_ROLE"]["ARN"].endswith(":role/dwh-test-role")
+
+
+def test_delete_removes_the_cluster(aws):
+    assert CliRunner().invoke(do_work, ["--name", "create"]).exit_code == 0
+
+    result = CliRunner().invoke(do_work, ["--name", "delete"])
+
+    assert result.exit_code == 0, result.output
+    assert aws.describe_clusters()["Clusters"] == []
+
+
+# moto implements neither the resize nor the parameter group changes.
+@pytest.mark.parametrize(
+    "args, parameter_group", [(["--name", "resize", "--nodes", "4"], ""), (["--name", "wlm"], "sparkify-wlm")]
+)
+def test_a_failed_step_exits_non_zero(aws, args, parameter_group):
+    assert CliRunner().invoke(do_work, ["--name", "create"]).exit_code == 0
+    config = read_cfg()
+    config["WLM"]["PARAMETER_GROUP"] = parameter_group
+    with open("dwh.cfg", "w") as f:
+        config.write(f)
+
+    result = CliRunner().invoke(do_work, args)
+
+    assert result.exit_code == 1
+    assert "has not been implemented" in result.output
@@ -0,0 +1,20 @@
+from time import sleep
+
+from instrumentation import Recorder
+
+
+def test_the_stages_record_their_wall_time():
+    recorder = Recorder()
+
+    with recorder.stage("create_tables"):
+        sleep(0.01)
+        recorder.record("CREATE TABLE songs (song_id TEXT);", 0.01, -1, "ok")
+    with recorder.stage("insert_tables"):
+        pass
+    with recorder.stage("create_tables"):
+        sleep(0.01)
+
+    assert list(recorder.stage_timings) == ["create_tables", "insert_tables"]
+    assert recorder.stage_timings["create_tables"] >= 0.02
+    assert recorder.metrics[0]["stage"] == "create_tables"
+    assert recorder.current_stage is None
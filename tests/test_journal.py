@@ -0,0 +1,48 @@
+from journal import RunJournal, fingerprint, listing_fingerprint
+
+
+class StubWarehouse:
+    def __init__(self):
+        self.executed = []
+
+    def run(self, query, params=None, idempotent=True):
+        self.executed.append(query)
+
+
+def test_the_fingerprint_is_stable_and_follows_the_inputs():
+    assert fingerprint("COPY staging_events", {"b": 2, "a": 1}) == fingerprint("COPY staging_events", {"a": 1, "b": 2})
+    assert fingerprint("COPY staging_events", {"a": 1}) != fingerprint("COPY staging_events", {"a": 2})
+    assert len(fingerprint("COPY staging_events")) == 16
+
+
+def test_the_listing_fingerprint_ignores_the_listing_order():
+    objects = [
+        {"key": "log_data/a.json", "size": 10, "last_modified": "2018-11-01"},
+        {"key": "log_data/b.json", "size": 20, "last_modified": "2018-11-02"},
+    ]
+
+    assert listing_fingerprint(objects) == listing_fingerprint(list(reversed(objects)))
+    assert listing_fingerprint(objects) != listing_fingerprint([{**objects[0], "size": 11}, objects[1]])
+
+
+def test_a_resumed_run_skips_the_steps_completed_for_the_same_inputs(tmp_path):
+    path = str(tmp_path / "journal.json")
+    db = StubWarehouse()
+    RunJournal(path).run(db, "copy staging_events", "f1", ["COPY staging_events"])
+
+    journal = RunJournal(path, resume=True)
+
+    assert not journal.run(db, "copy staging_events", "f1", ["COPY staging_events"])
+    assert journal.run(db, "copy staging_events", "f2", ["COPY staging_events"])
+    assert journal.run(db, "insert songplays", "f3", ["INSERT INTO songplays"])
+    assert db.executed == ["COPY staging_events", "COPY staging_events", "INSERT INTO songplays"]
+    assert journal.load()["copy staging_events"]["fingerprint"] == "f2"
+
+
+def test_a_new_run_starts_with_an_empty_journal(tmp_path):
+    path = str(tmp_path / "journal.json")
+    RunJournal(path).mark_done("copy staging_events", "f1", 1.23456)
+
+    assert RunJournal(path, resume=True).load()["copy staging_events"]["duration_s"] == 1.235
+    assert not RunJournal(path).is_done("copy staging_events", "f1")
+    assert not (tmp_path / "journal.json").exists()
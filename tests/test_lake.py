@@ -0,0 +1,60 @@
+import json
+import pathlib
+
+from conftest import put
+from lake import MANIFEST_NAME, read_manifest, write_lake_manifest
+
+LAKE = "s3://lake/sparkify"
+
+
+def export(s3, paths):
+    for path in paths:
+        put(s3, f"{LAKE}/{path}", body=b"PAR1")
+
+
+def lake_file(s3, path):
+    return pathlib.Path(s3.root, "lake", "sparkify", *path.split("/"))
+
+
+def test_a_full_export_lists_every_partition(s3):
+    export(s3, [
+        "songplays/start_date=2018-11-12/level=free/0000_part_00.parquet",
+        "songplays/start_date=2018-11-13/level=paid/0000_part_00.parquet",
+        "songs/0000_part_00.parquet",
+    ])
+    manifest = write_lake_manifest(s3, LAKE, ["songplays/", "songs/"])
+
+    assert manifest["tables"]["songplays"]["partition_by"] == ["start_date", "level"]
+    assert sorted(manifest["tables"]["songplays"]["partitions"]) == [
+        "start_date=2018-11-12/level=free",
+        "start_date=2018-11-13/level=paid",
+    ]
+    assert manifest["tables"]["songs"]["partitions"][""]["files"] == ["songs/0000_part_00.parquet"]
+    assert json.loads(s3.get_object(Bucket="lake", Key=f"sparkify/{MANIFEST_NAME}")["Body"].read()) == manifest
+
+
+def test_a_rewritten_day_replaces_only_its_partitions(s3):
+    export(s3, [
+        "songplays/start_date=2018-11-12/level=free/0000_part_00.parquet",
+        "songplays/start_date=2018-11-12/level=paid/0000_part_00.parquet",
+        "songplays/start_date=2018-11-13/level=paid/0000_part_00.parquet",
+    ])
+    before = write_lake_manifest(s3, LAKE, ["songplays/"])["tables"]["songplays"]["partitions"]
+
+    # The day is unloaded again with CLEANPATH: its old files are gone and its levels may differ.
+    for path in ["level=free/0000_part_00.parquet", "level=paid/0000_part_00.parquet"]:
+        lake_file(s3, f"songplays/start_date=2018-11-12/{path}").unlink()
+    export(s3, ["songplays/start_date=2018-11-12/level=free/0001_part_00.parquet"])
+    after = write_lake_manifest(s3, LAKE, ["songplays/start_date=2018-11-12/"])["tables"]["songplays"]["partitions"]
+
+    assert sorted(after) == ["start_date=2018-11-12/level=free", "start_date=2018-11-13/level=paid"]
+    assert after["start_date=2018-11-12/level=free"]["files"] == [
+        "songplays/start_date=2018-11-12/level=free/0001_part_00.parquet"
+    ]
+    # The partitions of the other days are kept with their export time.
+    assert after["start_date=2018-11-13/level=paid"] == before["start_date=2018-11-13/level=paid"]
+    assert read_manifest(s3, LAKE)["tables"]["songplays"]["partitions"] == after
+
+
+def test_the_manifest_is_empty_before_the_first_export(s3):
+    assert read_manifest(s3, LAKE) == {"tables": {}}
@@ -0,0 +1,18 @@
+from load_window import node_hours
+
+
+def window(phases, base_nodes=2, load_nodes=8):
+    return {"base_nodes": base_nodes, "load_nodes": load_nodes, "phases": phases}
+
+
+def test_the_load_phases_are_counted_on_the_load_nodes():
+    assert node_hours(window({"create_tables": 900, "etl": 1800, "analyse_insertion": 900})) == 8.0
+
+
+def test_the_lifecycle_phases_are_counted_at_the_larger_size():
+    assert node_hours(window({"resume": 360, "resize_up": 900, "resize_down": 900, "pause": 360})) == 5.6
+    assert node_hours(window({"resize_down": 3600}, base_nodes=4, load_nodes=2)) == 4.0
+
+
+def test_an_empty_window_spends_no_node_hours():
+    assert node_hours(window({})) == 0
@@ -0,0 +1,38 @@
+from maintenance import plan_maintenance
+
+SETTINGS = dict(stats_off=10, unsorted=5, deleted=5, sort_to=95, budget=900)
+
+
+def state(size_mb, unsorted=0.0, deleted=0.0, stats_off=0.0):
+    return dict(rows=1000, size_mb=size_mb, unsorted=unsorted, deleted=deleted, stats_off=stats_off)
+
+
+def test_the_tables_within_the_thresholds_are_not_maintained():
+    assert plan_maintenance({"users": state(10, unsorted=5, deleted=5, stats_off=10)}, SETTINGS) == []
+
+
+def test_the_analyzes_run_first_then_the_largest_vacuums():
+    states = {
+        "users": state(10, unsorted=50),
+        "songplays": state(1000, unsorted=6, deleted=20),
+        "songs": state(200, stats_off=50),
+        "artists": state(100, deleted=10, stats_off=20),
+    }
+
+    plan = [(table, operation) for table, operation, _ in plan_maintenance(states, SETTINGS)]
+
+    assert plan == [
+        ("artists", "analyze"),
+        ("songs", "analyze"),
+        ("songplays", "vacuum delete"),
+        ("songplays", "vacuum sort"),
+        ("artists", "vacuum delete"),
+        ("users", "vacuum sort"),
+    ]
+
+
+def test_the_vacuum_sort_stops_at_the_configured_percent():
+    (_, _, query), = plan_maintenance({"songplays": state(100, unsorted=20)}, SETTINGS)
+
+    assert "songplays" in query
+    assert "95 PERCENT" in query.upper()
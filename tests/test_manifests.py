@@ -0,0 +1,94 @@
+import json
+
+from conftest import put
+from etl import list_new_objects
+from manifests import batch_objects, list_objects, parse_s3_uri, write_batch_manifests
+
+LOADED = 1_600_000_000
+NEW = LOADED + 3600
+
+
+def watermark_of(objects):
+    """ The watermark etl.run_incremental stores after loading the objects.
+    """
+    return {
+        "last_key": max(obj["key"] for obj in objects),
+        "last_modified": max(obj["last_modified"] for obj in objects).isoformat(),
+    }
+
+
+def keys(objects):
+    return sorted(obj["key"] for obj in objects)
+
+
+def test_log_data_resumes_from_the_last_partition(s3):
+    uri = "s3://udacity/log-data"
+    put(s3, f"{uri}/2018/10/2018-10-31-events.json", mtime=LOADED)
+    put(s3, f"{uri}/2018/11/2018-11-01-events.json", mtime=LOADED)
+    watermark = watermark_of(list(list_objects(s3, uri)))
+
+    put(s3, f"{uri}/2018/11/2018-11-02-events.json", mtime=NEW)
+    put(s3, f"{uri}/2018/12/2018-12-01-events.json", mtime=NEW)
+
+    assert keys(list_new_objects(s3, uri, watermark, partitioned=True)) == [
+        "log-data/2018/11/2018-11-02-events.json",
+        "log-data/2018/12/2018-12-01-events.json",
+    ]
+
+
+def test_song_data_lists_new_files_below_earlier_prefixes(s3):
+    uri = "s3://udacity/song_data"
+    put(s3, f"{uri}/A/B/C/TRABCAA.json", mtime=LOADED)
+    put(s3, f"{uri}/Z/Z/Z/TRZZZAA.json", mtime=LOADED)
+    watermark = watermark_of(list(list_objects(s3, uri)))
+
+    put(s3, f"{uri}/A/A/A/TRAAAAA.json", mtime=NEW)
+    put(s3, f"{uri}/Z/Z/Z/TRZZZAB.json", mtime=NEW)
+
+    assert keys(list_new_objects(s3, uri, watermark)) == [
+        "song_data/A/A/A/TRAAAAA.json",
+        "song_data/Z/Z/Z/TRZZZAB.json",
+    ]
+    # Once loaded, the next run lists nothing again.
+    watermark = watermark_of(list(list_objects(s3, uri)))
+    assert list_new_objects(s3, uri, watermark) == []
+
+
+def test_first_run_lists_everything(s3):
+    uri = "s3://udacity/song_data"
+    put(s3, f"{uri}/A/B/C/TRABCAA.json", mtime=LOADED)
+    assert keys(list_new_objects(s3, uri, {})) == ["song_data/A/B/C/TRABCAA.json"]
+
+
+def objects_of_sizes(sizes):
+    return [{"url": f"s3://b/k{i:04d}", "key": f"k{i:04d}", "size": size} for i, size in enumerate(sizes)]
+
+
+def test_batches_give_every_slice_the_same_number_of_files():
+    objects = objects_of_sizes(range(1, 1001))
+    batches = batch_objects(objects, slices=8, files_per_slice=16)
+
+    assert sorted(obj["key"] for batch in batches for obj in batch) == sorted(obj["key"] for obj in objects)
+    assert all(len(batch) <= 8 * 16 for batch in batches)
+    assert max(map(len, batches)) - min(map(len, batches)) <= 1
+    # The largest files are dealt first, so the bytes of the batches differ by less than the largest file.
+    batch_bytes = [sum(obj["size"] for obj in batch) for batch in batches]
+    assert max(batch_bytes) - min(batch_bytes) <= 1000
+
+
+def test_a_small_listing_is_a_single_batch():
+    assert len(batch_objects(objects_of_sizes([10, 20, 30]), slices=4, files_per_slice=1)) == 1
+    assert batch_objects([], slices=4, files_per_slice=1) == []
+
+
+def test_batch_manifests_are_written_to_the_local_stand_in(s3):
+    objects = objects_of_sizes([5] * 10)
+    uris = write_batch_manifests(s3, objects, "s3://bucket/manifests/run", "log_data", slices=2, files_per_slice=2)
+
+    assert uris == [f"s3://bucket/manifests/run/log_data-{i:05d}.manifest" for i in range(3)]
+    entries = []
+    for uri in uris:
+        bucket, key = parse_s3_uri(uri)
+        entries.extend(json.loads(s3.get_object(Bucket=bucket, Key=key)["Body"].read())["entries"])
+    assert sorted(entry["url"] for entry in entries) == sorted(obj["url"] for obj in objects)
+    assert all(entry["mandatory"] and entry["meta"]["content_length"] == 5 for entry in entries)
@@ -0,0 +1,81 @@
+import datetime
+from decimal import Decimal
+
+from result_cache import CachedColumn, ResultCache, TableVersions, normalize_query, query_tables
+
+TABLES = ["songplays", "users", "songs", "artists", "time"]
+
+QUERY = "SELECT u.level, COUNT(*) FROM songplays sp JOIN users u ON u.user_id = sp.user_id GROUP BY 1"
+
+
+class StubWarehouse:
+    """ Streams the rows in a single batch and counts the queries run on the cluster.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def stream(self, query, write, params=None, batch_size=10000):
+        self.queries += 1
+        write([CachedColumn("level", 1043), CachedColumn("count", 20)], self.rows)
+        return len(self.rows)
+
+
+def cache(tmp_path, max_bytes=1024 ** 2):
+    return ResultCache(str(tmp_path / "cache"), TableVersions(str(tmp_path / "versions.json")), TABLES, max_bytes)
+
+
+def test_the_normalized_query_keeps_the_string_literals():
+    query = "SELECT level  -- the level\nFROM Users\n WHERE level = 'Paid';"
+
+    assert normalize_query(query) == "select level from users where level = 'Paid'"
+
+
+def test_the_query_tables_are_the_known_tables_read():
+    assert query_tables(QUERY, TABLES) == ["songplays", "users"]
+    assert query_tables("SELECT 1 FROM pg_tables", TABLES) == []
+
+
+def test_the_key_ignores_the_formatting_and_follows_the_parameters(tmp_path):
+    results = cache(tmp_path)
+
+    assert results.key(QUERY) == results.key(f"  {QUERY.replace('SELECT', 'select')} ;")
+    assert results.key(QUERY, {"level": "paid"}) != results.key(QUERY, {"level": "free"})
+
+
+def test_a_bump_of_a_table_read_invalidates_the_result(tmp_path):
+    results = cache(tmp_path)
+    key = results.key(QUERY)
+
+    results.versions.bump(["artists"])
+    assert results.key(QUERY) == key
+
+    results.versions.bump(["users"])
+    assert results.key(QUERY) != key
+
+
+def test_the_result_is_served_from_the_cache_until_its_tables_change(tmp_path):
+    rows = [("paid", Decimal("12")), ("free", datetime.date(2018, 11, 1))]
+    db = StubWarehouse(rows)
+    results = cache(tmp_path)
+
+    assert results.fetch(db, QUERY) == rows
+    assert results.fetch(db, QUERY) == rows
+    assert db.queries == 1
+    assert results.session["hits"] == 1
+
+    results.versions.bump(["songplays"])
+    assert results.fetch(db, QUERY) == rows
+    assert db.queries == 2
+
+
+def test_a_result_larger_than_the_cache_is_not_cached(tmp_path):
+    db = StubWarehouse([("x" * 1024,)])
+    results = cache(tmp_path, max_bytes=100)
+
+    results.fetch(db, QUERY)
+    results.fetch(db, QUERY)
+
+    assert db.queries == 2
+    assert results.load_index()["entries"] == {}
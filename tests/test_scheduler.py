@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from scheduler import critical_path, run_dag, target_table
+
+DEPENDENCIES = {"songplays": ["users", "songs"], "time": ["songplays"]}
+
+
+class StubWarehouse:
+    """ Records the queries in the order they ran, the queries in fail raise.
+    """
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.executed = []
+        self.idempotent = {}
+        self._lock = threading.Lock()
+
+    def run(self, query, params=None, idempotent=True):
+        with self._lock:
+            self.executed.append(query)
+            self.idempotent[query] = idempotent
+        if query in self.fail:
+            raise RuntimeError(query)
+
+
+def test_the_target_table_of_an_upsert_is_its_last_insert():
+    assert target_table("INSERT INTO users_stage SELECT 1; INSERT INTO users SELECT * FROM users_stage;") == "users"
+
+
+def test_the_critical_path_follows_the_dependency_finishing_last():
+    timings = {"users": (0, 1), "songs": (0, 3), "artists": (0, 5), "songplays": (3, 4), "time": (4, 6)}
+
+    assert critical_path(timings, DEPENDENCIES) == ["songs", "songplays", "time"]
+
+
+def test_the_critical_path_of_independent_steps_is_the_step_finishing_last():
+    assert critical_path({"users": (0, 2), "artists": (0, 1)}, DEPENDENCIES) == ["users"]
+    assert critical_path({}, DEPENDENCIES) == []
+
+
+def test_the_steps_run_after_their_dependencies():
+    steps = {name: name for name in ("time", "songplays", "users", "songs")}
+    db = StubWarehouse()
+
+    timings = run_dag(db, steps, DEPENDENCIES, concurrency=4, non_idempotent={"songplays"})
+
+    assert set(timings) == set(steps)
+    assert db.executed.index("songplays") > max(db.executed.index("users"), db.executed.index("songs"))
+    assert db.executed.index("time") > db.executed.index("songplays")
+    assert db.idempotent == {"time": True, "songplays": False, "users": True, "songs": True}
+
+
+def test_a_failed_step_stops_its_dependents():
+    db = StubWarehouse(fail={"songs"})
+
+    with pytest.raises(RuntimeError):
+        run_dag(db, {"songs": "songs", "songplays": "songplays"}, DEPENDENCIES, concurrency=2)
+
+    assert db.executed == ["songs"]
+
+
+def test_cyclic_dependencies_are_raised():
+    with pytest.raises(ValueError):
+        run_dag(StubWarehouse(), {"a": "a", "b": "b"}, {"a": ["b"], "b": ["a"]}, concurrency=2)
@@ -0,0 +1,92 @@
+import re
+
+import pytest
+
+import sql_queries
+from ddl import TABLES
+
+duckdb = pytest.importorskip("duckdb")
+
+# The Redshift functions the queries use without a DuckDB equivalent of the same name.
+MACROS = [
+    "CREATE MACRO getdate() AS CAST(current_timestamp AS TIMESTAMP)",
+    "CREATE MACRO dateadd(part, n, d) AS CAST(d AS TIMESTAMP) + CAST(n AS INTEGER) * "
+    "CASE part WHEN 'day' THEN INTERVAL 1 DAY ELSE INTERVAL 1 SECOND END",
+    "CREATE MACRO rs_trunc(ts) AS CAST(ts AS DATE)",
+]
+
+PARAMS = {"last_ts": 0, "day_start": "TIMESTAMP '2018-11-12'", "day_end": "TIMESTAMP '2018-11-13'"}
+
+INSERT_QUERIES = {
+    **{f"insert_{i}": query for i, query in enumerate(sql_queries.insert_table_queries)},
+    **{f"incremental_{i}": query for i, query in enumerate(sql_queries.incremental_insert_table_queries)},
+    "enrich": sql_queries.staging_events_match_key_update,
+    "match_report": sql_queries.songplay_match_report,
+    "backfill_enrich": sql_queries.backfill_enrich_query("staging_events"),
+    "backfill_replace": sql_queries.backfill_replace_query("staging_events"),
+}
+
+
+@pytest.fixture(scope="module")
+def warehouse():
+    """ An in-memory DuckDB database with the empty tables of ddl.py, without their Redshift attributes.
+    """
+    con = duckdb.connect()
+    # The division of two integers is an integer in Redshift.
+    con.execute("SET integer_division = true")
+    for table in TABLES.values():
+        columns = ", ".join(f'"{column.name}" {column.type}' for column in table.columns)
+        con.execute(f'CREATE TABLE "{table.name}" ({columns})')
+    for macro in MACROS:
+        con.execute(macro)
+    yield con
+    con.close()
+
+
+def duckdb_dialect(query):
+    """ Translates the Redshift constructs DuckDB does not parse and binds the query parameters.
+    """
+    query = re.sub(r"CREATE TEMP TABLE (\w+) \(LIKE (\w+)\)", r"CREATE TEMP TABLE \1 AS SELECT * FROM \2 LIMIT 0", query)
+    query = re.sub(r"\bTRUNC\(", "rs_trunc(", query)
+    # The date parts of DATEADD and DATEDIFF are keywords in Redshift and strings in DuckDB.
+    query = re.sub(r"\b(DATEADD|DATEDIFF)\((\w+),", r"\1('\2',", query)
+    return query % PARAMS
+
+
+def run(warehouse, query):
+    for statement in duckdb_dialect(query).split(";"):
+        if statement.strip():
+            warehouse.execute(statement)
+
+
+@pytest.mark.parametrize("name", INSERT_QUERIES)
+def test_the_queries_bind_against_the_tables(warehouse, name):
+    warehouse.execute("BEGIN")
+    try:
+        run(warehouse, INSERT_QUERIES[name])
+    finally:
+        warehouse.execute("ROLLBACK")
+
+
+def test_an_unknown_alias_fails_to_bind(warehouse):
+    with pytest.raises(duckdb.BinderException):
+        warehouse.execute(duckdb_dialect(sql_queries.songplay_table_insert.replace("s.song_id", "ss.song_id")))
+
+
+def test_the_time_dimension_holds_the_start_times_of_songplays(warehouse):
+    start_times = ["2018-11-12 23:59:59", "2018-11-13 00:00:00", "2018-11-13 07:15:42"]
+    warehouse.execute("BEGIN")
+    try:
+        for start_time in start_times:
+            warehouse.execute(
+                "INSERT INTO songplays (start_time, user_id, song_id, artist_id, session_id) VALUES (?, 1, 'S', 'A', 1)",
+                [start_time],
+            )
+        warehouse.execute("INSERT INTO time (start_time, hour) VALUES (TIMESTAMP '2018-11-13 00:00:00', 0)")
+
+        run(warehouse, sql_queries.time_table_insert)
+
+        rows = warehouse.execute("SELECT CAST(start_time AS VARCHAR), hour, day FROM time ORDER BY start_time").fetchall()
+    finally:
+        warehouse.execute("ROLLBACK")
+    assert rows == [("2018-11-12 23:59:59", 23, 12), ("2018-11-13 00:00:00", 0, None), ("2018-11-13 07:15:42", 7, 13)]
@@ -0,0 +1,51 @@
+"""
+This python file keeps the per-source watermarks used by the incremental load in etl.py:
+1. The last event timestamp (ts) loaded from the log data.
+2. The last object key (partition) and modification time processed for each S3 source.
+"""
+
+import json
+import os
+
+
+class WatermarkStore:
+    """ Persists the watermarks of every source (log_data, song_data) into a local json file.
+
+    Args:
+    path (str): The path of the json file holding the watermarks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """ Loads all the watermarks, an empty dictionary is returned when nothing was loaded before.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, source):
+        """ Returns the watermark of a single source.
+
+        Args:
+        source (str): The name of the source, for example log_data or song_data.
+        """
+        return self.load().get(source, {})
+
+    def update(self, source, **values):
+        """ Updates the watermark of a source and writes it atomically so that a failed run never leaves a broken file.
+
+        Args:
+        source (str): The name of the source, for example log_data or song_data.
+        values (dict): The watermark values to be stored (last_ts, last_key, last_modified).
+        """
+        watermarks = self.load()
+        watermarks.setdefault(source, {}).update(
+            {k: v for k, v in values.items() if v is not None}
+        )
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(watermarks, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,74 @@
+"""
+This python file reports how the workloads of the entry points fare in their WLM queues (the WLM section of dwh.cfg,
+applied by IaC.py --name wlm): the queue wait against the execution time of the statements of a query group per
+stage, as labelled by db.py, from STL_WLM_QUERY and STL_QUERY. A stage waiting long in its queue needs more slots
+or concurrency scaling, not a faster query.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import click
+
+from db import Warehouse, query_group, read_config
+from sql_queries import wlm_queue_report
+
+
+def queue_report(db, since, group):
+    """ Prints the queue wait and execution time of the statements of a query group per stage and queue.
+    Returns the rows of the report.
+
+    Args:
+    db (Warehouse): The shared connection layer.
+    since (datetime): The time (UTC) from which on the statements are reported.
+    group (str): The WLM query group, for example etl.
+    """
+    rows = db.run(
+        wlm_queue_report,
+        {"since": since.replace(tzinfo=None), "query_group": group, "label_pattern": f"{group}-%"},
+        fetch=True,
+    )
+    print(f"--------------------- WLM QUEUES ({group}) ------------------")
+    if not rows:
+        print("No statements are recorded yet, STL_WLM_QUERY is filled once the statements completed")
+        return rows
+    print(f"{'stage':<28}{'queue':>6}{'queries':>9}{'wait':>10}{'exec':>10}{'wait %':>8}{'max wait':>10}{'scaled':>8}")
+    for label, service_class, queries, queue_s, exec_s, max_queue_s, scaled in rows:
+        stage = label[len(group) + 1 :] if label != group else "-"
+        total = float(queue_s) + float(exec_s)
+        print(
+            f"{stage:<28}{service_class:>6}{queries:>9}{float(queue_s):>9.2f}s{float(exec_s):>9.2f}s"
+            f"{float(queue_s) / total if total else 0:>8.0%}{float(max_queue_s):>9.2f}s{scaled:>8}"
+        )
+    return rows
+
+
+@click.command()
+@click.option(
+    "--workload",
+    type=click.Choice(["etl", "analysis"]),
+    default="etl",
+    show_default=True,
+    help="The workload whose query group is reported.",
+)
+@click.option(
+    "--since-minutes",
+    default=60,
+    show_default=True,
+    help="Report the statements of the last minutes.",
+)
+def main(workload, since_minutes):
+    """ Prints the queue wait against the execution time of a workload per stage.
+    """
+    config = read_config()
+    group = query_group(config, workload)
+    if not group:
+        raise click.UsageError(f"{workload.upper()}_QUERY_GROUP must be set in the WLM section of dwh.cfg")
+    db = Warehouse(config)
+    try:
+        queue_report(db, datetime.now(timezone.utc) - timedelta(minutes=since_minutes), group)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()